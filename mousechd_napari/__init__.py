@@ -1,9 +1,18 @@
 __version__ = "0.0.4"
 
-from ._widget import MouseCHD
 from ._reader import napari_get_reader
 
+
+def __getattr__(name):
+    # The widget imports Qt and napari: only load it when it is requested, so
+    # that headless entry points (python -m mousechd_napari) work without them
+    if name == "MouseCHD":
+        from ._widget import MouseCHD
+        return MouseCHD
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 __all__ = (
     "napari_get_reader",
     "MouseCHD"
-)
\ No newline at end of file
+)
@@ -0,0 +1,44 @@
+"""
+Headless commands of the MouseCHD napari plugin
+"""
+
+
+def main():
+    import argparse, os
+    parser = argparse.ArgumentParser(description=__doc__)
+    import mousechd_napari
+    parser.add_argument('-version', action='version', version=mousechd_napari.__version__)
+    
+    import mousechd_napari.run.batch
+    import mousechd_napari.run.benchmark
+    import mousechd_napari.run.scale_test
+    import mousechd_napari.run.calibrate
+    import mousechd_napari.run.profiles
+    import mousechd_napari.run.cpu_runtime
+    import mousechd_napari.run.quantize
+    
+    modules = [
+        mousechd_napari.run.batch,
+        mousechd_napari.run.benchmark,
+        mousechd_napari.run.scale_test,
+        mousechd_napari.run.calibrate,
+        mousechd_napari.run.profiles,
+        mousechd_napari.run.cpu_runtime,
+        mousechd_napari.run.quantize
+    ]
+    
+    subparsers = parser.add_subparsers(title='Choose a command', required=True)
+    
+    def get_str_name(module):
+        return os.path.splitext(os.path.basename(module.__file__))[0]
+    
+    for module in modules:
+        this_parser = subparsers.add_parser(get_str_name(module), description=module.__doc__)
+        module.add_args(parser=this_parser)
+        this_parser.set_defaults(func=module.main)
+        
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Memory-aware admission of segment/diagnose jobs: run, run with fewer threads, queue or refuse
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from ._memory import MEMORY_FILE, available_memory, predict_stage_memory
+from ._threads import segmentation_plan
+
+# Memory kept free for the viewer and the system
+SAFETY_RATIO = 0.9
+# Jobs that run above this fraction of the available memory are warned about
+WARN_RATIO = 0.8
+# nnU-Net: torch and model weights
+SEG_BASE_MB = 1500
+# Each segmentation worker process: torch, weights of the folds, tile buffers
+SEG_WORKER_MB = 1000
+
+
+def total_memory():
+    """Physical memory in bytes, None if unknown
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().total
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, AttributeError, OSError):
+        return None
+
+
+def segment_memory(n_voxels, itemsize, nthreads_preprocessing, nthreads_nifti, step_size, nworkers=1):
+    """Model of the local segmentation peak (MB) before calibration.
+
+    The input is held by the viewer (`itemsize` bytes per voxel) and copied as
+    float32 by every preprocessing worker (image and its resampled version).
+    Inference aggregates 2-class float32 softmax and weights maps; each NIfTI
+    export worker holds a copy of the softmax. Smaller steps add overlapping
+    patch predictions in flight. Worker processes share the input but each
+    loads the model.
+    """
+    mb = n_voxels / 2**20
+    inference = mb * (itemsize + 4*2 + 4) * (1 + 0.1 * max(0, 0.5 / max(step_size, 0.05) - 1))
+    return (SEG_BASE_MB
+            + inference
+            + nthreads_preprocessing * mb * 4 * 2
+            + nthreads_nifti * mb * 4 * 2
+            + (nworkers * SEG_WORKER_MB if nworkers > 1 else 0))
+
+
+def calibration(workdir, resrc, itemsize=2, nthreads_nifti=2):
+    """Ratio measured / modelled memory of the past local segmentations
+    (1 without history). Each run is modelled with its recorded settings,
+    worker processes included, and the nnU-Net processes that ran for them
+    (older histories recorded the requested counts). `itemsize` and
+    `nthreads_nifti` (and one worker) are used for runs recorded without them.
+    """
+    path = os.path.join(workdir, MEMORY_FILE)
+    if not os.path.isfile(path):
+        return 1.
+    df = pd.read_csv(path)
+    df = df[(df["stage"] == "segment") & (df["resrc"] == resrc)].dropna(
+        subset=["n_voxels", "delta_mb", "nthreads_preprocessing", "step_size"]).tail(50)
+    if len(df) == 0:
+        return 1.
+    for col, default in [("itemsize", itemsize), ("nthreads_nifti", nthreads_nifti), ("nworkers", 1)]:
+        df[col] = df[col].fillna(default) if col in df.columns else default
+    ratios = [row["delta_mb"] / segment_memory(row["n_voxels"], row["itemsize"],
+                                               *job_processes(int(row["nthreads_preprocessing"]), int(row["nthreads_nifti"])),
+                                               row["step_size"], int(row["nworkers"]))
+              for _, row in df.iterrows()]
+    return float(np.clip(np.median(ratios), 0.25, 4))
+
+
+def job_processes(nthreads_preprocessing, nthreads_nifti):
+    """Preprocessing and NIfTI processes nnU-Net runs for a job of one scan
+    with the requested counts (see `segmentation_plan`)
+    """
+    plan = segmentation_plan(1, nthreads_preprocessing, nthreads_nifti)
+    return plan["preprocessing"], plan["nifti"]
+
+
+def estimate_job_memory(workdir, task, resrc, shape, dtype, nthreads_preprocessing, nthreads_nifti, step_size, nworkers=1):
+    """Peak memory (MB) of a segment/diagnose job with these settings
+    """
+    n_voxels = int(np.prod(shape))
+    itemsize = np.dtype(dtype).itemsize
+    n_pp, n_nifti = job_processes(nthreads_preprocessing, nthreads_nifti)
+    stages = [0.]
+    if resrc == "local":
+        stages.append(calibration(workdir, resrc, itemsize, n_nifti) * segment_memory(n_voxels,
+                                                                      itemsize,
+                                                                      n_pp,
+                                                                      n_nifti,
+                                                                      step_size,
+                                                                      nworkers))
+    if task == "diagnose":
+        stages.append(predict_stage_memory(workdir, "diagnose", n_voxels, resrc))
+
+    return max(stages)
+
+
+def admit(workdir, task, resrc, shape, dtype, nthreads_preprocessing, nthreads_nifti, step_size, available_mb=None, nworkers=1):
+    """Decide how to run a segment/diagnose job with the memory available now.
+
+    Returns:
+        dict: action ("run", "reduce", "queue" or "refuse"), the thread and
+            worker counts to use, estimate_mb, available_mb and a message for
+            the user (also set for a "run" above `WARN_RATIO` of the available
+            memory)
+    """
+    if available_mb is None:
+        available = available_memory()
+        available_mb = None if available is None else available / 2**20
+
+    def _estimate(n_pp, n_nifti, n_workers=nworkers):
+        return estimate_job_memory(workdir, task, resrc, shape, dtype, n_pp, n_nifti, step_size, n_workers)
+
+    decision = {"action": "run",
+                "nthreads_preprocessing": nthreads_preprocessing,
+                "nthreads_nifti": nthreads_nifti,
+                "nworkers": nworkers,
+                "estimate_mb": _estimate(nthreads_preprocessing, nthreads_nifti),
+                "available_mb": available_mb,
+                "message": ""}
+    if available_mb is None:
+        return decision
+    budget = SAFETY_RATIO * available_mb
+    if decision["estimate_mb"] <= budget:
+        if decision["estimate_mb"] > WARN_RATIO * available_mb:
+            decision["message"] = "This job needs about {:.1f} GB of the {:.1f} GB available: your computer may become slow.".format(
+                decision["estimate_mb"] / 1024, available_mb / 1024)
+        return decision
+
+    # Fewer worker processes. With one scan, nnU-Net runs one preprocessing
+    # and one NIfTI process whatever the thread counts: they are kept.
+    if resrc == "local":
+        for n_workers in range(nworkers - 1, 0, -1):
+            estimate = _estimate(nthreads_preprocessing, nthreads_nifti, n_workers)
+            if estimate <= budget:
+                decision["message"] = ("Not enough memory for {} processes ({:.1f} GB needed, {:.1f} GB available): "
+                                       "running with {} processes ({:.1f} GB).").format(
+                                           nworkers, decision["estimate_mb"] / 1024, available_mb / 1024,
+                                           n_workers, estimate / 1024)
+                decision.update({"action": "reduce",
+                                 "nworkers": n_workers,
+                                 "estimate_mb": estimate})
+                return decision
+
+    minimal = _estimate(nthreads_preprocessing, nthreads_nifti, 1) if resrc == "local" else decision["estimate_mb"]
+    total = total_memory()
+    if (total is not None) and (minimal <= SAFETY_RATIO * total / 2**20):
+        decision.update({"action": "queue",
+                         "nworkers": 1 if resrc == "local" else nworkers,
+                         "estimate_mb": minimal})
+        decision["message"] = ("Not enough memory now ({:.1f} GB needed, {:.1f} GB available): "
+                               "the job is queued and starts when memory is released.").format(minimal / 1024, available_mb / 1024)
+    else:
+        decision.update({"action": "refuse", "estimate_mb": minimal})
+        decision["message"] = ("This job needs about {:.1f} GB, more than the memory of this computer. "
+                               "Please run on server.").format(minimal / 1024)
+
+    return decision
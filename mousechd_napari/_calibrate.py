@@ -0,0 +1,220 @@
+"""
+One-time calibration of thread counts and step size from a probe of the local machine
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import SimpleITK as sitk
+
+from ._memory import available_memory
+from ._admission import total_memory, segment_memory
+
+STEP_SIZES = [0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+CROP_SIZE = 160
+
+
+def vars_path():
+    from mousechd.utils.tools import CACHE_DIR
+    return os.path.join(CACHE_DIR, "Napari", "vars.json")
+
+
+def load_vars():
+    try:
+        with open(vars_path(), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def update_vars(values):
+    """Update some keys of vars.json, keeping the others
+    """
+    default_vars = load_vars()
+    default_vars.update(values)
+    os.makedirs(os.path.dirname(vars_path()), exist_ok=True)
+    with open(vars_path(), "w") as f:
+        json.dump(default_vars, f, indent=1)
+
+    return default_vars
+
+
+def count_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def memory_bandwidth(size_mb=256, repeat=5):
+    """Copy bandwidth in GB/s
+    """
+    src = np.ones(size_mb * 2**20 // 4, dtype=np.float32)
+    dst = np.empty_like(src)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        np.copyto(dst, src)
+        best = min(best, time.perf_counter() - start)
+
+    return 2 * size_mb / 1024 / best
+
+
+def disk_throughput(workdir, size_mb=256):
+    """Sequential write and read throughput of `workdir` in MB/s. Reads may be
+    served from the page cache.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    path = os.path.join(workdir, ".calibration.bin")
+    data = np.random.default_rng(0).integers(0, 255, size_mb * 2**20, dtype=np.uint8).tobytes()
+    try:
+        start = time.perf_counter()
+        with open(path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        write = size_mb / (time.perf_counter() - start)
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            while f.read(64 * 2**20):
+                pass
+        read = size_mb / (time.perf_counter() - start)
+    finally:
+        if os.path.isfile(path):
+            os.remove(path)
+
+    return write, read
+
+
+def probe_hardware(workdir):
+    probe = {"cores": count_cores(),
+             "memory_total_gb": (total_memory() or 0) / 2**30,
+             "memory_available_gb": (available_memory() or 0) / 2**30,
+             "memory_bandwidth_gbs": memory_bandwidth()}
+    probe["disk_write_mbs"], probe["disk_read_mbs"] = disk_throughput(workdir)
+    try:
+        import torch
+        probe["gpu"] = torch.cuda.get_device_name(0) if torch.cuda.is_available() else None
+    except ImportError:
+        probe["gpu"] = None
+
+    return probe
+
+
+def time_cropped_segmentation(sample_path, nthreads_preprocessing, nthreads_nifti, step_size=0.5, crop=CROP_SIZE):
+    """Segment the center crop of the sample scan with the default profile of
+    this machine.
+
+    Returns:
+        tuple: (seconds, crop voxels, sample voxels)
+    """
+    from ._utils import nnunet_predict
+    from ._profiles import default_profile
+
+    img = sitk.ReadImage(sample_path)
+    size = img.GetSize()
+    start = [max(0, s // 2 - crop // 2) for s in size]
+    extent = [min(crop, s) for s in size]
+    cropped = sitk.RegionOfInterest(img, extent, start)
+
+    tmpdir = tempfile.mkdtemp(prefix="mousechd_calibration_")
+    try:
+        indir = os.path.join(tmpdir, "in")
+        os.makedirs(indir)
+        sitk.WriteImage(cropped, os.path.join(indir, "calibration_0000.nii.gz"))
+        t = time.time()
+        nnunet_predict(indir=indir,
+                       outdir=os.path.join(tmpdir, "out"),
+                       profile=default_profile(),
+                       step_size=step_size,
+                       nthreads_preprocessing=nthreads_preprocessing,
+                       nthreads_nifti=nthreads_nifti)
+        duration = time.time() - t
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return duration, int(np.prod(extent)), int(np.prod(size))
+
+
+def recommend(probe, seg_time=None, crop_voxels=None, scan_voxels=None, target_minutes=10):
+    """Settings for this machine.
+
+    Preprocessing threads: all cores but 2 (at most 8), fewer if the
+    segmentation of a typical scan would use more than 60% of the memory.
+    NIfTI threads: 1 on slow disks or small machines, 2 otherwise.
+    Segmentation processes: 1 on GPU; on CPU one per 8 cores (torch threads
+    scale poorly beyond), as many as fit in 60% of the memory.
+    Step size: 0.5 on GPU; on CPU the smallest step whose predicted time on a
+    typical scan is under `target_minutes` (the number of sliding windows
+    scales with (0.5/step)^3, tiles are shared by the processes).
+    """
+    scan_voxels = scan_voxels or 500**3
+    nthreads_nifti = 1 if (probe["disk_write_mbs"] < 150 or probe["cores"] <= 4) else 2
+    nthreads_preprocessing = int(min(8, max(1, probe["cores"] - 2)))
+    while (nthreads_preprocessing > 1) and (
+            segment_memory(scan_voxels, 2, nthreads_preprocessing, nthreads_nifti, 0.5)
+            > 0.6 * probe["memory_total_gb"] * 1024):
+        nthreads_preprocessing -= 1
+    nworkers = 1
+    if not probe["gpu"]:
+        nworkers = max(1, probe["cores"] // 8)
+        while (nworkers > 1) and (
+                segment_memory(scan_voxels, 2, nthreads_preprocessing, nthreads_nifti, 0.5, nworkers)
+                > 0.6 * probe["memory_total_gb"] * 1024):
+            nworkers -= 1
+
+    step_size = 0.5
+    predicted = None
+    if seg_time is not None:
+        predicted = {s: seg_time * scan_voxels / crop_voxels * (0.5 / s)**3 / nworkers for s in STEP_SIZES}
+        if not probe["gpu"]:
+            fast_enough = [s for s in STEP_SIZES if predicted[s] <= target_minutes * 60]
+            step_size = fast_enough[0] if fast_enough else STEP_SIZES[-1]
+
+    return {"nthreads_preprocessing": nthreads_preprocessing,
+            "nthreads_nifti": nthreads_nifti,
+            "nworkers": nworkers,
+            "step_size": step_size,
+            "predicted_segment_time": None if predicted is None else predicted[step_size]}
+
+
+def calibrate(workdir, sample_path=None, segment=True, target_minutes=10, save=True):
+    """Probe the machine, time a short segmentation on a crop of the sample
+    scan and store the recommended settings in vars.json.
+
+    Returns:
+        dict: calibration (probe, timings, recommended settings)
+    """
+    logging.info("Probe hardware")
+    probe = probe_hardware(workdir)
+    logging.info(json.dumps(probe, indent=1))
+    res = {"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+           "probe": probe,
+           "target_minutes": target_minutes}
+
+    seg_time, crop_voxels, scan_voxels = None, None, None
+    if segment and (sample_path is not None) and os.path.isfile(sample_path):
+        from mousechd.segmentation.utils import download_seg_models
+        download_seg_models()
+        first = recommend(probe)
+        logging.info("Time segmentation of a {}^3 crop of the sample".format(CROP_SIZE))
+        seg_time, crop_voxels, scan_voxels = time_cropped_segmentation(sample_path,
+                                                                       nthreads_preprocessing=first["nthreads_preprocessing"],
+                                                                       nthreads_nifti=first["nthreads_nifti"])
+        res.update({"crop_segment_time": seg_time, "crop_voxels": crop_voxels, "scan_voxels": scan_voxels})
+
+    res["recommended"] = recommend(probe, seg_time, crop_voxels, scan_voxels, target_minutes)
+    logging.info("Recommended: {}".format(res["recommended"]))
+    if save:
+        update_vars({"calibration": res,
+                     "nthreads_preprocessing": res["recommended"]["nthreads_preprocessing"],
+                     "nthreads_nifti": res["recommended"]["nthreads_nifti"],
+                     "nworkers": res["recommended"]["nworkers"],
+                     "step_size": res["recommended"]["step_size"]})
+
+    return res
@@ -0,0 +1,27 @@
+"""
+Device probes, run once per process and only when a task needs them, so that torch and TensorFlow are not imported at start-up
+"""
+import functools
+import logging
+
+
+@functools.lru_cache(maxsize=None)
+def cuda_available():
+    """CUDA device usable by torch (segmentation)
+    """
+    import torch
+    return torch.cuda.is_available()
+
+
+@functools.lru_cache(maxsize=None)
+def tf_gpu_available():
+    """GPU usable by TensorFlow (classifier). GPUs that fail the probe are
+    hidden from TensorFlow, so it must run before the first model is built.
+    """
+    import tensorflow as tf
+    try:
+        return bool(tf.test.is_gpu_available())
+    except Exception:
+        logging.info("TensorFlow can't use the GPU, the classifier runs on CPU")
+        tf.config.set_visible_devices([], "GPU")
+        return False
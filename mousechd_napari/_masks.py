@@ -0,0 +1,261 @@
+"""
+Compact in-memory and on-disk forms of heart masks (uint8 labels, bit-packed and run-length files, surface meshes) and GradCAM heatmaps (float16)
+"""
+import os
+
+import numpy as np
+
+MASK_DTYPE = np.uint8
+HEATMAP_DTYPE = np.float16
+PACKED_EXT = ".npz"
+# Bounding box + run lengths, with the NIfTI geometry
+RLE_EXT = ".rle.npz"
+NIFTI_EXT = ".nii.gz"
+
+
+def to_labels(mask):
+    """Mask as uint8 labels, without a copy if it already is
+    """
+    return np.asarray(mask, dtype=MASK_DTYPE)
+
+
+def to_heatmap(cam):
+    """GradCAM in [0, 1] at half precision (3 significant digits)
+    """
+    return np.asarray(cam, dtype=HEATMAP_DTYPE)
+
+
+def save_packed_mask(mask, path, spacing=None):
+    """Binary mask packed 8 voxels per byte in a compressed .npz file
+    """
+    np.savez_compressed(path,
+                        bits=np.packbits(np.asarray(mask) != 0),
+                        shape=np.asarray(mask.shape),
+                        spacing=np.asarray(spacing if spacing is not None else [1.] * mask.ndim, dtype=float))
+
+
+def load_packed_mask(path):
+    """Returns:
+        tuple: uint8 mask, spacing (z, y, x)
+    """
+    with np.load(path) as f:
+        shape = tuple(f["shape"])
+        mask = np.unpackbits(f["bits"], count=int(np.prod(shape))).reshape(shape)
+        return mask.astype(MASK_DTYPE, copy=False), tuple(f["spacing"])
+
+
+def mask_bbox(mask):
+    """Bounding box of the non-zero voxels, from projections on each axis
+
+    Returns:
+        tuple: slices, None if the mask is empty
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        others = tuple(x for x in range(mask.ndim) if x != axis)
+        idx = np.flatnonzero(np.any(mask, axis=others))
+        if len(idx) == 0:
+            return None
+        bbox.append(slice(idx[0], idx[-1] + 1))
+
+    return tuple(bbox)
+
+
+def mask_surface(mask, step_size=2):
+    """Isosurface of the mask, extracted on its bounding box. `step_size`
+    (voxels) decimates the mesh: 1 gives the full resolution mesh.
+
+    Returns:
+        tuple: vertices (float32, in voxels of `mask`), faces (int32), None
+            if the mask is empty
+    """
+    from skimage.measure import marching_cubes
+
+    bbox = mask_bbox(mask)
+    if bbox is None:
+        return None
+    # One empty voxel around the box closes the surface
+    crop = np.pad(np.asarray(mask[bbox] != 0, dtype=np.float32), 1)
+    verts, faces, _, _ = marching_cubes(crop, level=0.5, step_size=step_size, allow_degenerate=False)
+    verts += np.array([b.start - 1 for b in bbox], dtype=verts.dtype)
+
+    return verts.astype(np.float32), faces.astype(np.int32)
+
+
+def rle_encode(mask):
+    """Bounding box of a binary mask and run lengths of the box (C order),
+    starting with a run of `first`.
+
+    Returns:
+        dict: shape, start, stop, first, runs
+    """
+    bbox = mask_bbox(mask)
+    if bbox is None:
+        return {"shape": np.asarray(mask.shape),
+                "start": np.zeros(mask.ndim, dtype=np.int64),
+                "stop": np.zeros(mask.ndim, dtype=np.int64),
+                "first": np.uint8(0),
+                "runs": np.zeros(0, dtype=np.int64)}
+    flat = np.asarray(mask[bbox] != 0).ravel()
+    bounds = np.concatenate([[0], np.flatnonzero(flat[1:] != flat[:-1]) + 1, [flat.size]])
+
+    return {"shape": np.asarray(mask.shape),
+            "start": np.asarray([b.start for b in bbox]),
+            "stop": np.asarray([b.stop for b in bbox]),
+            "first": np.uint8(flat[0]),
+            "runs": np.diff(bounds)}
+
+
+def rle_decode(encoded, crop=False, pad=0):
+    """Mask of `rle_encode`, whole or cropped to the bounding box enlarged by
+    `pad` voxels (within the volume). An empty mask is not cropped, as in
+    `read_mask`.
+
+    Returns:
+        tuple: uint8 mask, offset of the mask in the volume
+    """
+    shape = tuple(int(x) for x in encoded["shape"])
+    start, stop = np.asarray(encoded["start"]), np.asarray(encoded["stop"])
+    runs = np.asarray(encoded["runs"])
+    if crop and (len(runs) > 0):
+        lo = np.maximum(start - pad, 0)
+        hi = np.minimum(stop + pad, shape)
+    else:
+        lo, hi = np.zeros(len(shape), dtype=int), np.asarray(shape)
+    mask = np.zeros(tuple(hi - lo), dtype=MASK_DTYPE)
+    if len(runs) > 0:
+        values = ((np.arange(len(runs)) + int(encoded["first"])) % 2).astype(MASK_DTYPE)
+        box = tuple(slice(a - o, b - o) for a, b, o in zip(start, stop, lo))
+        mask[box] = np.repeat(values, runs).reshape(tuple(stop - start))
+
+    return mask, tuple(int(x) for x in lo)
+
+
+def save_rle_mask(mask, path, spacing=None, origin=None, direction=None):
+    """Mask as bounding box + run lengths, with its NIfTI geometry (SimpleITK
+    order: x, y, z)
+    """
+    np.savez_compressed(path,
+                        spacing=np.asarray(spacing if spacing is not None else [1.] * mask.ndim, dtype=float),
+                        origin=np.asarray(origin if origin is not None else [0.] * mask.ndim, dtype=float),
+                        direction=np.asarray(direction if direction is not None else np.eye(mask.ndim).ravel(), dtype=float),
+                        **rle_encode(mask))
+
+
+def load_rle_mask(path, crop=False, pad=0):
+    """Returns:
+        tuple: uint8 mask (whole or cropped, see `rle_decode`), geometry
+            (spacing, origin, direction, offset)
+    """
+    with np.load(path) as f:
+        encoded = {k: f[k] for k in f.files}
+    mask, offset = rle_decode(encoded, crop=crop, pad=pad)
+
+    return mask, {"spacing": tuple(encoded["spacing"]),
+                  "origin": tuple(encoded["origin"]),
+                  "direction": tuple(encoded["direction"]),
+                  "offset": offset}
+
+
+def find_mask(maskdir, heart_name):
+    """Path of the mask of a heart in `maskdir`, compact first, None if there
+    is none
+    """
+    for ext in [RLE_EXT, NIFTI_EXT]:
+        path = os.path.join(maskdir, f"{heart_name}{ext}")
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def read_mask(path, crop=False, pad=0):
+    """Mask of a compact or NIfTI file, see `load_rle_mask`. NIfTI masks are
+    read whole, then cropped.
+    """
+    if path.endswith(RLE_EXT):
+        return load_rle_mask(path, crop=crop, pad=pad)
+    import SimpleITK as sitk
+    img = sitk.ReadImage(path)
+    mask = to_labels(sitk.GetArrayFromImage(img))
+    offset = (0,) * mask.ndim
+    if crop:
+        bbox = mask_bbox(mask)
+        if bbox is not None:
+            bbox = tuple(slice(max(b.start - pad, 0), min(b.stop + pad, n)) for b, n in zip(bbox, mask.shape))
+            mask, offset = mask[bbox], tuple(b.start for b in bbox)
+
+    return mask, {"spacing": img.GetSpacing(),
+                  "origin": img.GetOrigin(),
+                  "direction": img.GetDirection(),
+                  "offset": offset}
+
+
+def compact_mask(path, mask=None, geometry=None, remove=True):
+    """Convert a NIfTI mask to the compact format next to it. `mask` and
+    `geometry` of `read_mask` avoid reading it again.
+
+    Returns:
+        str: path of the compact mask
+    """
+    if not path.endswith(NIFTI_EXT):
+        return path
+    if mask is None:
+        mask, geometry = read_mask(path)
+    out_path = path[:-len(NIFTI_EXT)] + RLE_EXT
+    save_rle_mask(mask, out_path,
+                  spacing=geometry["spacing"],
+                  origin=geometry["origin"],
+                  direction=geometry["direction"])
+    if remove:
+        os.remove(path)
+
+    return out_path
+
+
+def expand_mask_folder(maskdir):
+    """Write a NIfTI copy of the compact masks of a folder that have none, for
+    tools that only read NIfTI (server resampling)
+
+    Returns:
+        list: paths of the written NIfTI masks
+    """
+    import SimpleITK as sitk
+
+    written = []
+    for x in sorted(os.listdir(maskdir)):
+        if x.startswith(".") or (not x.endswith(RLE_EXT)):
+            continue
+        out_path = os.path.join(maskdir, x[:-len(RLE_EXT)] + NIFTI_EXT)
+        if os.path.isfile(out_path):
+            continue
+        mask, geometry = load_rle_mask(os.path.join(maskdir, x))
+        img = sitk.GetImageFromArray(mask)
+        img.SetSpacing([float(v) for v in geometry["spacing"]])
+        img.SetOrigin([float(v) for v in geometry["origin"]])
+        img.SetDirection([float(v) for v in geometry["direction"]])
+        sitk.WriteImage(img, out_path)
+        written.append(out_path)
+
+    return written
+
+
+def compact_mask_folder(maskdir):
+    """Convert the NIfTI masks of a folder to the compact format
+
+    Returns:
+        int: number of converted masks
+    """
+    paths = [os.path.join(maskdir, x) for x in os.listdir(maskdir) if x.endswith(NIFTI_EXT)]
+    for path in paths:
+        compact_mask(path)
+
+    return len(paths)
+
+
+def memory_report(before, after):
+    """Bytes of an array before and after conversion
+    """
+    return {"nbytes_before": int(before.nbytes),
+            "nbytes_after": int(after.nbytes),
+            "dtype_before": str(before.dtype),
+            "dtype_after": str(after.dtype)}
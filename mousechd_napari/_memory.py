@@ -0,0 +1,193 @@
+"""
+Per-stage peak memory accounting and prediction of the memory needed by a job
+"""
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from ._profiling import current_rss
+
+MEMORY_FILE = "memory.csv"
+MEMORY_HEADERS = ["date",
+                  "task",
+                  "stage",
+                  "resrc",
+                  "n_voxels",
+                  "itemsize",
+                  "nthreads_preprocessing",
+                  "nthreads_nifti",
+                  "nworkers",
+                  "step_size",
+                  "rss_start_mb",
+                  "peak_mb",
+                  "delta_mb",
+                  "gpu_peak_mb"]
+
+# Used before any run is recorded: MB at start + bytes per input voxel
+DEFAULT_COST = {"segment": (2000, 40),
+                "diagnose": (1500, 12)}
+
+
+def available_memory():
+    """Memory available for new allocations in bytes, None if unknown
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def gpu_peak_memory():
+    """Peak memory of the torch and TensorFlow GPU allocators in bytes, None
+    without GPU. Frameworks are only queried if they are already imported.
+    """
+    peak = None
+    torch = sys.modules.get("torch")
+    if (torch is not None) and torch.cuda.is_available():
+        peak = torch.cuda.max_memory_allocated()
+    tf = sys.modules.get("tensorflow")
+    if tf is not None:
+        try:
+            if tf.config.list_physical_devices("GPU"):
+                peak = (peak or 0) + tf.config.experimental.get_memory_info("GPU:0")["peak"]
+        except (ValueError, AttributeError, RuntimeError):
+            pass
+    return peak
+
+
+def reset_gpu_peak_memory():
+    torch = sys.modules.get("torch")
+    if (torch is not None) and torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    tf = sys.modules.get("tensorflow")
+    if tf is not None:
+        try:
+            if tf.config.list_physical_devices("GPU"):
+                tf.config.experimental.reset_memory_stats("GPU:0")
+        except (ValueError, AttributeError, RuntimeError):
+            pass
+
+
+class MemoryMonitor:
+    """Sample the resident memory of the process and its children during a
+    run and record the peak of each stage.
+
+    Usage:
+        monitor = MemoryMonitor(task="diagnose", resrc="local", n_voxels=im.size)
+        with monitor.stage("segment"):
+            ...
+        monitor.save(workdir)
+    """
+    def __init__(self, task, resrc="local", n_voxels=None, interval=0.05, **params):
+        self.task = task
+        self.resrc = resrc
+        self.n_voxels = n_voxels
+        self.params = params
+        self.interval = interval
+        self.records = []
+        self._peak = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss(children=True) or 0
+            with self._lock:
+                self._peak = max(self._peak, rss)
+
+    @contextmanager
+    def stage(self, name, record=True):
+        """Measure the block as stage `name`. With `record=False` (e.g. result
+        read from a cache), nothing is recorded.
+        """
+        if (current_rss() is None) or (not record):
+            yield
+            return
+        start = current_rss(children=True)
+        with self._lock:
+            self._peak = start
+        reset_gpu_peak_memory()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        try:
+            yield
+        finally:
+            self._stop.set()
+            self._thread.join()
+            peak = max(self._peak, current_rss(children=True))
+            gpu_peak = gpu_peak_memory()
+            self.records.append({"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                 "task": self.task,
+                                 "stage": name,
+                                 "resrc": self.resrc,
+                                 "n_voxels": self.n_voxels,
+                                 "itemsize": self.params.get("itemsize"),
+                                 "nthreads_preprocessing": self.params.get("nthreads_preprocessing"),
+                                 "nthreads_nifti": self.params.get("nthreads_nifti"),
+                                 "nworkers": self.params.get("nworkers"),
+                                 "step_size": self.params.get("step_size"),
+                                 "rss_start_mb": start / 2**20,
+                                 "peak_mb": peak / 2**20,
+                                 "delta_mb": (peak - start) / 2**20,
+                                 "gpu_peak_mb": None if gpu_peak is None else gpu_peak / 2**20})
+
+    def peaks(self):
+        """Peak memory (MB) of each recorded stage
+        """
+        return {x["stage"]: x["peak_mb"] for x in self.records}
+
+    def save(self, workdir):
+        """Append the records to the memory history of `workdir`
+        """
+        if len(self.records) == 0:
+            return
+        path = os.path.join(workdir, MEMORY_FILE)
+        df = pd.DataFrame(self.records, columns=MEMORY_HEADERS)
+        if os.path.isfile(path) and (list(pd.read_csv(path, nrows=0).columns) != MEMORY_HEADERS):
+            # History written with fewer columns: rewritten with the new ones
+            df = pd.concat([pd.read_csv(path).reindex(columns=MEMORY_HEADERS), df])
+            df.to_csv(path, index=False)
+            return
+        df.to_csv(path, mode="a", header=not os.path.isfile(path), index=False)
+
+
+def predict_stage_memory(workdir, stage, n_voxels, resrc="local"):
+    """Memory (MB) a stage will add on an input of `n_voxels` voxels.
+
+    Fitted on the past runs of `workdir/memory.csv` (linear in the number of
+    voxels, or proportional with a single input size), defaults otherwise.
+    """
+    path = os.path.join(workdir, MEMORY_FILE)
+    if os.path.isfile(path):
+        df = pd.read_csv(path)
+        df = df[(df["stage"] == stage) & (df["resrc"] == resrc)].dropna(subset=["n_voxels", "delta_mb"])
+        df = df.tail(50)
+        if df["n_voxels"].nunique() >= 2:
+            slope, intercept = np.polyfit(df["n_voxels"], df["delta_mb"], 1)
+            return max(float(intercept + slope * n_voxels), float(df["delta_mb"].max()) * 0.5)
+        if len(df) > 0:
+            # With one input size: keep the largest observed, scaled by size
+            row = df.loc[df["delta_mb"].idxmax()]
+            return float(row["delta_mb"]) * n_voxels / max(float(row["n_voxels"]), 1)
+
+    if stage not in DEFAULT_COST:
+        return 0.
+    base_mb, bytes_per_voxel = DEFAULT_COST[stage]
+    return base_mb + bytes_per_voxel * n_voxels / 2**20
+
@@ -0,0 +1,126 @@
+"""
+Loaded classifiers and prepared classifier inputs, kept in memory so that switching between the default and retrained models does not reload weights or resample the heart again
+"""
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+CONF_NAME = "configs.json"
+WEIGHTS_NAME = "best_model.hdf5"
+# Classifiers kept in memory (about 100 MB each)
+MAX_MODELS = 3
+# Prepared inputs kept in memory (one float32 volume of the model input shape each)
+MAX_INPUTS = 4
+
+
+def model_files(model_dir):
+    return os.path.join(model_dir, CONF_NAME), os.path.join(model_dir, WEIGHTS_NAME)
+
+
+def is_model_dir(model_dir):
+    return all(os.path.isfile(x) for x in model_files(model_dir))
+
+
+class ClassifierCache:
+    """LRU cache of classifiers keyed by model folder and modification time
+    of the weights: retraining in place invalidates the cached model.
+    """
+    def __init__(self, maxsize=MAX_MODELS):
+        self.maxsize = maxsize
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        # One load at a time: a folder requested twice is loaded once
+        self.load_lock = threading.Lock()
+
+    @staticmethod
+    def key(model_dir):
+        _, weights_path = model_files(model_dir)
+        return (os.path.realpath(model_dir), os.path.getmtime(weights_path))
+
+    def get(self, model_dir):
+        """Cached classifier of `model_dir`, None if it is not loaded
+        """
+        try:
+            key = self.key(model_dir)
+        except OSError:
+            return None
+        with self.lock:
+            if key not in self.models:
+                return None
+            self.models.move_to_end(key)
+            return self.models[key]
+
+    def load(self, model_dir):
+        """Classifier of `model_dir`, loaded if it is not cached
+        """
+        from mousechd.classifier.models import load_MouseCHD_model
+
+        with self.load_lock:
+            model = self.get(model_dir)
+            if model is not None:
+                return model
+            key = self.key(model_dir)
+            conf_path, weights_path = model_files(model_dir)
+            model = load_MouseCHD_model(conf_path=conf_path, weights_path=weights_path)
+            with self.lock:
+                # Weights of the same folder with an older mtime are stale
+                for old in [k for k in self.models if k[0] == key[0]]:
+                    del self.models[old]
+                self.models[key] = model
+                while len(self.models) > self.maxsize:
+                    evicted, _ = self.models.popitem(last=False)
+                    logging.info(f"Classifier unloaded: {evicted[0]}")
+
+        return model
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+
+def heart_key(cropped_im, cropped_ma):
+    """Digest of the cropped image and mask of a heart
+    """
+    import numpy as np
+
+    digest = hashlib.blake2b(digest_size=16)
+    for arr in [cropped_im, cropped_ma]:
+        arr = np.ascontiguousarray(arr)
+        digest.update(f"{arr.shape}{arr.dtype.str}".encode())
+        digest.update(memoryview(arr).cast("B"))
+
+    return digest.hexdigest()
+
+
+class InputCache:
+    """LRU cache of classifier inputs keyed by heart digest and model input
+    shape: the models sharing an input shape reuse the same input.
+    """
+    def __init__(self, maxsize=MAX_INPUTS):
+        self.maxsize = maxsize
+        self.inputs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.inputs:
+                return None
+            self.inputs.move_to_end(key)
+            return self.inputs[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.inputs[key] = value
+            self.inputs.move_to_end(key)
+            while len(self.inputs) > self.maxsize:
+                self.inputs.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.inputs.clear()
+
+
+classifiers = ClassifierCache()
+classifier_inputs = InputCache()
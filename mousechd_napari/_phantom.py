@@ -0,0 +1,155 @@
+"""
+Synthetic heart phantoms and micro-CT cohorts in the layouts accepted by the plugin
+"""
+import os
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+FORMATS = ["NIFTI", "NRRD", "DICOM"]
+SPACING = 0.02
+
+
+def heart_phantom(size, seed=0, chd=False, n_debris=5):
+    """Heart-like phantom: a mouse body ellipsoid containing a heart with
+    four brighter chambers, plus Gaussian noise. Heart size and position vary
+    with the seed. CHD phantoms have a septal defect joining the ventricles.
+
+    Args:
+        size (int or tuple): volume shape (z, y, x), or side of a cube
+        seed (int, optional): random seed. Defaults to 0.
+        chd (bool, optional): add a septal defect. Defaults to False.
+        n_debris (int, optional): small false positive blobs added to the
+            mask, removed by mask post-processing. Defaults to 5.
+
+    Returns:
+        tuple: (image as int16, heart mask as uint8)
+    """
+    shape = (size,)*3 if np.isscalar(size) else tuple(size)
+    rng = np.random.default_rng(seed)
+    im = np.empty(shape, dtype=np.int16)
+    heart = np.zeros(shape, dtype=np.uint8)
+
+    cz, cy, cx = [s/2 for s in shape]
+    hz, hy, hx = [s * rng.uniform(0.10, 0.15) for s in shape]
+    hcz, hcy, hcx = [c + s*rng.uniform(-0.03, 0.03) for c, s in zip((cz, cy, cx), shape)]
+    chambers = [(dz*0.35*hz, dy*0.35*hy, dx*0.35*hx) for dz, dy, dx in
+                [(-1, -1, -1), (-1, 1, 1), (1, -1, 1), (1, 1, -1)]]
+    y, x = np.ogrid[:shape[1], :shape[2]]
+    # Filled slice by slice to keep memory close to the output arrays
+    for z in range(shape[0]):
+        body = (((z - cz) / (0.45*shape[0]))**2 + ((y - cy) / (0.35*shape[1]))**2
+                + ((x - cx) / (0.40*shape[2]))**2) <= 1
+        myo = ((z - hcz) / hz)**2 + ((y - hcy) / hy)**2 + ((x - hcx) / hx)**2 <= 1
+        sl = np.where(body, 200, -1000).astype(np.int16)
+        sl[myo] = 600
+        for dz, dy, dx in chambers:
+            chamber = (((z - hcz - dz) / (0.3*hz))**2 + ((y - hcy - dy) / (0.3*hy))**2
+                       + ((x - hcx - dx) / (0.3*hx))**2) <= 1
+            sl[chamber & myo] = 900
+        if chd and abs(z - hcz - 0.35*hz) < 0.1*hz:
+            defect = (np.abs(y - hcy) < 0.1*hy) & (np.abs(x - hcx) < 0.35*hx) & myo
+            sl[defect] = 900
+        sl += rng.normal(0, 30, sl.shape).astype(np.int16)
+        im[z] = sl
+        heart[z] = myo
+
+    r = max(2, min(shape) // 100)
+    for _ in range(n_debris):
+        z, y, x = [rng.integers(r, s - r) for s in shape]
+        heart[z-r:z+r, y-r:y+r, x-r:x+r] = 1
+
+    return im, heart
+
+
+def write_dicom_series(img, outdir, patient_name):
+    """Write a 3D image as a DICOM series (one file per slice)
+    """
+    os.makedirs(outdir, exist_ok=True)
+    # hash() of a str changes between processes (PYTHONHASHSEED)
+    digest = hashlib.sha256(patient_name.encode()).hexdigest()
+    uid = "1.2.826.0.1.3680043.2.1125." + str(int(digest, 16) % 10**12)
+    direction = img.GetDirection()
+    tags = [("0010|0010", patient_name),
+            ("0010|0020", patient_name),
+            ("0008|0060", "CT"),
+            ("0020|000d", uid + ".1"),
+            ("0020|000e", uid + ".2"),
+            ("0020|0037", "\\".join(map(str, (direction[0], direction[3], direction[6],
+                                              direction[1], direction[4], direction[7])))),
+            ("0008|103e", "MouseCHD phantom")]
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for i in range(img.GetDepth()):
+        sl = img[:, :, i]
+        for tag, value in tags:
+            sl.SetMetaData(tag, value)
+        sl.SetMetaData("0020|0032", "\\".join(map(str, img.TransformIndexToPhysicalPoint((0, 0, i)))))
+        sl.SetMetaData("0020|0013", str(i + 1))
+        sl.SetMetaData("0018|0050", str(img.GetSpacing()[2]))
+        writer.SetFileName(os.path.join(outdir, "{:04d}.dcm".format(i + 1)))
+        writer.Execute(sl)
+
+
+def write_phantom(im, heart, outdir, name, fmt="NIFTI", maskdir=None):
+    """Write a phantom in `outdir` as `name.nii.gz`, `name.nrrd` or a DICOM
+    folder `name`, and its mask as `maskdir/name.nii.gz`.
+    """
+    img = sitk.GetImageFromArray(im)
+    img.SetSpacing((SPACING,)*3)
+    if fmt == "NIFTI":
+        sitk.WriteImage(img, os.path.join(outdir, f"{name}.nii.gz"))
+    elif fmt == "NRRD":
+        sitk.WriteImage(img, os.path.join(outdir, f"{name}.nrrd"))
+    elif fmt == "DICOM":
+        write_dicom_series(img, os.path.join(outdir, name), patient_name=name)
+    else:
+        raise ValueError(f"Unknown format {fmt}, choose from {FORMATS}")
+
+    if maskdir is not None:
+        ma = sitk.GetImageFromArray(heart)
+        ma.CopyInformation(img)
+        sitk.WriteImage(ma, os.path.join(maskdir, f"{name}.nii.gz"))
+
+
+def make_cohort(outdir, n_hearts, size=256, fmt="NIFTI", chd_ratio=0.5, seed=42, nthreads=4):
+    """Synthetic cohort in the retrain layout: `outdir/CHD` and
+    `outdir/Normal` contain the scans, `outdir/masks` the heart masks.
+    Existing phantoms are kept, so a cohort can be grown.
+
+    Args:
+        outdir (str): output directory
+        n_hearts (int): number of phantoms
+        size (int, optional): side of the volumes. Defaults to 256.
+        fmt (str, optional): "NIFTI", "NRRD" or "DICOM". Defaults to "NIFTI".
+        chd_ratio (float, optional): fraction of CHD phantoms. Defaults to 0.5.
+        seed (int, optional): random seed. Defaults to 42.
+        nthreads (int, optional): number of writing threads. Defaults to 4.
+
+    Returns:
+        list: (group, name) of the phantoms
+    """
+    for group in ["CHD", "Normal", "masks"]:
+        os.makedirs(os.path.join(outdir, group), exist_ok=True)
+    n_chd = int(round(n_hearts * chd_ratio))
+    hearts = [("CHD" if i < n_chd else "Normal", "phantom_{:05d}".format(i)) for i in range(n_hearts)]
+    ext = {"NIFTI": ".nii.gz", "NRRD": ".nrrd", "DICOM": ""}[fmt]
+
+    def _make(i):
+        group, name = hearts[i]
+        if os.path.exists(os.path.join(outdir, group, name + ext)):
+            return
+        im, heart = heart_phantom(size, seed=seed + i, chd=(group == "CHD"))
+        write_phantom(im, heart, os.path.join(outdir, group), name, fmt=fmt,
+                      maskdir=os.path.join(outdir, "masks"))
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        list(executor.map(_make, range(n_hearts)))
+    logging.info("{} phantoms ({} CHD, {}) generated in {:.1f}s".format(n_hearts, n_chd, fmt, time.time() - start))
+
+    return hearts
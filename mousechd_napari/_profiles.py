@@ -0,0 +1,122 @@
+"""
+Segmentation profiles: folds, test-time augmentation and step size, with their measured runtime and accuracy
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+from datetime import datetime
+
+import SimpleITK as sitk
+
+# From the fastest to the most accurate
+PROFILES = {"preview": {"folds": [0], "tta": False, "step_size": 1.0,
+                        "description": "1 fold, no TTA, step 1.0"},
+            "standard": {"folds": [0], "tta": False, "step_size": 0.5,
+                         "description": "1 fold, no TTA, step 0.5"},
+            "accurate": {"folds": None, "tta": False, "step_size": 0.5,
+                         "description": "5-fold ensemble, no TTA, step 0.5"},
+            "full": {"folds": None, "tta": True, "step_size": 0.5,
+                     "description": "5-fold ensemble, TTA (mirroring), step 0.5"}}
+PROFILES_FILE = "profiles.json"
+
+
+def default_profile():
+    """Former implicit choice: 5-fold ensemble on GPU, 1 fold on CPU
+    """
+    from ._capabilities import cuda_available
+    return "accurate" if cuda_available() else "standard"
+
+
+def profiles_path():
+    from mousechd.utils.tools import CACHE_DIR
+    return os.path.join(CACHE_DIR, "Napari", PROFILES_FILE)
+
+
+def load_measurements():
+    try:
+        with open(profiles_path(), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def describe(profile, measurements=None):
+    """One line description of a profile, with its measurements if any
+    """
+    measurements = load_measurements() if measurements is None else measurements
+    text = PROFILES[profile]["description"]
+    if profile in measurements:
+        m = measurements[profile]
+        text += " | sample: {} on {}".format(time.strftime("%Hh%Mm%Ss", time.gmtime(m["time"])), m["device"])
+        if m.get("dice") is not None:
+            text += ", Dice vs {}: {:.3f}".format(m["reference"], m["dice"])
+
+    return text
+
+
+def measure_profiles(sample_path, profiles=None, nthreads_preprocessing=6, nthreads_nifti=2, crop=None):
+    """Segment the sample scan with each profile, record the time and the
+    Dice with the most accurate profile measured, and save them.
+
+    Args:
+        sample_path (str): NIfTI scan
+        profiles (list, optional): profiles to measure. Defaults to all.
+        crop (int, optional): segment only the central crop^3 region. Defaults to None.
+
+    Returns:
+        dict: profile -> time, dice, reference, device, n_voxels, date
+    """
+    import torch
+    import numpy as np
+    from mousechd.segmentation.utils import calc_dsc
+    from ._utils import nnunet_predict, clean_mask
+
+    profiles = list(PROFILES.keys()) if profiles is None else profiles
+    profiles = sorted(profiles, key=list(PROFILES.keys()).index)
+    img = sitk.ReadImage(sample_path)
+    if crop is not None:
+        size = img.GetSize()
+        img = sitk.RegionOfInterest(img,
+                                    [min(crop, s) for s in size],
+                                    [max(0, s // 2 - crop // 2) for s in size])
+    n_voxels = int(np.prod(img.GetSize()))
+    device = "gpu" if torch.cuda.is_available() else "cpu"
+
+    tmpdir = tempfile.mkdtemp(prefix="mousechd_profiles_")
+    masks, res = {}, {}
+    try:
+        indir = os.path.join(tmpdir, "in")
+        os.makedirs(indir)
+        sitk.WriteImage(img, os.path.join(indir, "sample_0000.nii.gz"))
+        for profile in profiles:
+            logging.info(f"Profile {profile}: {PROFILES[profile]['description']}")
+            outdir = os.path.join(tmpdir, profile)
+            start = time.time()
+            nnunet_predict(indir, outdir, profile,
+                           nthreads_preprocessing=nthreads_preprocessing,
+                           nthreads_nifti=nthreads_nifti)
+            duration = time.time() - start
+            masks[profile] = clean_mask(sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(outdir, "sample.nii.gz"))))
+            res[profile] = {"time": duration,
+                            "device": device,
+                            "n_voxels": n_voxels,
+                            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+            logging.info("{}: {:.1f}s".format(profile, duration))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    reference = profiles[-1]
+    for profile in profiles:
+        res[profile]["reference"] = reference
+        res[profile]["dice"] = float(calc_dsc(masks[profile], masks[reference]))
+
+    measurements = load_measurements()
+    measurements.update(res)
+    os.makedirs(os.path.dirname(profiles_path()), exist_ok=True)
+    with open(profiles_path(), "w") as f:
+        json.dump(measurements, f, indent=1)
+
+    return res
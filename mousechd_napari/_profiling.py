@@ -0,0 +1,218 @@
+"""
+Timing and memory profiling helpers
+"""
+import os
+import json
+import time
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def current_rss(children=False):
+    """Resident set size of this process in bytes, None if it cannot be read.
+    With `children`, the child processes are included (requires psutil).
+    """
+    try:
+        import psutil
+        proc = psutil.Process()
+        rss = proc.memory_info().rss
+        if children:
+            for child in proc.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+        return rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class PeakMemory:
+    """Peak memory used inside a `with` block, in bytes above the memory used
+    when entering it.
+
+    The resident set size is sampled in a background thread every `interval`
+    seconds. When it cannot be read (no psutil, no /proc), numpy and python
+    allocations are traced with tracemalloc instead.
+    """
+    def __init__(self, interval=0.01, children=False):
+        self.interval = interval
+        self.children = children
+        self.peak = 0
+        self.baseline = 0
+        self._use_rss = current_rss() is not None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss(self.children) - self.baseline)
+
+    def __enter__(self):
+        self.peak = 0
+        self._stop.clear()
+        if self._use_rss:
+            self.baseline = current_rss(self.children)
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        else:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._use_rss:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, current_rss(self.children) - self.baseline)
+        else:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return False
+
+
+def profile_call(func, *args, repeat=1, setup=None, **kwargs):
+    """Time and memory-profile `func(*args, **kwargs)`.
+
+    Args:
+        func (callable): function to profile
+        repeat (int, optional): number of calls. Defaults to 1.
+        setup (callable, optional): called before each call, not timed. Its
+            return value (a dict) updates kwargs, e.g. to give a fresh copy
+            of an array modified in place. Defaults to None.
+
+    Returns:
+        dict: time_mean, time_min, time_max (seconds), peak_mem_mb, repeat
+    """
+    times, peaks = [], []
+    for _ in range(repeat):
+        call_kwargs = dict(kwargs)
+        if setup is not None:
+            call_kwargs.update(setup() or {})
+        with PeakMemory() as mem:
+            start = time.perf_counter()
+            func(*args, **call_kwargs)
+            times.append(time.perf_counter() - start)
+        peaks.append(mem.peak)
+        del call_kwargs
+
+    return {"time_mean": float(np.mean(times)),
+            "time_min": float(np.min(times)),
+            "time_max": float(np.max(times)),
+            "peak_mem_mb": float(np.max(peaks)) / 2**20,
+            "repeat": repeat}
+
+
+class Tracer:
+    """Collect nested spans of a run and export them as a Chrome trace
+    (open in chrome://tracing or https://ui.perfetto.dev).
+
+    Spans of a thread nest by their start and end times, so sub-stages only
+    need to be traced inside their parent stage.
+    """
+    def __init__(self, name="mousechd-napari"):
+        self.name = name
+        self.events = []
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, end, cat="stage", **args):
+        """Record a span from `start` to `end` (time.time() values)
+        """
+        event = {"name": name,
+                 "cat": cat,
+                 "ph": "X",
+                 "ts": (start - self.start) * 1e6,
+                 "dur": (end - start) * 1e6,
+                 "pid": os.getpid(),
+                 "tid": threading.get_ident(),
+                 "args": args}
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, cat="stage", **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.time(), cat=cat, **args)
+
+    def summary(self):
+        """Total seconds per span name
+        """
+        totals = {}
+        for event in self.events:
+            totals[event["name"]] = totals.get(event["name"], 0) + event["dur"] / 1e6
+        return totals
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        threads = {e["tid"] for e in self.events}
+        meta = [{"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": self.name}}]
+        meta += [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                  "args": {"name": "main" if tid == threading.main_thread().ident else f"worker-{tid}"}}
+                 for tid in threads]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": meta + sorted(self.events, key=lambda e: e["ts"]),
+                       "displayTimeUnit": "ms",
+                       "otherData": {"name": self.name,
+                                     "start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start))}},
+                      f)
+
+
+_TRACER = None
+
+
+def start_trace(name="mousechd-napari"):
+    """Start collecting spans of `trace` calls, from any thread
+    """
+    global _TRACER
+    _TRACER = Tracer(name)
+    return _TRACER
+
+
+def stop_trace(path=None):
+    """Stop collecting spans, save them in `path` if given
+    """
+    global _TRACER
+    tracer, _TRACER = _TRACER, None
+    if (tracer is not None) and (path is not None):
+        tracer.save(path)
+    return tracer
+
+
+def current_tracer():
+    return _TRACER
+
+
+@contextmanager
+def trace(name, cat="stage", **args):
+    """Span of the current trace, no-op when no trace is started
+    """
+    tracer = _TRACER
+    if tracer is None:
+        yield
+        return
+    with tracer.span(name, cat=cat, **args):
+        yield
+
+
+def traced(name=None, cat="stage"):
+    """Decorator tracing every call of a function
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace(name or func.__name__, cat=cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,220 @@
+"""
+Int8 copy of the segmentation model for CPU: static post-training quantization calibrated on the sample scan
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+QUANT_NAME = "model_int8.pt"
+VALIDATION_FILE = "validation.json"
+# Number of tiles of the sample scan used to calibrate activation ranges
+N_CALIBRATION_TILES = 16
+CROP_SIZE = 160
+
+
+def quant_dir():
+    """Next to the segmentation model folder
+    """
+    from mousechd.segmentation.utils import SEG_DIR
+    return os.path.normpath(SEG_DIR) + "_int8"
+
+
+def model_folds(folds=None):
+    """Fold numbers of the segmentation model (all if None)
+    """
+    from mousechd.segmentation.utils import SEG_DIR
+    if folds is not None:
+        return list(folds)
+    return sorted(int(x.split("_")[1]) for x in os.listdir(SEG_DIR) if x.startswith("fold_"))
+
+
+def quantized_path(fold):
+    return os.path.join(quant_dir(), f"fold_{fold}", QUANT_NAME)
+
+
+def quantized_available(folds=None):
+    try:
+        return all(os.path.isfile(quantized_path(f)) for f in model_folds(folds))
+    except FileNotFoundError:
+        return False
+
+
+def load_validation():
+    try:
+        with open(os.path.join(quant_dir(), VALIDATION_FILE), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class QuantizedNetwork:
+    """Int8 TorchScript network of one fold, with the interface used by the
+    tiled predictor
+    """
+    def __init__(self, module, num_classes):
+        self.module = module
+        self.num_classes = num_classes
+
+    def __call__(self, x):
+        return self.module(x)
+
+    @staticmethod
+    def inference_apply_nonlin(x):
+        import torch
+        return torch.softmax(x, 1)
+
+    def eval(self):
+        self.module.eval()
+        return self
+
+    def to(self, *args, **kwargs):
+        return self
+
+
+def set_quantized_engine():
+    import torch
+    engines = torch.backends.quantized.supported_engines
+    for engine in ["x86", "fbgemm", "qnnpack"]:
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError("No quantized engine in this torch build")
+
+
+def load_quantized(folds, num_classes):
+    """Int8 networks of the folds, in the order of `folds`
+    """
+    import torch
+    set_quantized_engine()
+    return [QuantizedNetwork(torch.jit.load(quantized_path(f), map_location="cpu"), num_classes) for f in folds]
+
+
+def calibration_tiles(trainer, sample_path, n_tiles=N_CALIBRATION_TILES, crop=None):
+    """Tiles of the preprocessed sample scan, spread over the sliding window
+    """
+    import SimpleITK as sitk
+    from batchgenerators.augmentations.utils import pad_nd_image
+    from ._tiled import tile_positions
+
+    tmpdir = tempfile.mkdtemp(prefix="mousechd_quantize_")
+    try:
+        input_path = os.path.join(tmpdir, "sample_0000.nii.gz")
+        img = sitk.ReadImage(sample_path)
+        if crop is not None:
+            size = img.GetSize()
+            img = sitk.RegionOfInterest(img,
+                                        [min(crop, s) for s in size],
+                                        [max(0, s // 2 - crop // 2) for s in size])
+        sitk.WriteImage(img, input_path)
+        d, _, _ = trainer.preprocess_patient([input_path])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    data, _ = pad_nd_image(d, trainer.patch_size, "constant", {"constant_values": 0}, True, None)
+    corners, _ = tile_positions(trainer.patch_size, data.shape[1:], 0.5)
+    picked = np.linspace(0, len(corners) - 1, min(n_tiles, len(corners))).astype(int)
+
+    return [np.ascontiguousarray(data[(slice(None),) + tuple(slice(c, c + s) for c, s in zip(corners[i], trainer.patch_size))][None])
+            for i in picked]
+
+
+def quantize_network(network, tiles):
+    """Static int8 quantization (FX graph mode) of a float network, with
+    activation ranges observed on `tiles`. Returns a TorchScript module.
+    """
+    import copy
+    import torch
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    engine = set_quantized_engine()
+    model = copy.deepcopy(network).cpu().eval()
+    example = torch.from_numpy(tiles[0])
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs=(example,))
+    with torch.inference_mode():
+        for tile in tiles:
+            prepared(torch.from_numpy(tile))
+    quantized = convert_fx(prepared)
+    with torch.inference_mode():
+        return torch.jit.freeze(torch.jit.trace(quantized, example).eval())
+
+
+def quantize_segmenter(sample_path, folds=None, crop=CROP_SIZE):
+    """Write the int8 copy of each fold of the segmentation model next to
+    SEG_DIR
+    """
+    import torch
+    from ._tiled import load_segmenter
+
+    folds = model_folds(folds)
+    trainer, params = load_segmenter("accurate")
+    trainer.network.cpu()
+    tiles = calibration_tiles(trainer, sample_path, crop=crop)
+    all_folds = model_folds()
+    for fold in folds:
+        logging.info(f"Quantize fold {fold}")
+        trainer.load_checkpoint_ram(params[all_folds.index(fold)], False)
+        trainer.network.eval()
+        scripted = quantize_network(trainer.network, tiles)
+        os.makedirs(os.path.dirname(quantized_path(fold)), exist_ok=True)
+        torch.jit.save(scripted, quantized_path(fold))
+
+    return [quantized_path(f) for f in folds]
+
+
+def validate_quantized(sample_path, profile="standard", crop=CROP_SIZE):
+    """Segment the sample scan with the float and the int8 model and save the
+    speedup and the Dice of the int8 mask against the float mask
+
+    Returns:
+        dict: float_time, int8_time, speedup, dice, profile, n_voxels, date
+    """
+    import SimpleITK as sitk
+    from mousechd.segmentation.utils import calc_dsc
+    from ._tiled import segment_progressive
+
+    img = sitk.ReadImage(sample_path)
+    if crop is not None:
+        size = img.GetSize()
+        img = sitk.RegionOfInterest(img,
+                                    [min(crop, s) for s in size],
+                                    [max(0, s // 2 - crop // 2) for s in size])
+    tmpdir = tempfile.mkdtemp(prefix="mousechd_quantize_")
+    times, masks = {}, {}
+    try:
+        input_path = os.path.join(tmpdir, "sample_0000.nii.gz")
+        sitk.WriteImage(img, input_path)
+        for name, quantized in [("float", False), ("int8", True)]:
+            output_path = os.path.join(tmpdir, name, "sample.nii.gz")
+            start = time.time()
+            for _ in segment_progressive(input_path, output_path, profile, quantized=quantized):
+                pass
+            times[name] = time.time() - start
+            masks[name] = sitk.GetArrayFromImage(sitk.ReadImage(output_path))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    res = {"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+           "profile": profile,
+           "n_voxels": int(np.prod(img.GetSize())),
+           "float_time": times["float"],
+           "int8_time": times["int8"],
+           "speedup": times["float"] / times["int8"],
+           "dice": float(calc_dsc(masks["int8"], masks["float"]))}
+    with open(os.path.join(quant_dir(), VALIDATION_FILE), "w") as f:
+        json.dump(res, f, indent=1)
+    logging.info("Int8: x{:.2f} faster, Dice {:.4f} against float".format(res["speedup"], res["dice"]))
+
+    return res
+
+
+def describe_validation(res):
+    if res is None:
+        return "Int8 model not validated"
+    return "Int8 model on the sample scan: x{:.2f} faster, Dice {:.3f} against full precision ({})".format(
+        res["speedup"], res["dice"], res["date"])
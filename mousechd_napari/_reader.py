@@ -6,6 +6,8 @@ import SimpleITK as sitk
 
 from mousechd.datasets.utils import dicom2nii, nrrd2nii, anyview2LPS, make_isotropic
 
+from ._profiling import trace
+
 tmp_dir = os.path.join(tempfile.gettempdir(), "MouseCHD")
 os.makedirs(tmp_dir, exist_ok=True)
 
@@ -40,24 +42,28 @@ def reader_function(path):
         default to layer_type=="image" if not provided
     """
     
-    if os.path.isdir(path):
-        first_file = next(os.path.join(path, f) for f in os.listdir(path) if not f.startswith(".") and f.endswith(".dcm"))
-        dicom_data = pydicom.read_file(first_file)
-        mouse = str(dicom_data.get("PatientName")).replace(" ", "")
-        img = dicom2nii(path)
-    else:
-        if path.endswith(".nii.gz"):
-            mouse = re.sub(r".nii.gz$", "", os.path.basename(path))
-            img = sitk.ReadImage(path)
+    with trace("read"):
+        if os.path.isdir(path):
+            first_file = next(os.path.join(path, f) for f in os.listdir(path) if not f.startswith(".") and f.endswith(".dcm"))
+            dicom_data = pydicom.read_file(first_file)
+            mouse = str(dicom_data.get("PatientName")).replace(" ", "")
+            img = dicom2nii(path)
         else:
-            mouse = re.sub(r".nrrd$", "", os.path.basename(path))
-            img = nrrd2nii(path)
+            if path.endswith(".nii.gz"):
+                mouse = re.sub(r".nii.gz$", "", os.path.basename(path))
+                img = sitk.ReadImage(path)
+            else:
+                mouse = re.sub(r".nrrd$", "", os.path.basename(path))
+                img = nrrd2nii(path)
     
     mouse = re.sub(r"_0000", "", mouse)
-    img = anyview2LPS(img)
-    img = make_isotropic(img, spacing=0.02)
+    with trace("reorient"):
+        img = anyview2LPS(img)
+    with trace("make_isotropic"):
+        img = make_isotropic(img, spacing=0.02)
     im = sitk.GetArrayFromImage(img)
-    sitk.WriteImage(img, os.path.join(tmp_dir, f"{mouse}.nii.gz"))
+    with trace("write_tmp"):
+        sitk.WriteImage(img, os.path.join(tmp_dir, f"{mouse}.nii.gz"))
     
     add_kwargs = {"name": mouse, 
                   "scale": img.GetSpacing()[::-1]}
@@ -0,0 +1,176 @@
+"""
+Torch runtime settings for local CPU segmentation: inference mode, thread counts, channels-last layout, bfloat16 autocast
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+from contextlib import ExitStack
+from datetime import datetime
+
+RUNTIME_FILE = "cpu_runtime.json"
+# Masks of a variant must be this close to the default runtime to be recommended
+MIN_DICE = 0.99
+
+
+def runtime_path():
+    from mousechd.utils.tools import CACHE_DIR
+    return os.path.join(CACHE_DIR, "Napari", RUNTIME_FILE)
+
+
+def cpu_supports_bf16():
+    """bfloat16 matrix instructions (AVX512-BF16 or AMX) and oneDNN
+    """
+    import torch
+    if not torch.backends.mkldnn.is_available():
+        return False
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return ("avx512_bf16" in flags) or ("amx_bf16" in flags)
+
+
+def cpu_runtime_settings(channels_last=None, bf16=None, nthreads=None, interop_threads=1):
+    """Settings of the CPU runtime. Unset values come from the last benchmark
+    (`benchmark_cpu_runtime`), or channels-last and bfloat16 if the CPU has
+    bfloat16 instructions.
+    """
+    recommended = {}
+    try:
+        with open(runtime_path(), "r") as f:
+            recommended = json.load(f).get("recommended") or {}
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    if channels_last is None:
+        channels_last = recommended.get("channels_last", True)
+    if bf16 is None:
+        bf16 = recommended.get("bf16", cpu_supports_bf16())
+
+    return {"channels_last": channels_last,
+            "bf16": bf16 and cpu_supports_bf16(),
+            "nthreads": nthreads,
+            "interop_threads": interop_threads}
+
+
+def configure_cpu(network, runtime, nthreads=None):
+    """Set the torch thread counts and the memory layout of the network
+    """
+    import torch
+    from ._threads import get_thread_budget
+
+    torch.set_num_threads(nthreads or runtime["nthreads"] or get_thread_budget())
+    try:
+        # Only possible before the first inter-op parallel work of the process
+        torch.set_num_interop_threads(runtime["interop_threads"])
+    except RuntimeError:
+        pass
+    if runtime["channels_last"]:
+        network.to(memory_format=torch.channels_last_3d)
+
+    return network
+
+
+def inference_context(device, runtime=None):
+    """No gradients (inference mode with a runtime), autocast: float16 on GPU,
+    bfloat16 on CPU if the runtime asks for it
+    """
+    import torch
+
+    stack = ExitStack()
+    stack.enter_context(torch.inference_mode() if runtime is not None else torch.no_grad())
+    if device.type == "cuda":
+        stack.enter_context(torch.autocast("cuda"))
+    elif (runtime is not None) and runtime["bf16"]:
+        stack.enter_context(torch.autocast("cpu", dtype=torch.bfloat16))
+
+    return stack
+
+
+def benchmark_cpu_runtime(sample_path, profile="standard", crop=None, nthreads=None, min_dice=MIN_DICE, save=True):
+    """Segment the sample scan with the default runtime (nnU-Net loop, torch
+    defaults) and with the CPU runtime variants, and compare time and Dice
+    with the default mask. The fastest variant with a Dice of at least
+    `min_dice` is recommended.
+
+    Returns:
+        dict: variants (time, speedup, dice or error) and recommended settings
+    """
+    import numpy as np
+    import SimpleITK as sitk
+    from mousechd.segmentation.utils import calc_dsc
+    from ._utils import nnunet_predict
+    from ._tiled import segment_progressive
+
+    variants = {"inference": cpu_runtime_settings(channels_last=False, bf16=False, nthreads=nthreads),
+                "channels_last": cpu_runtime_settings(channels_last=True, bf16=False, nthreads=nthreads)}
+    if cpu_supports_bf16():
+        variants["channels_last_bf16"] = cpu_runtime_settings(channels_last=True, bf16=True, nthreads=nthreads)
+
+    img = sitk.ReadImage(sample_path)
+    if crop is not None:
+        size = img.GetSize()
+        img = sitk.RegionOfInterest(img,
+                                    [min(crop, s) for s in size],
+                                    [max(0, s // 2 - crop // 2) for s in size])
+
+    tmpdir = tempfile.mkdtemp(prefix="mousechd_runtime_")
+    res = {"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+           "profile": profile,
+           "n_voxels": int(np.prod(img.GetSize())),
+           "bf16_supported": cpu_supports_bf16(),
+           "variants": {}}
+    try:
+        indir = os.path.join(tmpdir, "in")
+        os.makedirs(indir)
+        input_path = os.path.join(indir, "sample_0000.nii.gz")
+        sitk.WriteImage(img, input_path)
+
+        logging.info("Default runtime")
+        start = time.time()
+        nnunet_predict(indir, os.path.join(tmpdir, "default"), profile,
+                       nthreads_preprocessing=1, nthreads_nifti=1)
+        default_time = time.time() - start
+        reference = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(tmpdir, "default", "sample.nii.gz")))
+        res["variants"]["default"] = {"time": default_time, "speedup": 1., "dice": 1., "settings": None}
+
+        for name, runtime in variants.items():
+            logging.info(f"CPU runtime: {name} {runtime}")
+            output_path = os.path.join(tmpdir, name, "sample.nii.gz")
+            try:
+                start = time.time()
+                for _ in segment_progressive(input_path, output_path, profile, runtime=runtime):
+                    pass
+                duration = time.time() - start
+            except RuntimeError as error:
+                # Layout or dtype not supported by an operator of this torch build
+                logging.info(f"{name} failed: {error}")
+                res["variants"][name] = {"error": str(error), "settings": runtime}
+                continue
+            ma = sitk.GetArrayFromImage(sitk.ReadImage(output_path))
+            res["variants"][name] = {"time": duration,
+                                     "speedup": default_time / duration,
+                                     "dice": float(calc_dsc(ma, reference)),
+                                     "settings": runtime}
+            logging.info("{}: {:.1f}s (x{:.2f}), Dice {:.4f}".format(
+                name, duration, res["variants"][name]["speedup"], res["variants"][name]["dice"]))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    valid = {k: v for k, v in res["variants"].items()
+             if (k != "default") and ("error" not in v) and (v["dice"] >= min_dice)}
+    best = min(valid, key=lambda k: valid[k]["time"]) if valid else None
+    res["recommended"] = None
+    if (best is not None) and (valid[best]["time"] < default_time):
+        res["recommended"] = {"variant": best,
+                              "channels_last": valid[best]["settings"]["channels_last"],
+                              "bf16": valid[best]["settings"]["bf16"]}
+    if save:
+        os.makedirs(os.path.dirname(runtime_path()), exist_ok=True)
+        with open(runtime_path(), "w") as f:
+            json.dump(res, f, indent=1)
+
+    return res
@@ -0,0 +1,180 @@
+"""
+Session archives: scan, mask, GradCAM, surface, predictions and display settings of a heart in one zip of compressed chunks, reloaded lazily
+"""
+import io
+import os
+import json
+import zipfile
+from datetime import datetime
+
+import numpy as np
+
+SESSION_EXT = ".mchd"
+MANIFEST_NAME = "session.json"
+VERSION = 1
+# Slices (first axis) per chunk: a chunk is read when napari displays one of its slices
+CHUNK_SLICES = 32
+# Layers of a heart, by name prefix
+LAYER_PREFIXES = ["", "mask-", "gradcam-", "surface-"]
+# Display settings saved with a layer, if the layer has them
+SETTINGS = ["scale", "translate", "opacity", "blending", "visible", "contrast_limits",
+            "gamma", "rendering", "shading"]
+
+
+def heart_layer_names(heart_name):
+    return [f"{prefix}{heart_name}" for prefix in LAYER_PREFIXES]
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (np.generic,)):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(x) for x in value]
+    # napari string enums (blending, rendering, shading)
+    return getattr(value, "value", value)
+
+
+def layer_settings(layer):
+    """Display settings of a napari layer, colormap included
+    """
+    settings = {}
+    for attr in SETTINGS:
+        if hasattr(layer, attr):
+            settings[attr] = _jsonable(getattr(layer, attr))
+    for attr in ["interpolation2d", "interpolation3d"]:
+        if hasattr(layer, attr):
+            settings[attr] = _jsonable(getattr(layer, attr))
+    colormap = getattr(layer, "colormap", None)
+    if colormap is not None:
+        settings["colormap"] = {"name": colormap.name,
+                                "colors": _jsonable(colormap.colors),
+                                "controls": _jsonable(colormap.controls),
+                                "interpolation": _jsonable(colormap.interpolation)}
+
+    return settings
+
+
+def snapshot(layer):
+    """What `save_session` needs of a layer. To call from the GUI thread.
+    """
+    import napari
+
+    kind = "surface" if isinstance(layer, napari.layers.Surface) else "image"
+    return {"name": layer.name, "kind": kind, "data": layer.data, "settings": layer_settings(layer)}
+
+
+def _write_array(zf, member, arr, chunk_slices=CHUNK_SLICES):
+    """Array in chunks of `chunk_slices` slices, one .npy member each. Dask
+    arrays are computed one chunk at a time.
+    """
+    n = arr.shape[0] if arr.ndim > 0 else 1
+    chunks = []
+    for i in range(0, max(n, 1), chunk_slices):
+        name = f"{member}/{i:06d}.npy"
+        buf = io.BytesIO()
+        np.save(buf, np.asarray(arr[i:i + chunk_slices] if arr.ndim > 0 else arr))
+        zf.writestr(name, buf.getvalue())
+        chunks.append(name)
+
+    return {"shape": list(arr.shape), "dtype": np.dtype(arr.dtype).str,
+            "chunk_slices": chunk_slices, "chunks": chunks}
+
+
+def save_session(path, heart_name, layers, predictions=None, chunk_slices=CHUNK_SLICES):
+    """Write the layers of a heart (`snapshot`s) and its predictions. The
+    archive is written next to `path` and moved in place when complete.
+
+    Returns:
+        dict: manifest
+    """
+    manifest = {"version": VERSION,
+                "heart_name": heart_name,
+                "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "predictions": None if predictions is None else [float(x) for x in predictions],
+                "layers": []}
+    tmp_path = f"{path}.part"
+    try:
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            for i, layer in enumerate(layers):
+                entry = {"name": layer["name"], "kind": layer["kind"], "settings": layer["settings"]}
+                if layer["kind"] == "surface":
+                    # Small: vertices, faces (and values) are written whole
+                    entry["arrays"] = [_write_array(zf, f"layer{i}/data{j}", np.asarray(x), chunk_slices=max(len(x), 1))
+                                       for j, x in enumerate(layer["data"])]
+                else:
+                    entry["array"] = _write_array(zf, f"layer{i}/data", layer["data"], chunk_slices=chunk_slices)
+                manifest["layers"].append(entry)
+            zf.writestr(MANIFEST_NAME, json.dumps(manifest, indent=1))
+        os.replace(tmp_path, path)
+    finally:
+        # Incomplete archive of a failed write
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+    return manifest
+
+
+def read_manifest(path):
+    with zipfile.ZipFile(path, "r") as zf:
+        return json.loads(zf.read(MANIFEST_NAME))
+
+
+def _read_chunk(path, member):
+    with zipfile.ZipFile(path, "r") as zf:
+        return np.load(io.BytesIO(zf.read(member)))
+
+
+def _lazy_array(path, entry):
+    """Dask array of the chunks of `_write_array`, read on access
+    """
+    import dask
+    import dask.array as da
+
+    shape, dtype = tuple(entry["shape"]), np.dtype(entry["dtype"])
+    if len(shape) == 0:
+        return _read_chunk(path, entry["chunks"][0])
+    parts = []
+    for i, member in zip(range(0, shape[0], entry["chunk_slices"]), entry["chunks"]):
+        part_shape = (min(entry["chunk_slices"], shape[0] - i),) + shape[1:]
+        parts.append(da.from_delayed(dask.delayed(_read_chunk)(path, member), shape=part_shape, dtype=dtype))
+
+    return da.concatenate(parts, axis=0)
+
+
+def load_session(path):
+    """Manifest of a session with the layer data: lazy dask arrays for images,
+    numpy arrays for surfaces. Nothing is recomputed.
+
+    Returns:
+        dict: manifest, "data" added to each layer
+    """
+    manifest = read_manifest(path)
+    if manifest.get("version", 0) > VERSION:
+        raise ValueError(f"Session {path} was written by a newer version (format {manifest['version']})")
+    for layer in manifest["layers"]:
+        if layer["kind"] == "surface":
+            layer["data"] = tuple(_read_chunk(path, x["chunks"][0]) for x in layer["arrays"])
+        else:
+            layer["data"] = _lazy_array(path, layer["array"])
+
+    return manifest
+
+
+def layer_kwargs(settings):
+    """Keyword arguments of `viewer.add_image`/`add_surface` from saved
+    settings. Interpolation is set on the layer afterwards.
+    """
+    kwargs = {k: v for k, v in settings.items() if not k.startswith("interpolation")}
+    if "colormap" in kwargs:
+        cmap = kwargs["colormap"]
+        kwargs["colormap"] = {"name": cmap["name"],
+                              "colors": np.asarray(cmap["colors"], dtype=np.float32),
+                              "controls": np.asarray(cmap["controls"], dtype=np.float32),
+                              "interpolation": cmap["interpolation"]}
+    for k in ["scale", "translate", "contrast_limits"]:
+        if k in kwargs:
+            kwargs[k] = tuple(kwargs[k])
+
+    return kwargs
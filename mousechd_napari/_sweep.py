@@ -0,0 +1,199 @@
+"""
+Hyperparameter sweep on top of `retrain`
+"""
+import os
+import json
+import time
+import logging
+import itertools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from mousechd.classifier.utils import CLF_DIR
+
+
+def expand_grid(grid):
+    """{"lr": [1e-3, 1e-4], "class_weights": [true, false]} -> list of 4 configs
+    """
+    keys = sorted(grid.keys())
+    values = [v if isinstance(v, (list, tuple)) else [v] for v in (grid[k] for k in keys)]
+
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def share_local_resources(thread_budget):
+    """Configure a local trial process to share the machine with the other
+    trials: its part of the thread budget, and GPU memory allocated as needed
+    instead of the whole GPU at start.
+    """
+    from ._threads import set_thread_budget
+
+    set_thread_budget(thread_budget)
+    import tensorflow as tf
+    for gpu in tf.config.list_physical_devices("GPU"):
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+
+def _run_trial(kwargs):
+    # Top-level function: executed in a spawned process for local trials
+    from ._utils import retrain
+
+    kwargs = dict(kwargs)
+    thread_budget = kwargs.pop("thread_budget", None)
+    start = time.time()
+    try:
+        if thread_budget is not None:
+            share_local_resources(thread_budget)
+        status = retrain(**kwargs)
+    except Exception as error:
+        logging.exception(f"Trial {kwargs['exp']} failed")
+        status = f"Error: {error}"
+
+    return status, time.time() - start
+
+
+def trial_monitor(save_dir):
+    """Monitored metric of an experiment, from its own configs (the grid may
+    override it)
+    """
+    for path in [os.path.join(save_dir, "configs.json"), os.path.join(CLF_DIR, "configs.json")]:
+        try:
+            with open(path, "r") as f:
+                return json.load(f).get("monitor", "val_loss")
+        except FileNotFoundError:
+            continue
+
+    return "val_loss"
+
+
+def summarize_trial(save_dir, monitor=None):
+    """Best validation metrics of an experiment, from its CSVLogger file.
+    Without the monitored column (e.g. `val_weighted_accuracy` without class
+    weights) only the number of epochs is reported.
+    """
+    if monitor is None:
+        monitor = trial_monitor(save_dir)
+    try:
+        history = pd.read_csv(os.path.join(save_dir, "train.csv"))
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return {"monitor": monitor}
+    res = {"monitor": monitor, "epochs_run": len(history)}
+    if (len(history) == 0) or (monitor not in history.columns) or history[monitor].isna().all():
+        return res
+
+    if monitor == "val_loss":
+        best = history.loc[history[monitor].idxmin()]
+    else:
+        best = history.loc[history[monitor].idxmax()]
+    res["best_epoch"] = int(best["epoch"]) + 1
+    res.update({c: best[c] for c in history.columns if c.startswith("val_")})
+
+    return res
+
+
+def sweep(resrc,
+          retrain_dir,
+          outdir,
+          exp,
+          grid,
+          max_parallel=2,
+          progress_log=None,
+          **retrain_kwargs):
+    """Run one retraining per combination of `grid` on the already prepared
+    `retrain/resampled` and `retrain/label` data.
+
+    Trials run concurrently: in separate processes on local resources, as
+    parallel server jobs otherwise. Each trial is saved in
+    `outdir/exp/trial-XX` and the comparison table in `outdir/exp/sweep.csv`.
+    Each trial logs in `trial-XX/retrain.log`; a line per finished trial is
+    added to `progress_log` (default `retrain_dir/retrain.log`).
+
+    Args:
+        resrc (str): "local" or "server"
+        retrain_dir (str): prepared retrain directory
+        outdir (str): output directory
+        exp (str): experiment name
+        grid (dict): configs key -> list of values
+        max_parallel (int, optional): concurrent trials. Defaults to 2.
+        progress_log (str, optional): file of the progress lines.
+        retrain_kwargs: other arguments passed to `retrain`
+
+    Returns:
+        pd.DataFrame: comparison table
+    """
+    trials = expand_grid(grid)
+    sweep_dir = os.path.join(outdir, exp)
+    os.makedirs(sweep_dir, exist_ok=True)
+    with open(os.path.join(sweep_dir, "grid.json"), "w") as f:
+        json.dump(grid, f, indent=1)
+    logging.info(f"Sweep {exp}: {len(trials)} trials, {max_parallel} in parallel")
+
+    # Trials are independent full retrainings
+    retrain_kwargs["mode"] = "full"
+    cache = retrain_kwargs.pop("cache", False) and ("input_size" not in grid)
+    if resrc == "local" and cache:
+        # Pack once before trials start, they all find it up to date
+        from ._train import pack_training_cache
+        with open(os.path.join(CLF_DIR, "configs.json"), "r") as f:
+            configs = json.load(f)
+        pack_training_cache(data_dir=os.path.join(retrain_dir, "resampled"),
+                            filenames=pd.concat([pd.read_csv(os.path.join(retrain_dir, "label", f"{x}.csv"))
+                                                 for x in ["train", "val"]])["heart_name"].tolist(),
+                            target_size=configs["input_size"],
+                            cache_dir=os.path.join(retrain_dir, "cache"),
+                            nthreads=retrain_kwargs.get("nworkers", 4))
+
+    names = ["trial-{:02d}".format(i + 1) for i in range(len(trials))]
+    jobs = [dict(retrain_kwargs,
+                 resrc=resrc,
+                 retrain_dir=retrain_dir,
+                 outdir=sweep_dir,
+                 exp=name,
+                 overrides=trial,
+                 cache=cache,
+                 register=False,
+                 # Concurrent trials would interleave in one log
+                 logfile=os.path.join(sweep_dir, name, "retrain.log"))
+            for name, trial in zip(names, trials)]
+
+    if resrc == "local":
+        # Trials share the cores of the thread budget
+        from ._threads import get_thread_budget
+        for job in jobs:
+            job["thread_budget"] = max(1, get_thread_budget() // max_parallel)
+        # TensorFlow is not fork-safe
+        executor = ProcessPoolExecutor(max_workers=max_parallel,
+                                       mp_context=multiprocessing.get_context("spawn"))
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_parallel)
+    if progress_log is None:
+        progress_log = os.path.join(retrain_dir, "retrain.log")
+    results = [None] * len(jobs)
+    with executor:
+        futures = {executor.submit(_run_trial, job): i for i, job in enumerate(jobs)}
+        for n_done, future in enumerate(as_completed(futures)):
+            i = futures[future]
+            results[i] = future.result()
+            # Numbered lines are shown in the run log of the widget
+            with open(progress_log, "a") as f:
+                f.write("{}. {} ({}/{}): {}, {}\n".format(
+                    i + 1, names[i], n_done + 1, len(jobs), results[i][0],
+                    time.strftime("%Hh%Mm%Ss", time.gmtime(results[i][1]))))
+
+    rows = []
+    for job, trial, (status, duration) in zip(jobs, trials, results):
+        row = {"trial": job["exp"], **trial, "status": status, "train_time": duration}
+        row.update(summarize_trial(os.path.join(sweep_dir, job["exp"])))
+        rows.append(row)
+
+    df = pd.DataFrame(rows)
+    # Trials are ranked only if they monitor the same metric
+    monitors = df["monitor"].unique()
+    if (len(monitors) == 1) and (monitors[0] in df.columns):
+        df = df.sort_values(monitors[0], ascending=(monitors[0] == "val_loss"), na_position="last")
+    df.to_csv(os.path.join(sweep_dir, "sweep.csv"), index=False)
+    logging.info(f"Sweep results saved in {os.path.join(sweep_dir, 'sweep.csv')}")
+
+    return df
@@ -0,0 +1,62 @@
+import pandas as pd
+
+from mousechd_napari._admission import admit, calibration, estimate_job_memory, segment_memory
+from mousechd_napari._memory import MEMORY_FILE
+
+SHAPE = (400, 400, 400)
+
+
+def _history(workdir, rows):
+    pd.DataFrame(rows).to_csv(workdir / MEMORY_FILE, index=False)
+
+
+def test_calibration_uses_recorded_settings(tmp_path):
+    n_voxels = 400**3
+    # One scan: one preprocessing and one NIfTI process ran
+    modelled = segment_memory(n_voxels, 4, 1, 1, 0.5)
+    _history(tmp_path, [{"stage": "segment", "resrc": "local", "n_voxels": n_voxels, "itemsize": 4,
+                         "nthreads_preprocessing": 3, "nthreads_nifti": 1, "step_size": 0.5,
+                         "delta_mb": 2 * modelled}])
+    # Current defaults differ from the recorded run
+    assert abs(calibration(str(tmp_path), "local", itemsize=2, nthreads_nifti=4) - 2) < 1e-6
+
+
+def test_calibration_old_history(tmp_path):
+    n_voxels = 400**3
+    modelled = segment_memory(n_voxels, 2, 1, 1, 0.5)
+    _history(tmp_path, [{"stage": "segment", "resrc": "local", "n_voxels": n_voxels,
+                         "nthreads_preprocessing": 3, "step_size": 0.5, "delta_mb": modelled}])
+    assert abs(calibration(str(tmp_path), "local") - 1) < 1e-6
+
+
+def test_admit_levels(tmp_path):
+    kwargs = dict(workdir=str(tmp_path), task="segment", resrc="local", shape=SHAPE, dtype="int16",
+                  nthreads_preprocessing=4, nthreads_nifti=2, step_size=0.5, nworkers=4)
+    estimate = estimate_job_memory(**kwargs)
+
+    decision = admit(available_mb=10 * estimate, **kwargs)
+    assert (decision["action"] == "run") and (decision["message"] == "")
+    decision = admit(available_mb=estimate / 0.85, **kwargs)
+    assert (decision["action"] == "run") and (decision["message"] != "")
+    decision = admit(available_mb=estimate / 1.2, **kwargs)
+    assert decision["action"] == "reduce"
+    # Thread counts have no effect with one scan: only processes are reduced
+    assert (decision["nthreads_preprocessing"], decision["nthreads_nifti"]) == (4, 2)
+    assert decision["nworkers"] < 4
+
+
+def test_estimate_one_scan_processes(tmp_path):
+    # nnU-Net runs one preprocessing and one NIfTI process for one scan
+    kwargs = dict(workdir=str(tmp_path), task="segment", resrc="local", shape=SHAPE, dtype="int16", step_size=0.5)
+    assert (estimate_job_memory(nthreads_preprocessing=8, nthreads_nifti=4, **kwargs)
+            == estimate_job_memory(nthreads_preprocessing=1, nthreads_nifti=1, **kwargs))
+
+
+def test_calibration_worker_processes(tmp_path):
+    # A multi-process peak is not counted as extra memory per voxel
+    n_voxels = 400**3
+    modelled = segment_memory(n_voxels, 2, 1, 1, 0.5, nworkers=4)
+    _history(tmp_path, [{"stage": "segment", "resrc": "local", "n_voxels": n_voxels, "itemsize": 2,
+                         "nthreads_preprocessing": 3, "nthreads_nifti": 2, "nworkers": 4, "step_size": 0.5,
+                         "delta_mb": modelled}])
+    assert abs(calibration(str(tmp_path), "local") - 1) < 1e-6
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from mousechd_napari._masks import (RLE_EXT, NIFTI_EXT, rle_encode, rle_decode, save_rle_mask, read_mask,
+                                    compact_mask, expand_mask_folder, find_mask)
+
+SHAPE = (20, 30, 25)
+
+
+def _masks():
+    empty = np.zeros(SHAPE, dtype=np.uint8)
+    inside = empty.copy()
+    inside[5:12, 8:20, 3:9] = 1
+    inside[7, 10, 4] = 0
+    border = empty.copy()
+    border[0:4, 25:, 20:] = 1
+    border[-1, 0, 0] = 1
+    full = np.ones(SHAPE, dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    noisy = (rng.random(SHAPE) > 0.7).astype(np.uint8)
+    return {"empty": empty, "inside": inside, "border": border, "full": full, "noisy": noisy}
+
+
+def _crop(mask, pad):
+    """Expected crop: bounding box + pad, within the volume, whole if empty"""
+    idx = np.argwhere(mask)
+    if len(idx) == 0:
+        return mask, (0, 0, 0)
+    lo = np.maximum(idx.min(axis=0) - pad, 0)
+    hi = np.minimum(idx.max(axis=0) + 1 + pad, mask.shape)
+    return mask[tuple(slice(a, b) for a, b in zip(lo, hi))], tuple(int(x) for x in lo)
+
+
+@pytest.mark.parametrize("name", list(_masks().keys()))
+def test_rle_round_trip(name):
+    mask = _masks()[name]
+    decoded, offset = rle_decode(rle_encode(mask))
+    assert offset == (0, 0, 0)
+    assert decoded.dtype == np.uint8
+    np.testing.assert_array_equal(decoded, mask)
+
+
+@pytest.mark.parametrize("name", list(_masks().keys()))
+@pytest.mark.parametrize("pad", [0, 5])
+def test_rle_crop(name, pad):
+    mask = _masks()[name]
+    decoded, offset = rle_decode(rle_encode(mask), crop=True, pad=pad)
+    expected, expected_offset = _crop(mask, pad)
+    assert offset == expected_offset
+    np.testing.assert_array_equal(decoded, expected)
+
+
+@pytest.mark.parametrize("name", ["inside", "border"])
+@pytest.mark.parametrize("pad", [0, 5])
+def test_read_mask_formats(tmp_path, name, pad):
+    mask = _masks()[name]
+    nifti_path = str(tmp_path / f"heart{NIFTI_EXT}")
+    img = sitk.GetImageFromArray(mask)
+    img.SetSpacing((0.02, 0.03, 0.04))
+    img.SetOrigin((1., 2., 3.))
+    sitk.WriteImage(img, nifti_path)
+
+    from_nifti, nifti_geometry = read_mask(nifti_path, crop=True, pad=pad)
+    rle_path = compact_mask(nifti_path)
+    assert rle_path.endswith(RLE_EXT) and (find_mask(str(tmp_path), "heart") == rle_path)
+    from_rle, rle_geometry = read_mask(rle_path, crop=True, pad=pad)
+
+    np.testing.assert_array_equal(from_rle, from_nifti)
+    assert rle_geometry["offset"] == nifti_geometry["offset"]
+    np.testing.assert_allclose(rle_geometry["spacing"], nifti_geometry["spacing"])
+
+
+def test_expand_mask_folder(tmp_path):
+    mask = _masks()["border"]
+    save_rle_mask(mask, str(tmp_path / f"heart{RLE_EXT}"), spacing=(0.02, 0.03, 0.04), origin=(1., 2., 3.))
+    written = expand_mask_folder(str(tmp_path))
+    assert written == [str(tmp_path / f"heart{NIFTI_EXT}")]
+    img = sitk.ReadImage(written[0])
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(img), mask)
+    np.testing.assert_allclose(img.GetSpacing(), (0.02, 0.03, 0.04))
+    # Existing NIfTI masks are kept
+    assert expand_mask_folder(str(tmp_path)) == []
+
+
+def test_server_segment_sees_compact_masks(tmp_path, monkeypatch):
+    import mousechd_napari._utils as utils
+
+    workdir = tmp_path / ".MouseCHD"
+    (workdir / "HeartSeg").mkdir(parents=True)
+    save_rle_mask(_masks()["inside"], str(workdir / "HeartSeg" / f"heart{RLE_EXT}"))
+    seen = []
+
+    def fake_ssh(cmd):
+        seen.append(sorted(x.name for x in (workdir / "HeartSeg").iterdir()))
+        return ""
+
+    monkeypatch.setattr(utils.subprocess, "getoutput", fake_ssh)
+    utils.segment_hearts(resrc="server", nthreads_preprocessing=1, nthreads_nifti=1, step_size=0.5,
+                         workdir=str(workdir), servername="server", shared_folder=str(tmp_path), profile="standard")
+    # The server call finds a NIfTI mask, which is removed afterwards
+    assert f"heart{NIFTI_EXT}" in seen[-1]
+    assert sorted(x.name for x in (workdir / "HeartSeg").iterdir()) == [f"heart{RLE_EXT}"]
@@ -0,0 +1,72 @@
+import json
+import zipfile
+
+import numpy as np
+import pytest
+
+from mousechd_napari._session import CHUNK_SLICES, MANIFEST_NAME, layer_kwargs, load_session, save_session
+
+pytest.importorskip("dask")
+
+SETTINGS = {"scale": [0.02, 0.02, 0.02], "opacity": 0.5, "blending": "additive", "visible": True,
+            "contrast_limits": [0., 1.], "interpolation2d": "nearest",
+            "colormap": {"name": "heat", "colors": [[0., 0., 0., 1.], [1., 0., 0., 1.]],
+                         "controls": [0., 1.], "interpolation": "linear"}}
+
+
+def _surface():
+    rng = np.random.default_rng(0)
+    return (rng.random((10, 3)).astype(np.float32), rng.integers(0, 10, (6, 3)), rng.random(10))
+
+
+@pytest.mark.parametrize("n_slices", [1, CHUNK_SLICES - 1, CHUNK_SLICES, CHUNK_SLICES + 1, 2 * CHUNK_SLICES + 5])
+def test_session_round_trip(tmp_path, n_slices):
+    path = str(tmp_path / "heart.mchd")
+    image = np.arange(n_slices * 6 * 5, dtype=np.int16).reshape(n_slices, 6, 5)
+    surface = _surface()
+    save_session(path, "heart",
+                 [{"name": "heart", "kind": "image", "data": image, "settings": SETTINGS},
+                  {"name": "surface-heart", "kind": "surface", "data": surface, "settings": {"opacity": 0.3}}],
+                 predictions=[0.2, 0.8])
+    session = load_session(path)
+
+    assert session["heart_name"] == "heart"
+    assert session["predictions"] == [0.2, 0.8]
+    layers = {x["name"]: x for x in session["layers"]}
+    assert len(layers["heart"]["array"]["chunks"]) == -(-n_slices // CHUNK_SLICES)
+    loaded = layers["heart"]["data"]
+    assert (loaded.shape, loaded.dtype) == (image.shape, image.dtype)
+    np.testing.assert_array_equal(np.asarray(loaded), image)
+    # Slices across a chunk boundary
+    np.testing.assert_array_equal(np.asarray(loaded[n_slices // 2:]), image[n_slices // 2:])
+    assert layers["heart"]["settings"] == SETTINGS
+    for loaded_x, x in zip(layers["surface-heart"]["data"], surface):
+        np.testing.assert_array_equal(loaded_x, x)
+    assert layers["surface-heart"]["settings"] == {"opacity": 0.3}
+
+
+def test_layer_kwargs():
+    kwargs = layer_kwargs(SETTINGS)
+    assert "interpolation2d" not in kwargs
+    assert kwargs["scale"] == (0.02, 0.02, 0.02)
+    assert kwargs["colormap"]["colors"].dtype == np.float32
+
+
+def test_session_newer_version(tmp_path):
+    path = str(tmp_path / "heart.mchd")
+    save_session(path, "heart", [])
+    with zipfile.ZipFile(path, "r") as zf:
+        manifest = json.loads(zf.read(MANIFEST_NAME))
+    manifest["version"] += 1
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr(MANIFEST_NAME, json.dumps(manifest))
+    with pytest.raises(ValueError):
+        load_session(path)
+
+
+def test_save_session_failure_cleanup(tmp_path):
+    path = tmp_path / "heart.mchd"
+    with pytest.raises(TypeError):
+        save_session(str(path), "heart", [{"name": "heart", "kind": "image", "data": np.zeros((2, 2)),
+                                           "settings": {"bad": object()}}])
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,58 @@
+import json
+
+import pandas as pd
+
+from mousechd_napari._sweep import expand_grid, summarize_trial
+
+
+def _write_trial(path, monitor, history):
+    path.mkdir()
+    (path / "configs.json").write_text(json.dumps({"monitor": monitor}))
+    pd.DataFrame(history).to_csv(path / "train.csv", index=False)
+
+
+def test_expand_grid():
+    trials = expand_grid({"lr": [0.1, 0.01], "class_weights": [True, False], "epochs": 5})
+    assert len(trials) == 4
+    assert all(t["epochs"] == 5 for t in trials)
+
+
+def test_summarize_trial_uses_trial_monitor(tmp_path):
+    _write_trial(tmp_path / "trial-01", "val_accuracy",
+                 {"epoch": [0, 1, 2], "val_loss": [0.5, 0.4, 0.3], "val_accuracy": [0.6, 0.9, 0.7]})
+    res = summarize_trial(str(tmp_path / "trial-01"))
+    assert res["monitor"] == "val_accuracy"
+    assert res["best_epoch"] == 2
+    assert res["epochs_run"] == 3
+
+
+def test_summarize_trial_missing_column(tmp_path):
+    _write_trial(tmp_path / "trial-01", "val_weighted_accuracy",
+                 {"epoch": [0, 1], "val_loss": [0.5, 0.4], "val_accuracy": [0.6, 0.9]})
+    res = summarize_trial(str(tmp_path / "trial-01"))
+    assert res == {"monitor": "val_weighted_accuracy", "epochs_run": 2}
+
+
+def test_summarize_trial_not_trained(tmp_path):
+    (tmp_path / "trial-01").mkdir()
+    assert "best_epoch" not in summarize_trial(str(tmp_path / "trial-01"), monitor="val_loss")
+
+
+def test_sweep_progress_log(tmp_path, monkeypatch):
+    import mousechd_napari._utils as utils
+    from mousechd_napari._sweep import sweep
+
+    def fake_retrain(outdir, exp, overrides, **kwargs):
+        _write_trial(tmp_path / "out" / "exp" / exp, "val_loss",
+                     {"epoch": [0, 1], "val_loss": [overrides["lr"], overrides["lr"] / 2]})
+        return "Sucess"
+
+    monkeypatch.setattr(utils, "retrain", fake_retrain)
+    (tmp_path / "retrain").mkdir()
+    df = sweep(resrc="server", retrain_dir=str(tmp_path / "retrain"), outdir=str(tmp_path / "out"),
+               exp="exp", grid={"lr": [0.2, 0.1]})
+    assert df["trial"].tolist() == ["trial-02", "trial-01"]
+    lines = (tmp_path / "retrain" / "retrain.log").read_text().splitlines()
+    assert len(lines) == 2
+    assert sorted(x.split()[1] for x in lines) == ["trial-01", "trial-02"]
+    assert all(x.split(":")[1].startswith(" Sucess") for x in lines)
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("nnunet")
+
+from mousechd_napari._tiled import tile_positions  # noqa: E402
+
+
+@pytest.mark.parametrize("image_size", [(64, 64, 64), (100, 230, 157), (64, 300, 500), (200, 200, 200)])
+@pytest.mark.parametrize("step_size", [0.5, 0.3, 1.])
+def test_tile_positions(image_size, step_size):
+    patch_size = (64, 96, 128)
+    image_size = tuple(max(p, s) for p, s in zip(patch_size, image_size))
+    corners, n_coarse = tile_positions(patch_size, image_size, step_size)
+
+    # No duplicates, same tiles as the sliding window
+    assert len(set(corners)) == len(corners)
+    n_steps = [len({c[axis] for c in corners}) for axis in range(3)]
+    assert len(corners) == np.prod(n_steps)
+
+    # Coarse tiles alone cover the image
+    covered = np.zeros(image_size, dtype=bool)
+    for corner in corners[:n_coarse]:
+        covered[tuple(slice(c, c + p) for c, p in zip(corner, patch_size))] = True
+    assert covered.all()
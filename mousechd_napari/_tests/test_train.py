@@ -0,0 +1,69 @@
+import pandas as pd
+import pytest
+
+from mousechd_napari._train import check_configs, record_run, resume_epoch
+
+
+CONFIGS = {"n_classes": 1,
+           "loss_fn": "binary_crossentropy",
+           "model_name": "roimask3d1",
+           "mask_depth": 3,
+           "augment": "augment0",
+           "monitor": "val_loss"}
+
+
+@pytest.mark.parametrize("resume, epoch", [(None, 0),
+                                           ("finetune_init.hdf5", 0),
+                                           ("best_model.hdf5", 0),
+                                           ("epoch-012.hdf5", 12),
+                                           ("ckpt/epoch-003.hdf5", 3)])
+def test_resume_epoch(resume, epoch):
+    assert resume_epoch(resume) == epoch
+
+
+def test_check_configs():
+    check_configs(CONFIGS)
+
+
+@pytest.mark.parametrize("key, value", [("loss_fn", "categorical_crossentropy"),
+                                        ("model_name", "resnet"),
+                                        ("mask_depth", 5),
+                                        ("augment", "augment9"),
+                                        ("monitor", "val_auc")])
+def test_check_configs_invalid(key, value):
+    with pytest.raises(AssertionError):
+        check_configs(dict(CONFIGS, **{key: value}))
+
+
+def _labels(path, n):
+    path.mkdir(parents=True)
+    pd.DataFrame({"heart_name": [f"heart_{i:02d}" for i in range(n)], "label": [i % 2 for i in range(n)]}).to_csv(
+        path / "train.csv", index=False)
+
+
+def test_record_run_epochs_run(tmp_path):
+    retrain_dir = tmp_path / "retrain"
+    _labels(retrain_dir / "label", 20)
+    _labels(retrain_dir / "label" / "incremental", 5)
+    # Full run early-stopped after 5 of 20 epochs: 1s per sample and epoch
+    full = record_run(str(retrain_dir), str(tmp_path / "full"), str(retrain_dir / "label"), "full", "full",
+                      epochs=20, train_time=100., epochs_run=5)
+    assert full["epochs_run"] == 5
+    # Incremental run early-stopped after 2 epochs
+    inc = record_run(str(retrain_dir), str(tmp_path / "inc"), str(retrain_dir / "label" / "incremental"),
+                     "inc", "incremental", epochs=20, train_time=10., epochs_run=2)
+    assert inc["full_time_estimate"] == pytest.approx(20 * 2)
+    assert inc["time_saved"] == pytest.approx(30)
+    assert pd.read_csv(retrain_dir / "runs.csv")["epochs_run"].tolist() == [5, 2]
+
+
+def test_record_run_old_runs(tmp_path):
+    retrain_dir = tmp_path / "retrain"
+    _labels(retrain_dir / "label", 20)
+    _labels(retrain_dir / "label" / "incremental", 5)
+    pd.DataFrame([{"date": "2024-01-01 10:00:00", "exp": "full", "mode": "full", "n_hearts": 20, "n_samples": 20,
+                   "epochs": 10, "train_time": 200.}]).to_csv(retrain_dir / "runs.csv", index=False)
+    inc = record_run(str(retrain_dir), str(tmp_path / "inc"), str(retrain_dir / "label" / "incremental"),
+                     "inc", "incremental", epochs=10, train_time=10., epochs_run=10)
+    assert inc["full_time_estimate"] == pytest.approx(200)
+    assert pd.read_csv(retrain_dir / "runs.csv")["epochs_run"].tolist() == [10, 10]
@@ -0,0 +1,145 @@
+"""
+One CPU thread budget for torch, TensorFlow, SimpleITK, BLAS/OpenMP and the nnU-Net worker processes
+"""
+import os
+import sys
+import logging
+from contextlib import contextmanager
+
+# Read by OpenMP/BLAS/ITK of the processes started later
+ENV_VARS = ["OMP_NUM_THREADS",
+            "MKL_NUM_THREADS",
+            "OPENBLAS_NUM_THREADS",
+            "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"]
+
+_budget = {"total": None}
+
+
+def get_thread_budget():
+    """Threads the plugin may use: the budget set with `set_thread_budget`,
+    all cores otherwise
+    """
+    from ._calibrate import count_cores
+    return _budget["total"] or count_cores()
+
+
+def partition(total, weights):
+    """Split `total` threads between stages running at the same time,
+    proportionally to `weights`, at least 1 each.
+
+    Returns:
+        dict: stage -> threads
+    """
+    names = list(weights.keys())
+    if total <= len(names):
+        return {name: 1 for name in names}
+    norm = sum(weights.values())
+    exact = {name: (total - len(names)) * weights[name] / norm for name in names}
+    shares = {name: 1 + int(exact[name]) for name in names}
+    # Largest remainders get the threads left
+    for name in sorted(names, key=lambda x: exact[x] - int(exact[x]), reverse=True)[:total - sum(shares.values())]:
+        shares[name] += 1
+
+    return shares
+
+
+def set_sitk_threads(nthreads):
+    import SimpleITK as sitk
+    previous = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(nthreads)
+    return previous
+
+
+def set_tf_threads(nthreads, interop=1):
+    """TensorFlow threads, only possible before TensorFlow runs its first
+    operation. TensorFlow is not imported for this.
+
+    Returns:
+        bool: applied
+    """
+    tf = sys.modules.get("tensorflow")
+    if tf is None:
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(nthreads)
+        os.environ["TF_NUM_INTEROP_THREADS"] = str(interop)
+        return True
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(nthreads)
+        tf.config.threading.set_inter_op_parallelism_threads(interop)
+        return True
+    except RuntimeError:
+        logging.info("TensorFlow is already initialized: its threads are not changed")
+        return False
+
+
+def set_library_threads(nthreads, tf_threads=None, interop=1):
+    """Configure the thread pools of this process and of the processes it
+    starts: torch, TensorFlow (`tf_threads`, default `nthreads`), SimpleITK,
+    BLAS (with threadpoolctl if installed) and OpenMP.
+    """
+    import torch
+
+    for var in ENV_VARS:
+        os.environ[var] = str(nthreads)
+    torch.set_num_threads(nthreads)
+    try:
+        # Only possible before the first inter-op parallel work of the process
+        torch.set_num_interop_threads(interop)
+    except RuntimeError:
+        pass
+    set_tf_threads(tf_threads or nthreads, interop)
+    set_sitk_threads(nthreads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(nthreads)
+    except ImportError:
+        pass
+
+
+def set_thread_budget(total=None, tf_threads=None):
+    """Set the budget (all cores if None) and configure the libraries with it
+    """
+    _budget["total"] = total
+    set_library_threads(get_thread_budget(), tf_threads=tf_threads)
+
+    return get_thread_budget()
+
+
+@contextmanager
+def stage_threads(nthreads, sitk_threads=None):
+    """Torch and SimpleITK threads of a stage, restored after. Processes forked
+    in the stage keep the SimpleITK setting.
+    """
+    import torch
+
+    previous_torch = torch.get_num_threads()
+    previous_sitk = set_sitk_threads(sitk_threads or nthreads)
+    torch.set_num_threads(nthreads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous_torch)
+        set_sitk_threads(previous_sitk)
+
+
+def segmentation_plan(n_cases, nthreads_preprocessing, nthreads_nifti, total=None):
+    """Partition the budget between the nnU-Net stages.
+
+    With one scan, preprocessing, inference and export run one after the
+    other: each gets the whole budget. With several scans, the preprocessing
+    and export processes of the other scans run during inference: they get
+    at most the requested numbers of processes (one SimpleITK thread each)
+    and inference keeps at least half of the budget.
+
+    Returns:
+        dict: preprocessing and nifti processes, inference and sitk threads
+    """
+    total = total or get_thread_budget()
+    if n_cases <= 1:
+        return {"preprocessing": 1, "nifti": 1, "inference": total, "sitk": total}
+    preprocessing = max(1, min(nthreads_preprocessing, n_cases, total // 4))
+    nifti = max(1, min(nthreads_nifti, total // 8))
+
+    return {"preprocessing": preprocessing,
+            "nifti": nifti,
+            "inference": max(1, total - preprocessing - nifti, total // 2),
+            "sitk": 1}
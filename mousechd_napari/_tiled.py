@@ -0,0 +1,314 @@
+"""
+Tile-by-tile sliding-window inference of the nnU-Net heart segmentation model, coarse tiles first, for progressive
+previews, on one process or split across CPU worker processes
+"""
+import os
+import itertools
+
+import numpy as np
+
+from ._profiles import PROFILES
+from ._runtime import configure_cpu, inference_context
+
+
+def load_segmenter(profile, checkpoint_name="model_final_checkpoint", quantized=False):
+    """nnU-Net trainer (network in inference mode) and the weights of the
+    folds of `profile`, or their int8 networks if `quantized`
+    """
+    from nnunet.training.model_restore import load_model_and_checkpoint_files
+    from mousechd.segmentation.utils import SEG_DIR, download_seg_models
+
+    download_seg_models()
+    trainer, params = load_model_and_checkpoint_files(SEG_DIR,
+                                                      PROFILES[profile]["folds"],
+                                                      mixed_precision=True,
+                                                      checkpoint_name=checkpoint_name)
+    trainer.network.do_ds = False
+    trainer.network.eval()
+    if quantized:
+        from ._quantize import model_folds, load_quantized
+        params = load_quantized(model_folds(PROFILES[profile]["folds"]), trainer.network.num_classes)
+
+    return trainer, params
+
+
+def select_fold(trainer, params, fold):
+    """Network predicting with the weights of `fold`: the trainer network with
+    the fold weights loaded, or the int8 network of the fold
+    """
+    if not isinstance(params[fold], dict):
+        return params[fold]
+    trainer.load_checkpoint_ram(params[fold], False)
+    trainer.network.eval()
+
+    return trainer.network
+
+
+def tile_positions(patch_size, image_size, step_size):
+    """Corners of the sliding-window tiles, coarse tiles first.
+
+    Coarse tiles (along each axis, a step is skipped when the next one is
+    still within a patch of the previous coarse step) are at most one patch
+    apart, so they already cover the whole image; the other tiles refine the
+    overlaps. With a step size of 0.5 this is every other step.
+
+    Returns:
+        tuple: (list of corners, number of coarse tiles)
+    """
+    from nnunet.network_architecture.neural_network import SegmentationNetwork
+
+    steps = SegmentationNetwork._compute_steps_for_sliding_window(patch_size, image_size, step_size)
+    coarse_steps = []
+    for axis, patch in zip(steps, patch_size):
+        kept = [axis[0]]
+        for i in range(1, len(axis)):
+            if (i == len(axis) - 1) or (axis[i + 1] - kept[-1] > patch):
+                kept.append(axis[i])
+        coarse_steps.append(kept)
+    coarse = list(itertools.product(*coarse_steps))
+    coarse_set = set(coarse)
+    rest = [x for x in itertools.product(*steps) if x not in coarse_set]
+
+    return coarse + rest, len(coarse)
+
+
+def mirror_flips(mirror_axes, tta):
+    """Flipped axes of the (b, c, x, y, z) tile for each test-time augmentation
+    """
+    if not tta:
+        return [()]
+    return [tuple(a + 2 for a in combo)
+            for r in range(len(mirror_axes) + 1)
+            for combo in itertools.combinations(mirror_axes, r)]
+
+
+def predict_tile(network, tile, flips, gaussian, device, runtime=None):
+    """Softmax of one (c, x, y, z) tile averaged over the flips, weighted by
+    the Gaussian importance map. `runtime`: CPU runtime settings (see
+    `cpu_runtime_settings`), torch defaults if None.
+    """
+    import torch
+
+    x = torch.from_numpy(np.ascontiguousarray(tile[None])).to(device)
+    if (runtime is not None) and runtime["channels_last"]:
+        x = x.contiguous(memory_format=torch.channels_last_3d)
+    pred = 0
+    with inference_context(device, runtime):
+        for axes in flips:
+            out = network.inference_apply_nonlin(network(torch.flip(x, axes) if axes else x))
+            pred = pred + (torch.flip(out, axes) if axes else out)
+
+    return (pred[0].float().cpu().numpy() / len(flips)) * gaussian
+
+
+# State of a worker process: model, folds, shared input
+_worker = {}
+
+
+def _init_worker(profile, shm_name, shape, dtype, tta, nthreads, runtime, quantized):
+    import torch
+    from multiprocessing import shared_memory
+    from nnunet.network_architecture.neural_network import SegmentationNetwork
+
+    torch.set_num_threads(nthreads)
+    trainer, params = load_segmenter(profile, quantized=quantized)
+    if runtime is not None:
+        configure_cpu(trainer.network, runtime, nthreads)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker.update({"trainer": trainer,
+                    "params": params,
+                    "shm": shm,
+                    "data": np.ndarray(shape, dtype=dtype, buffer=shm.buf),
+                    "flips": mirror_flips(trainer.data_aug_params["mirror_axes"], tta),
+                    "gaussian": SegmentationNetwork._get_gaussian(trainer.patch_size, sigma_scale=1. / 8),
+                    "runtime": runtime,
+                    "network": None,
+                    "fold": None})
+
+
+def _predict_task(task):
+    import torch
+
+    fold, corner = task
+    trainer = _worker["trainer"]
+    if _worker["fold"] != fold:
+        _worker["network"] = select_fold(trainer, _worker["params"], fold)
+        _worker["fold"] = fold
+    tile = _worker["data"][(slice(None),) + tuple(slice(c, c + s) for c, s in zip(corner, trainer.patch_size))]
+
+    return predict_tile(_worker["network"], tile, _worker["flips"], _worker["gaussian"], torch.device("cpu"), _worker["runtime"])
+
+
+def iter_tile_predictions(trainer, params, data, tasks, tta, gaussian, device, profile, n_workers=1, threads_per_worker=None,
+                          runtime=None, quantized=False):
+    """Weighted softmax of each (fold, corner) task, in the order of `tasks`.
+
+    With `n_workers` > 1, tasks are split across worker processes that read
+    the input from shared memory, each with `threads_per_worker` torch threads.
+    Closing the generator cancels the pending tasks.
+    """
+    flips = mirror_flips(trainer.data_aug_params["mirror_axes"], tta)
+    if n_workers <= 1:
+        loaded, network = None, None
+        for fold, corner in tasks:
+            if fold != loaded:
+                network = select_fold(trainer, params, fold)
+                loaded = fold
+            tile = data[(slice(None),) + tuple(slice(c, c + s) for c, s in zip(corner, trainer.patch_size))]
+            yield predict_tile(network, tile, flips, gaussian, device, runtime)
+        return
+
+    from multiprocessing import get_context, shared_memory
+    from concurrent.futures import ProcessPoolExecutor
+    from ._threads import get_thread_budget
+
+    threads_per_worker = threads_per_worker or max(1, get_thread_budget() // n_workers)
+    shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+    try:
+        np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+        # spawn: torch and TensorFlow threads of the viewer are not forked
+        pool = ProcessPoolExecutor(max_workers=n_workers,
+                                   mp_context=get_context("spawn"),
+                                   initializer=_init_worker,
+                                   initargs=(profile, shm.name, data.shape, data.dtype, tta, threads_per_worker, runtime, quantized))
+        try:
+            yield from pool.map(_predict_task, tasks)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+class TileAccumulator:
+    """Gaussian-weighted sum of the tile predictions of a padded image
+    """
+    def __init__(self, num_classes, shape, patch_size):
+        from nnunet.network_architecture.neural_network import SegmentationNetwork
+
+        self.gaussian = SegmentationNetwork._get_gaussian(patch_size, sigma_scale=1. / 8)
+        self.patch_size = patch_size
+        self.sum = np.zeros([num_classes] + list(shape), dtype=np.float32)
+        self.weights = np.zeros(shape, dtype=np.float32)
+
+    def add(self, corner, pred):
+        region = tuple(slice(c, c + p) for c, p in zip(corner, self.patch_size))
+        self.sum[(slice(None),) + region] += pred
+        self.weights[region] += self.gaussian
+
+    def mask(self, region):
+        """Labels of the predicted voxels (background elsewhere). Weights are
+        positive, so the argmax of the sums is the argmax of the probabilities.
+        """
+        return self.sum[(slice(None),) + region].argmax(0).astype(np.uint8)
+
+    def probabilities(self, region):
+        return self.sum[(slice(None),) + region] / np.maximum(self.weights[region], 1e-8)
+
+
+def preview_geometry(properties, transpose_backward):
+    """Scale and translation (in input voxels) of a mask at the model
+    resolution onto the input scan
+    """
+    spacing = np.array(properties["spacing_after_resampling"])[transpose_backward]
+    scale = spacing / np.array(properties["original_spacing"])
+    translate = np.array([b[0] for b in properties["crop_bbox"]]) + (scale - 1) / 2
+
+    return scale, translate
+
+
+def segment_progressive(input_path, output_path, profile, step_size=None, n_updates=20, n_workers=1, threads_per_worker=None,
+                        runtime=None, quantized=False):
+    """Segment one scan tile by tile, yielding after each tile.
+
+    The coarse tiles of the first fold come first and give a complete but
+    rough mask; the remaining tiles and folds then refine it. On CPU, tiles
+    and folds can be split across `n_workers` processes.
+
+    Args:
+        input_path (str): NIfTI scan
+        output_path (str): the final mask is written there, like `nnunet_predict`
+        profile (str): segmentation profile (folds, TTA, step size)
+        step_size (float, optional): overrides the step of the profile. Defaults to None.
+        n_updates (int, optional): number of intermediate masks. Defaults to 20.
+        n_workers (int, optional): worker processes (CPU only). Defaults to 1.
+        threads_per_worker (int, optional): torch threads per worker. Defaults to thread budget / n_workers.
+        runtime (dict, optional): CPU runtime settings (see `cpu_runtime_settings`). Defaults to None (torch defaults).
+        quantized (bool, optional): int8 networks of the folds (CPU, see `quantize_segmenter`). Defaults to False.
+
+    Yields:
+        dict: done, total, stage ("coarse", "refine" or "done"), and every
+            total/n_updates tiles, after the coarse pass and at the end:
+            mask (uint8 at the model resolution), scale and translate (mask
+            to input voxels)
+    """
+    import torch
+    from batchgenerators.augmentations.utils import pad_nd_image
+    from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax
+    from nnunet.postprocessing.connected_components import load_postprocessing, load_remove_save
+    from mousechd.segmentation.utils import SEG_DIR
+
+    settings = PROFILES[profile]
+    step_size = settings["step_size"] if step_size is None else step_size
+    trainer, params = load_segmenter(profile, quantized=quantized)
+    # Quantized operators only run on CPU
+    device = torch.device("cuda" if torch.cuda.is_available() and not quantized else "cpu")
+    network = trainer.network.to(device)
+    if device.type == "cuda":
+        n_workers = 1
+        runtime = None
+    if quantized and (runtime is not None):
+        # Int8 kernels: no bfloat16 autocast, layout chosen by the engine
+        runtime = dict(runtime, channels_last=False, bf16=False)
+    elif (runtime is not None) and (n_workers <= 1):
+        configure_cpu(network, runtime)
+
+    d, _, properties = trainer.preprocess_patient([input_path])
+    transpose_backward = trainer.plans.get("transpose_backward", [0, 1, 2])
+    scale, translate = preview_geometry(properties, transpose_backward)
+    data, slicer = pad_nd_image(d, trainer.patch_size, "constant", {"constant_values": 0}, True, None)
+    region = tuple(slicer[1:])
+
+    corners, n_coarse = tile_positions(trainer.patch_size, data.shape[1:], step_size)
+    acc = TileAccumulator(network.num_classes, data.shape[1:], trainer.patch_size)
+    total = len(corners) * len(params)
+    every = max(1, total // n_updates)
+
+    def _update(done, stage, with_mask):
+        update = {"done": done, "total": total, "stage": stage}
+        if with_mask:
+            update.update({"mask": acc.mask(region).transpose(transpose_backward),
+                           "scale": scale,
+                           "translate": translate})
+        return update
+
+    tasks = [(fold, corner) for fold in range(len(params)) for corner in corners]
+    predictions = iter_tile_predictions(trainer, params, data, tasks, settings["tta"], acc.gaussian, device,
+                                        profile, n_workers, threads_per_worker, runtime, quantized)
+    try:
+        for done, ((_, corner), pred) in enumerate(zip(tasks, predictions), start=1):
+            acc.add(corner, pred)
+            stage = "coarse" if (done <= n_coarse) else "refine"
+            yield _update(done, stage, (done == n_coarse) or ((done > n_coarse) and (done % every == 0)))
+    finally:
+        predictions.close()
+    done = len(tasks)
+
+    softmax = acc.probabilities(region).transpose([0] + [i + 1 for i in transpose_backward])
+    if "segmentation_export_params" in trainer.plans.keys():
+        export_params = trainer.plans["segmentation_export_params"]
+    else:
+        export_params = {"force_separate_z": None, "interpolation_order": 1, "interpolation_order_z": 0}
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    save_segmentation_nifti_from_softmax(softmax, output_path, properties,
+                                         export_params["interpolation_order"],
+                                         getattr(trainer, "regions_class_order", None),
+                                         None, None, None, None,
+                                         force_separate_z=export_params["force_separate_z"],
+                                         interpolation_order_z=export_params["interpolation_order_z"])
+    pp_file = os.path.join(SEG_DIR, "postprocessing.json")
+    if os.path.isfile(pp_file):
+        for_which_classes, min_valid_obj_size = load_postprocessing(pp_file)
+        load_remove_save(output_path, output_path, for_which_classes, min_valid_obj_size)
+
+    yield _update(done, "done", True)
@@ -0,0 +1,671 @@
+"""
+Local classifier training on a prepacked, memory-mapped data cache
+"""
+import os
+import re
+import json
+import time
+import shutil
+import logging
+from datetime import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from ._profiling import trace, traced
+
+CACHE_VERSION = 1
+CACHE_FILE = "volumes.npy"
+CACHE_META = "cache.json"
+FINETUNE_WEIGHTS = "finetune_init.hdf5" # no "-" in name: train_clf parses resume epochs after "-"
+RUN_HEADERS = ["date", "exp", "mode", "n_hearts", "n_samples", "epochs", "epochs_run", "train_time"]
+INITIAL_WEIGHTS = "initial_weights.hdf5"
+MONITOR_LIST = ["val_loss", "val_accuracy", "val_weighted_accuracy"]
+# Columns of the initial evaluation row of train.csv (as train_clf writes it)
+TRAIN_HEADERS = ["epoch",
+                 "loss", "accuracy", "recall", "precision", "weighted_accuracy",
+                 "val_loss", "val_accuracy", "val_recall", "val_precision", "val_weighted_accuracy"]
+
+
+def nifti_path(data_dir, filename):
+    """Resolve a label entry (e.g. 'images_x5/heart_01') to a file on disk
+    """
+    path = os.path.join(data_dir, filename)
+    if (not os.path.isfile(path)) and os.path.isfile(path + ".nii.gz"):
+        path += ".nii.gz"
+
+    return path
+
+
+def load_volume(path, target_size):
+    """Decode a resampled heart and bring it to the classifier input grid,
+    the same way `MouseCHDGen` does at every epoch.
+    """
+    from mousechd.datasets.utils import resample3d, norm_min_max
+
+    img = sitk.ReadImage(path)
+    img = resample3d(img, tuple(target_size[:3])[::-1])
+
+    return norm_min_max(sitk.GetArrayFromImage(img))
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+@traced("pack_cache")
+def pack_training_cache(data_dir,
+                        filenames,
+                        target_size,
+                        cache_dir,
+                        nthreads=4,
+                        dtype="float16"):
+    """Decode, resample and normalize all volumes once into a single
+    memory-mappable `.npy` file.
+
+    Entries that are already packed and unchanged on disk are copied from the
+    previous cache instead of being decoded again.
+
+    Args:
+        data_dir (str): resampled data directory (`retrain/resampled`)
+        filenames (list): label entries relative to `data_dir`
+        target_size (list): classifier input size (z, y, x, c)
+        cache_dir (str): output directory of the cache
+        nthreads (int, optional): decoding threads. Defaults to 4.
+        dtype (str, optional): storage dtype. Defaults to "float16".
+
+    Returns:
+        tuple: (memmap of shape (n, z, y, x), {filename: row})
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    filenames = sorted(set(filenames))
+    shape = tuple(target_size[:3])
+    stamps = {fn: _file_stamp(nifti_path(data_dir, fn)) for fn in filenames}
+
+    cache_path = os.path.join(cache_dir, CACHE_FILE)
+    meta_path = os.path.join(cache_dir, CACHE_META)
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        old = np.load(cache_path, mmap_mode="r")
+        if ((meta["version"] != CACHE_VERSION) or (tuple(meta["shape"]) != shape)
+            or (meta["dtype"] != dtype)):
+            raise ValueError("Cache layout changed")
+    except (FileNotFoundError, ValueError, KeyError):
+        meta = {"index": {}, "stamps": {}}
+        old = None
+
+    reusable = {fn: meta["index"][fn] for fn in filenames
+                if (fn in meta["index"]) and (meta["stamps"].get(fn) == stamps[fn])}
+
+    if (old is not None) and (len(reusable) == len(filenames)) and (len(old) == len(filenames)):
+        logging.info("Training cache is up to date: {} volumes".format(len(filenames)))
+        return old, {fn: int(i) for fn, i in meta["index"].items()}
+
+    logging.info("Pack training cache: {} volumes ({} reused, {} to decode)".format(
+        len(filenames), len(reusable), len(filenames) - len(reusable)))
+
+    tmp_path = os.path.join(cache_dir, "volumes.tmp.npy")
+    volumes = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype,
+                                        shape=(len(filenames), *shape))
+    index = {fn: i for i, fn in enumerate(filenames)}
+
+    for fn, i in reusable.items():
+        volumes[index[fn]] = old[i]
+
+    def _decode(out, fn):
+        out[index[fn]] = load_volume(nifti_path(data_dir, fn), target_size)
+        return fn
+
+    todo = [fn for fn in filenames if fn not in reusable]
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as executor:
+        for i, _ in enumerate(executor.map(partial(_decode, volumes), todo)):
+            if (i + 1) % 50 == 0:
+                logging.info("Packed {}/{}".format(i + 1, len(todo)))
+
+    volumes.flush()
+    del volumes, old
+    os.replace(tmp_path, cache_path)
+    with open(meta_path, "w") as f:
+        json.dump({"version": CACHE_VERSION,
+                   "shape": list(shape),
+                   "dtype": dtype,
+                   "index": index,
+                   "stamps": {fn: stamps[fn] for fn in filenames}}, f)
+
+    return np.load(cache_path, mmap_mode="r"), index
+
+
+def CachedGen(*args, **kwargs):
+    """Build a `CachedSequence`. TensorFlow is imported lazily so that the
+    cache can be packed without it.
+    """
+    import tensorflow as tf
+
+    class CachedSequence(tf.keras.utils.Sequence):
+        """Drop-in replacement for `MouseCHDGen` reading from the packed cache
+        """
+        def __init__(self,
+                     volumes,
+                     index,
+                     filenames,
+                     batch_size,
+                     target_size,
+                     labels,
+                     seed=42,
+                     n_classes=1,
+                     stage="train",
+                     class_weights=None):
+            self.volumes = volumes
+            self.rows = np.array([index[fn] for fn in filenames])
+            self.n_classes = n_classes
+            self.numeric_labels = np.array(labels)
+            if n_classes == 1:
+                self.labels = np.array(labels).reshape(-1, 1)
+            else:
+                self.labels = tf.keras.utils.to_categorical(np.array(labels), num_classes=n_classes)
+            self.batch_size = batch_size
+            self.target_size = target_size
+            self.seed = seed
+            self.stage = stage
+            self.class_weights = class_weights
+            self.on_epoch_end()
+
+        def __len__(self):
+            return int(np.ceil(len(self.rows) / float(self.batch_size)))
+
+        def on_epoch_end(self):
+            # Same (seeded) ordering as MouseCHDGen
+            self.indexes = np.arange(len(self.rows))
+            if self.stage in ["train", "val"]:
+                np.random.seed(self.seed)
+                np.random.shuffle(self.indexes)
+
+        def __getitem__(self, index):
+            ids = self.indexes[index*self.batch_size:(index+1)*self.batch_size]
+            X = np.zeros((self.batch_size, *self.target_size), dtype=np.float32)
+            y = np.zeros((self.batch_size, self.n_classes), dtype=np.float32)
+            # Sorted rows keep memmap reads sequential
+            order = np.argsort(self.rows[ids])
+            for i in order:
+                X[i] = np.repeat(self.volumes[self.rows[ids[i]]][..., np.newaxis],
+                                 self.target_size[3], axis=3)
+                y[i] = self.labels[ids[i]]
+
+            if self.class_weights is None:
+                return X, y
+
+            weights = np.zeros((self.batch_size, 1), dtype=np.float32)
+            for i, ID in enumerate(ids):
+                weights[i] = self.class_weights[self.numeric_labels[ID]]
+
+            return X, y, weights
+
+    return CachedSequence(*args, **kwargs)
+
+
+def EpochTimer():
+    """Keras callback logging the wall-clock time of every epoch
+    """
+    import tensorflow as tf
+
+    class _EpochTimer(tf.keras.callbacks.Callback):
+        def on_train_begin(self, logs=None):
+            self.times = []
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.time()
+
+        def on_epoch_end(self, epoch, logs=None):
+            self.times.append(time.time() - self.start)
+            logging.info("Epoch {} time: {}".format(
+                epoch + 1,
+                time.strftime("%Hh%Mm%Ss", time.gmtime(self.times[-1]))))
+
+    return _EpochTimer()
+
+
+def TimeBudget(budget):
+    """Keras callback stopping the training before the next epoch would
+    exceed `budget` seconds of wall-clock time
+    """
+    import tensorflow as tf
+
+    class _TimeBudget(tf.keras.callbacks.Callback):
+        def on_train_begin(self, logs=None):
+            self.start = time.time()
+            self.stopped = False
+            self.epochs = 0
+
+        def on_epoch_end(self, epoch, logs=None):
+            # Epochs of this run: `epoch` starts at the resumed epoch
+            self.epochs += 1
+            elapsed = time.time() - self.start
+            if elapsed + elapsed / self.epochs > budget:
+                logging.info("Epoch {}: time budget of {} reached, stop training".format(
+                    epoch + 1,
+                    time.strftime("%Hh%Mm%Ss", time.gmtime(budget))))
+                self.stopped = True
+                self.model.stop_training = True
+
+    return _TimeBudget()
+
+
+def stopped_epoch(save_dir):
+    """Last epoch written by the CSVLogger of an experiment (0 if none)
+    """
+    try:
+        df = pd.read_csv(os.path.join(save_dir, "train.csv"))
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return 0
+
+    return int(df["epoch"].iloc[-1]) + 1 if len(df) > 0 else 0
+
+
+def check_configs(configs):
+    """Same checks as `mousechd.run.train_clf.main`
+    """
+    from mousechd.classifier.utils import MODEL_NAMES
+    from mousechd.classifier.augments import AUGMENT_POLS
+
+    if configs["n_classes"] == 1:
+        assert configs["loss_fn"] in ["binary_crossentropy", "sigmoid_focal_crossentropy"], "loss_fn for n_classes=1: binary_crossentropy,sigmoid_focal_crossentropy"
+    else:
+        assert configs["loss_fn"] == "categorical_crossentropy", "n_classes={}, only categorical_crossentropy can be applied as loss_fn".format(configs["n_classes"])
+    assert configs["model_name"] in MODEL_NAMES, f"'model_name' must be in {MODEL_NAMES}"
+    assert configs["mask_depth"] in range(1, 5), "'mask_depth' must be in {}".format(list(range(1, 5)))
+    assert configs["augment"] in AUGMENT_POLS, f"'augment' must be in {AUGMENT_POLS}"
+    assert configs["monitor"] in MONITOR_LIST, f"'monitor' must be in {MONITOR_LIST}"
+
+
+def resume_epoch(resume):
+    """Initial epoch of resumed weights: the number after "-" in the file name
+    (e.g. 'epoch-012.hdf5'), 0 if there is none
+    """
+    if resume is None:
+        return 0
+    match = re.search(r"-(\d+)", os.path.basename(resume))
+
+    return int(match.group(1)) if match else 0
+
+
+def evaluate_initial(model, data_dir, train_df, val_df, configs, save_dir):
+    """Write the metrics of the initial model as epoch 0 of train.csv, the way
+    `mousechd.classifier.train.train_clf` does
+    """
+    import tensorflow as tf
+    from mousechd.classifier.utils import calculate_metrics
+    from mousechd.classifier.evaluate import predict_folder
+
+    logging.info("="*15 + "//" + "="*15)
+    logging.info("Evaluate initial model:")
+    row = [0]
+    for df in [train_df, val_df]:
+        res = predict_folder(model=model,
+                             imdir=data_dir,
+                             maskdir=None,
+                             target_size=configs["input_size"],
+                             label_df=df,
+                             stage="eval",
+                             batch_size=configs["batch_size"],
+                             save=None,
+                             grouped_result=False)
+        labels = res["label"].values.astype(float)
+        probs = res["prob"].values.astype(float)
+        loss = tf.keras.metrics.binary_crossentropy(tf.constant(labels), tf.constant(probs))
+        metrics = calculate_metrics(probs, labels)
+        # Same columns as train_clf: specificity is logged as precision
+        row += [loss.numpy(), metrics["acc"], metrics["sens"], metrics["spec"], metrics["bal_acc"]]
+
+    pd.DataFrame([row], columns=TRAIN_HEADERS).to_csv(os.path.join(save_dir, "train.csv"), index=False)
+
+
+def resume_or_initialize(model, save_dir, configs, data_dir, train_df, val_df):
+    """Load the weights of `configs["resume"]` (in `save_dir`, the default
+    classifier if missing), or save the initial weights and evaluate them if
+    the experiment has no train.csv yet. Mirrors `train_clf`.
+
+    Returns:
+        int: initial epoch
+    """
+    from mousechd.classifier.utils import download_clf_models, CLF_DIR
+
+    resume = configs.get("resume")
+    if resume is not None:
+        try:
+            model.load_weights(os.path.join(save_dir, resume))
+        except FileNotFoundError:
+            logging.info("Resumed weights not found, retrain from default weights")
+            download_clf_models()
+            model.load_weights(os.path.join(CLF_DIR, "best_model.hdf5"))
+        logging.info("Resume from {}".format(resume))
+        return resume_epoch(resume)
+
+    model.save_weights(os.path.join(save_dir, INITIAL_WEIGHTS))
+    if not os.path.isfile(os.path.join(save_dir, "train.csv")):
+        evaluate_initial(model, data_dir, train_df, val_df, configs, save_dir)
+
+    return 0
+
+
+@traced()
+def train_local(exp_dir,
+                exp,
+                data_dir,
+                label_dir,
+                configs,
+                log_dir,
+                logfile,
+                epochs=None,
+                cache_dir=None,
+                nworkers=4,
+                cache=True,
+                time_budget=None):
+    """Train the classifier on local resources.
+
+    Same steps as `mousechd.run.train_clf.main` with `-evaluate none`: configs
+    checks, resume from `configs["resume"]` or initial weights and evaluation,
+    checkpoints, logs and output layout. With `cache`, every epoch reads
+    decoded volumes from a memory-mapped cache. Batches are prefetched by
+    `nworkers` threads.
+
+    Args:
+        exp_dir (str): experiment directory
+        exp (str): experiment name
+        data_dir (str): resampled data directory
+        label_dir (str): directory containing train.csv and val.csv
+        configs (str): path to configs.json
+        log_dir (str): tensorboard logging directory
+        logfile (str): path to logfile
+        epochs (int, optional): overwrite number of epochs. Defaults to None.
+        cache_dir (str, optional): cache directory. Defaults to `data_dir/../cache`.
+        nworkers (int, optional): decoding and prefetching threads. Defaults to 4.
+        cache (bool, optional): read from the packed cache. Defaults to True.
+        time_budget (float, optional): wall-clock budget in seconds. Defaults to None.
+
+    Returns:
+        tuple: trained model, stop reason ("completed", "early_stopping" or "time_budget")
+    """
+    import tensorflow as tf
+    from tensorflow.keras.callbacks import (ModelCheckpoint,
+                                            EarlyStopping,
+                                            TensorBoard,
+                                            CSVLogger)
+    from sklearn.utils import class_weight
+    from mousechd.utils.tools import set_logger
+    from mousechd.classifier.utils import load_label
+    from mousechd.classifier.models import MouseCHD
+    from mousechd.classifier.datagens import MouseCHDGen
+
+    with open(configs, "r") as f:
+        configs = json.load(f)
+    if epochs is not None:
+        configs["epochs"] = epochs
+    check_configs(configs)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(data_dir), "cache")
+
+    save_dir = os.path.join(exp_dir, exp)
+    os.makedirs(save_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(logfile), exist_ok=True)
+    set_logger(logfile)
+    with open(os.path.join(save_dir, "configs.json"), "w") as f:
+        json.dump(configs, f, indent=1)
+
+    train_df = load_label(os.path.join(label_dir, "train.csv"), configs["seed"])
+    val_df = load_label(os.path.join(label_dir, "val.csv"), configs["seed"])
+    logging.info("TRAIN:")
+    logging.info(train_df["label"].value_counts())
+    logging.info("VAL:")
+    logging.info(val_df["label"].value_counts())
+
+    # Cache
+    if cache:
+        cache_start = time.time()
+        volumes, index = pack_training_cache(data_dir=data_dir,
+                                             filenames=pd.concat([train_df, val_df])["heart_name"].tolist(),
+                                             target_size=configs["input_size"],
+                                             cache_dir=cache_dir,
+                                             nthreads=nworkers)
+        logging.info("Cache time: {}".format(
+            time.strftime("%Hh%Mm%Ss", time.gmtime(time.time() - cache_start))))
+
+    # Optimizer, loss
+    lr_scheduler = tf.keras.optimizers.schedules.ExponentialDecay(initial_learning_rate=configs["lr"],
+                                                                  decay_steps=1000,
+                                                                  decay_rate=configs["decay"])
+    optimizer = tf.keras.optimizers.SGD(learning_rate=lr_scheduler,
+                                        momentum=configs["momentum"],
+                                        nesterov=True)
+    if configs["loss_fn"] == "categorical_crossentropy":
+        loss_fn = tf.keras.losses.CategoricalCrossentropy()
+    else:
+        loss_fn = tf.keras.losses.BinaryCrossentropy()
+
+    if configs["class_weights"]:
+        weights = class_weight.compute_class_weight(class_weight="balanced",
+                                                    classes=np.unique(train_df["label"]),
+                                                    y=train_df["label"].values)
+        weights = {i: weights[i] for i in range(len(train_df["label"].unique()))}
+    else:
+        weights = None
+    logging.info("Class weights: {}".format(weights))
+
+    model = MouseCHD(model_name=configs["model_name"],
+                     input_size=configs["input_size"],
+                     n_classes=configs["n_classes"],
+                     first_filters=configs["first_filters"],
+                     mask_depth=configs["mask_depth"],
+                     is_bn_mask=configs["is_bn_mask"]).build_model()
+    initial_epoch = resume_or_initialize(model, save_dir, configs, data_dir, train_df, val_df)
+
+    # Callbacks
+    save_model_name = "best_model.hdf5" if configs["save_best"] else "epoch-{epoch:03d}.hdf5"
+    callbacks = [ModelCheckpoint(os.path.join(save_dir, save_model_name),
+                                 monitor=configs["monitor"],
+                                 verbose=1,
+                                 save_best_only=configs["save_best"],
+                                 save_weights_only=True,
+                                 save_freq="epoch"),
+                 TensorBoard(log_dir=os.path.join(log_dir, exp), update_freq="batch"),
+                 CSVLogger(os.path.join(save_dir, "train.csv"), append=True),
+                 EpochTimer()]
+    early_stop = EarlyStopping(configs["monitor"], patience=configs["patience"])
+    callbacks.append(early_stop)
+    if time_budget is not None:
+        budget = TimeBudget(time_budget)
+        callbacks.append(budget)
+
+    # Data generators
+    gen_kwargs = dict(batch_size=configs["batch_size"],
+                      target_size=configs["input_size"],
+                      seed=configs["seed"],
+                      n_classes=configs["n_classes"],
+                      class_weights=weights)
+    if cache:
+        train_gen = CachedGen(volumes=volumes,
+                              index=index,
+                              filenames=train_df["heart_name"].values,
+                              labels=train_df["label"].values,
+                              stage="train",
+                              **gen_kwargs)
+        val_gen = CachedGen(volumes=volumes,
+                            index=index,
+                            filenames=val_df["heart_name"].values,
+                            labels=val_df["label"].values,
+                            stage="val",
+                            **gen_kwargs)
+    else:
+        train_gen = MouseCHDGen(imdir=data_dir,
+                                filenames=train_df["heart_name"].values,
+                                labels=train_df["label"].values,
+                                stage="train",
+                                augment=configs["augment"],
+                                **gen_kwargs)
+        val_gen = MouseCHDGen(imdir=data_dir,
+                              filenames=val_df["heart_name"].values,
+                              labels=val_df["label"].values,
+                              stage="val",
+                              augment=None,
+                              **gen_kwargs)
+
+    if weights is not None:
+        model.compile(loss=loss_fn, optimizer=optimizer, metrics=["accuracy",
+                                                                  tf.keras.metrics.Recall(),
+                                                                  tf.keras.metrics.Precision()],
+                      weighted_metrics=["accuracy"])
+    else:
+        model.compile(loss=loss_fn, optimizer=optimizer, metrics=["accuracy",
+                                                                  tf.keras.metrics.Recall(),
+                                                                  tf.keras.metrics.Precision()])
+
+    logging.info("="*15 + "//" + "="*15)
+    logging.info("TRAIN")
+    train_start = time.time()
+    with trace("fit", epochs=configs["epochs"]):
+        model.fit(train_gen,
+                  validation_data=val_gen,
+                  epochs=configs["epochs"],
+                  initial_epoch=initial_epoch,
+                  verbose=1,
+                  callbacks=callbacks,
+                  workers=max(1, nworkers),
+                  use_multiprocessing=False,
+                  max_queue_size=2*max(1, nworkers))
+    logging.info("Training time (hours): {}".format((time.time() - train_start) / 3600))
+
+    if (time_budget is not None) and budget.stopped:
+        stop_reason = "time_budget"
+    elif early_stop.stopped_epoch > 0:
+        stop_reason = "early_stopping"
+    else:
+        stop_reason = "completed"
+    logging.info("Stopped at epoch {} ({})".format(stopped_epoch(save_dir), stop_reason))
+
+    return model, stop_reason
+
+
+##########################
+# RETRAINING EXPERIMENTS #
+##########################
+def prepare_configs(base_configs, path, **overrides):
+    """Write a copy of `base_configs` with overridden values (None is ignored)
+    """
+    with open(base_configs, "r") as f:
+        configs = json.load(f)
+    configs.update({k: v for k, v in overrides.items() if v is not None})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(configs, f, indent=1)
+
+    return path
+
+
+def base_heart_name(filename):
+    """'images/heart' or 'images_x5/heart_03' -> 'heart'
+    """
+    parts = re.split(r"[\\/]", filename)
+    if (len(parts) > 1) and (parts[-2] == "images_x5"):
+        return re.sub(r"_\d{2}$", "", parts[-1])
+
+    return parts[-1]
+
+
+def split_incremental(label_dir, outdir, trained_file, replay=0.2, seed=42):
+    """Select new hearts plus a replay sample of previously trained hearts.
+
+    Args:
+        label_dir (str): directory containing the full train.csv and val.csv
+        outdir (str): output label directory
+        trained_file (str): csv of hearts used by previous trainings
+        replay (float, optional): fraction of old hearts replayed. Defaults to 0.2.
+        seed (int, optional): random seed. Defaults to 42.
+
+    Returns:
+        tuple: (number of new hearts, number of replayed hearts)
+    """
+    train_df = pd.read_csv(os.path.join(label_dir, "train.csv"))
+    hearts = train_df["heart_name"].map(base_heart_name)
+    try:
+        trained = set(pd.read_csv(trained_file)["heart_name"].astype(str))
+    except FileNotFoundError:
+        trained = set()
+
+    new = sorted(set(hearts) - trained)
+    old = sorted(set(hearts) & trained)
+    assert len(new) > 0, "No new hearts to train on. Use full retraining instead."
+
+    n_replay = min(len(old), int(np.ceil(replay * len(old))))
+    replayed = list(pd.Series(old, dtype=object).sample(n=n_replay, random_state=seed)) if n_replay > 0 else []
+
+    os.makedirs(outdir, exist_ok=True)
+    train_df[hearts.isin(new + replayed)].to_csv(os.path.join(outdir, "train.csv"), index=False)
+    shutil.copy2(os.path.join(label_dir, "val.csv"), os.path.join(outdir, "val.csv"))
+
+    return len(new), len(replayed)
+
+
+def record_run(retrain_dir, save_dir, label_dir, exp, mode, epochs, train_time, epochs_run=None, register=True, **extra):
+    """Save the run in `save_dir/summary.json`. With `register`, the run is
+    also added to `retrain_dir/runs.csv` and its hearts to the trained hearts.
+    `epochs_run` (default `epochs`) are the epochs `train_time` covers, fewer
+    than `epochs` after early stopping. `extra` items are added to the
+    summary.
+
+    Returns:
+        dict: run summary (with estimated saving for incremental runs)
+    """
+    train_df = pd.read_csv(os.path.join(label_dir, "train.csv"))
+    hearts = sorted(set(train_df["heart_name"].map(base_heart_name)))
+    run = {"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+           "exp": exp,
+           "mode": mode,
+           "n_hearts": len(hearts),
+           "n_samples": len(train_df),
+           "epochs": epochs,
+           "epochs_run": epochs if epochs_run is None else epochs_run,
+           "train_time": train_time}
+
+    runs_path = os.path.join(retrain_dir, "runs.csv")
+    try:
+        runs = pd.read_csv(runs_path)
+    except FileNotFoundError:
+        runs = pd.DataFrame(columns=RUN_HEADERS)
+    if "epochs_run" not in runs.columns:
+        # Runs recorded before early stopping: all epochs ran
+        runs = runs.reindex(columns=RUN_HEADERS)
+        runs["epochs_run"] = runs["epochs"]
+
+    if mode == "incremental":
+        # Time of a full retrain on all hearts, from the last full run if any
+        full_samples = len(pd.read_csv(os.path.join(retrain_dir, "label", "train.csv")))
+        full_runs = runs[runs["mode"] == "full"]
+        if len(full_runs) > 0:
+            ref = full_runs.iloc[-1]
+            per_sample = ref["train_time"] / (ref["n_samples"] * max(ref["epochs_run"], 1))
+        else:
+            per_sample = train_time / (len(train_df) * max(run["epochs_run"], 1))
+        run["full_time_estimate"] = per_sample * full_samples * run["epochs_run"]
+        run["time_saved"] = run["full_time_estimate"] - train_time
+
+    if register:
+        runs.loc[len(runs), :] = [run[k] for k in RUN_HEADERS]
+        runs.to_csv(runs_path, index=False)
+
+        trained_path = os.path.join(retrain_dir, "trained.csv")
+        try:
+            trained = set(pd.read_csv(trained_path)["heart_name"].astype(str))
+        except FileNotFoundError:
+            trained = set()
+        pd.DataFrame({"heart_name": sorted(trained | set(hearts))}).to_csv(trained_path, index=False)
+
+    run.update(extra)
+    os.makedirs(save_dir, exist_ok=True)
+    with open(os.path.join(save_dir, "summary.json"), "w") as f:
+        json.dump(run, f, indent=1)
+
+    return run
@@ -1,25 +1,33 @@
 import logging
 from pathlib import Path
 import os
+import re
+import time
 import tempfile
 import subprocess
 import shutil
 
 import numpy as np
+import pandas as pd
 import SimpleITK as sitk
 
-import tensorflow as tf
-
-from mousechd.datasets.preprocess import Preprocess
-from mousechd.datasets.resample import resample_folder
-from mousechd.segmentation.segment import segment_from_folder
+# TensorFlow, scikit-learn and the preprocessing modules of mousechd are
+# imported by the functions using them: the widget and the reader start
+# without them
 from mousechd.datasets.utils import (crop_heart_bbx,
+                                     get_largest_connectivity,
                                      maskout_non_heart,
                                      norm_min_max,
                                      resample3d)
 from mousechd.utils.tools import CACHE_DIR
 from mousechd.classifier.utils import CLF_DIR
-from mousechd.classifier.gradcam import GradCAM3D
+
+from ._profiling import trace, traced
+from ._profiles import PROFILES, default_profile
+from ._capabilities import cuda_available
+from ._models import classifier_inputs, heart_key
+from ._masks import to_heatmap, find_mask, read_mask, compact_mask, compact_mask_folder, expand_mask_folder, RLE_EXT, NIFTI_EXT
+from ._threads import segmentation_plan, stage_threads
 
 tmp_dir = os.path.join(tempfile.gettempdir(), "MouseCHD")
 os.makedirs(tmp_dir, exist_ok=True)
@@ -57,6 +65,74 @@ def get_relative_sever_dir(shared_folder, path):
         logging.info(f"Path {path} is not on shared folder!")
     
 
+def nnunet_predict(indir,
+                   outdir,
+                   profile,
+                   step_size=None,
+                   nthreads_preprocessing=6,
+                   nthreads_nifti=2):
+    """Segment the scans of `indir` with the folds and test-time augmentation
+    of `profile`. `step_size` overrides the step of the profile. Processes and
+    threads are taken from the thread budget (see `segmentation_plan`).
+    """
+    from nnunet.inference.predict import predict_from_folder
+    from mousechd.segmentation.utils import SEG_DIR, download_seg_models
+    
+    settings = PROFILES[profile]
+    step_size = settings["step_size"] if step_size is None else step_size
+    download_seg_models()
+    os.makedirs(outdir, exist_ok=True)
+    n_cases = len([x for x in os.listdir(indir) if x.endswith("_0000.nii.gz")])
+    plan = segmentation_plan(n_cases, nthreads_preprocessing, nthreads_nifti)
+    logging.info(f"Threads: {plan}")
+    start = time.time()
+    with stage_threads(plan["inference"], sitk_threads=plan["sitk"]):
+        predict_from_folder(model=SEG_DIR,
+                            input_folder=indir,
+                            output_folder=outdir,
+                            folds=settings["folds"],
+                            save_npz=False,
+                            num_threads_preprocessing=plan["preprocessing"],
+                            num_threads_nifti_save=plan["nifti"],
+                            lowres_segmentations=None,
+                            part_id=0,
+                            num_parts=1,
+                            tta=settings["tta"],
+                            overwrite_existing=False,
+                            mode="normal",
+                            overwrite_all_in_gpu=None,
+                            mixed_precision=True,
+                            step_size=step_size,
+                            checkpoint_name="model_final_checkpoint")
+    logging.info("Segmentation ({} profile): {:.1f}s".format(profile, time.time() - start))
+
+
+def server_segment_args(profile, step_size=None):
+    """Options of `mousechd segment` for a profile. The server command has no
+    test-time augmentation option: "full" runs as "accurate".
+    """
+    settings = PROFILES[profile]
+    step_size = settings["step_size"] if step_size is None else step_size
+    args = f"-step_size {step_size}"
+    if settings["folds"] is not None:
+        args += f" -fold {settings['folds'][0]}"
+    if settings["tta"]:
+        logging.info("Test-time augmentation is not available on server")
+    
+    return args
+
+
+def get_cpu_runtime(cpu_runtime):
+    """CPU runtime settings if asked for and segmenting on CPU, else None
+    """
+    from ._runtime import cpu_runtime_settings
+    
+    if (not cpu_runtime) or cuda_available():
+        return None
+    return cpu_runtime_settings()
+
+
+@traced()
 def segment_heart(resrc,
                   nthreads_preprocessing,
                   nthreads_nifti,
@@ -69,36 +145,49 @@ def segment_heart(resrc,
                   slurm=False,
                   slurm_cmd=SLURM_CMD,
                   module=False,
-                  module_ls=MODULE_LS
+                  module_ls=MODULE_LS,
+                  profile=None,
+                  nworkers=1,
+                  cpu_runtime=False,
+                  quantized=False
                   ):
+    profile = profile or default_profile()
     outdir = os.path.join(workdir, "HeartSeg")
-    # Check if the mask is exist
-    if not os.path.isfile(os.path.join(outdir, f"{heart_name}.nii.gz")):
+    # Check if the mask is exist (compact or NIfTI)
+    if find_mask(outdir, heart_name) is None:
         indir = os.path.join(workdir, "processed", heart_name)
         os.makedirs(indir, exist_ok=True)
-        shutil.copy2(os.path.join(tmp_dir, f"{heart_name}.nii.gz"),
-                    os.path.join(indir, f"{heart_name}_0000.nii.gz"))
+        with trace("prepare_input"):
+            shutil.copy2(os.path.join(tmp_dir, f"{heart_name}.nii.gz"),
+                        os.path.join(indir, f"{heart_name}_0000.nii.gz"))
           
         if resrc == "local":
-            import torch
-            if torch.cuda.is_available():
-                print("Segmentation with full mode")
-                segment_from_folder(indir=os.path.join(workdir, "processed", heart_name),
-                                    outdir=os.path.join(workdir, "HeartSeg"),
-                                    step_size=step_size,
-                                    num_threads_preprocessing=nthreads_preprocessing,
-                                    num_threads_nifti_save=nthreads_nifti)
-            else:
-                print("Segmentation with minimal mode")
-                segment_from_folder(indir=os.path.join(workdir, "processed", heart_name),
-                                    outdir=os.path.join(workdir, "HeartSeg"),
-                                    folds=0,
-                                    step_size=step_size,
-                                    num_threads_preprocessing=nthreads_preprocessing,
-                                    num_threads_nifti_save=nthreads_nifti)
+            print(f"Segmentation with {profile} profile")
+            runtime = get_cpu_runtime(cpu_runtime)
+            with trace("segment_load_infer", profile=profile, nworkers=nworkers, cpu_runtime=runtime is not None, quantized=quantized):
+                if (nworkers > 1) or (runtime is not None) or quantized:
+                    # Own sliding window: tiles and folds split across
+                    # processes, tuned CPU runtime, int8 model
+                    from ._tiled import segment_progressive
+                    for _ in segment_progressive(input_path=os.path.join(indir, f"{heart_name}_0000.nii.gz"),
+                                                 output_path=os.path.join(outdir, f"{heart_name}.nii.gz"),
+                                                 profile=profile,
+                                                 step_size=step_size,
+                                                 n_workers=nworkers,
+                                                 runtime=runtime,
+                                                 quantized=quantized):
+                        pass
+                else:
+                    nnunet_predict(indir=indir,
+                                   outdir=outdir,
+                                   profile=profile,
+                                   step_size=step_size,
+                                   nthreads_preprocessing=nthreads_preprocessing,
+                                   nthreads_nifti=nthreads_nifti)
         else:
             print("Run on server")
-            server_home = subprocess.getoutput(f'ssh {servername} "pwd"')
+            with trace("ssh", cat="remote", step="home"):
+                server_home = subprocess.getoutput(f'ssh {servername} "pwd"')
             
             print(f"server home: {server_home}")
 
@@ -122,17 +211,43 @@ def segment_heart(resrc,
             
             print(cmd)
             
-            out = subprocess.getoutput(f'ssh {servername} "{cmd} -indir {server_home}/DATA/{server_indir} -outdir {server_home}/DATA/{server_outdir}"')
+            with trace("ssh", cat="remote", step="command"):
+                out = subprocess.getoutput(f'ssh {servername} "{cmd} -indir {server_home}/DATA/{server_indir} -outdir {server_home}/DATA/{server_outdir} {server_segment_args(profile, step_size)}"')
             
             print(out)
             
             shutil.rmtree(indir)
         
-    img = sitk.ReadImage(os.path.join(outdir, f"{heart_name}.nii.gz"))
+    with trace("read_mask"):
+        mask_path = find_mask(outdir, heart_name)
+        ma, geometry = read_mask(mask_path)
+    # Masks are cached in the compact format (bounding box + run lengths)
+    with trace("compact_mask"):
+        compact_mask(mask_path, mask=ma, geometry=geometry)
     
-    return sitk.GetArrayFromImage(img)
+    return ma
 
 
+def segment_heart_progressive(workdir, heart_name, step_size=None, profile=None, nworkers=1, cpu_runtime=False, quantized=False):
+    """Segment a heart on local like `segment_heart`, tile by tile. Yields the
+    progress and preview masks of `segment_progressive`; the mask is then read
+    with `segment_heart`.
+    """
+    from ._tiled import segment_progressive
+    
+    profile = profile or default_profile()
+    print(f"Segmentation with {profile} profile, with previews")
+    with trace("segment_load_infer", profile=profile, nworkers=nworkers, progressive=True):
+        yield from segment_progressive(input_path=os.path.join(tmp_dir, f"{heart_name}.nii.gz"),
+                                       output_path=os.path.join(workdir, "HeartSeg", f"{heart_name}.nii.gz"),
+                                       profile=profile,
+                                       step_size=step_size,
+                                       n_workers=nworkers,
+                                       runtime=get_cpu_runtime(cpu_runtime),
+                                       quantized=quantized)
+
+
+@traced()
 def segment_hearts(resrc,
                    nthreads_preprocessing,
                    nthreads_nifti,
@@ -144,33 +259,48 @@ def segment_hearts(resrc,
                    slurm=False,
                    slurm_cmd=SLURM_CMD,
                    module=False,
-                   module_ls=MODULE_LS):
+                   module_ls=MODULE_LS,
+                   profile=None):
     
+    profile = profile or default_profile()
     outdir = os.path.join(workdir, "HeartSeg")
     indir = os.path.join(workdir, "retrain", "processed", "images")
     
     if resrc == "local":
-        import torch
-        if torch.cuda.is_available():
-            print("Segmentation with full mode")
-            segment_from_folder(indir=indir,
-                                outdir=outdir,
-                                step_size=step_size,
-                                num_threads_preprocessing=nthreads_preprocessing,
-                                num_threads_nifti_save=nthreads_nifti)
-            
-        else:
-            print("Segmentation with minimal model")
-            segment_from_folder(indir=indir,
-                                outdir=outdir,
-                                folds=0,
-                                step_size=step_size,
-                                num_threads_preprocessing=nthreads_preprocessing,
-                                num_threads_nifti_save=nthreads_nifti)
+        print(f"Segmentation with {profile} profile")
+        # nnU-Net only skips hearts with a NIfTI mask: hearts with a compact
+        # mask are left out of its input folder
+        cases = [x for x in os.listdir(indir) if x.endswith("_0000.nii.gz")]
+        todo = [x for x in cases if find_mask(outdir, re.sub(r"_0000.nii.gz$", "", x)) is None]
+        todo_dir = indir
+        if len(todo) < len(cases):
+            todo_dir = tempfile.mkdtemp(prefix="mousechd_seg_")
+            for x in todo:
+                try:
+                    os.symlink(os.path.abspath(os.path.join(indir, x)), os.path.join(todo_dir, x))
+                except OSError:
+                    shutil.copy2(os.path.join(indir, x), os.path.join(todo_dir, x))
+        try:
+            if len(todo) > 0:
+                nnunet_predict(indir=todo_dir,
+                               outdir=outdir,
+                               profile=profile,
+                               step_size=step_size,
+                               nthreads_preprocessing=nthreads_preprocessing,
+                               nthreads_nifti=nthreads_nifti)
+        finally:
+            if todo_dir != indir:
+                shutil.rmtree(todo_dir, ignore_errors=True)
 
     else:
         print("Segment on server")
-        server_home = subprocess.getoutput(f'ssh {servername} "pwd"')
+        # The server nnU-Net only skips hearts with a NIfTI mask: compact
+        # masks (segmented in the widget or by an earlier run) get a NIfTI
+        # copy for the call
+        with trace("expand_masks"):
+            nifti_copies = expand_mask_folder(outdir) if os.path.isdir(outdir) else []
+        with trace("ssh", cat="remote", step="home"):
+            server_home = subprocess.getoutput(f'ssh {servername} "pwd"')
         
         print(f"server home: {server_home}")
 
@@ -194,38 +324,126 @@ def segment_hearts(resrc,
         
         print(cmd)
         
-        out = subprocess.getoutput(f'ssh {servername} "{cmd} -indir {server_home}/DATA/{server_indir} -outdir {server_home}/DATA/{server_outdir}"')
+        try:
+            with trace("ssh", cat="remote", step="command"):
+                out = subprocess.getoutput(f'ssh {servername} "{cmd} -indir {server_home}/DATA/{server_indir} -outdir {server_home}/DATA/{server_outdir} {server_segment_args(profile, step_size)}"')
+        finally:
+            for path in nifti_copies:
+                os.remove(path)
         
         print(out)
 
-def resample_im(im, ma):
-    cropped_im, cropped_ma = crop_heart_bbx(im, ma, pad=(5,5,5))
-    resampled_im = maskout_non_heart(cropped_im, cropped_ma)
+@traced("component_cleanup")
+def clean_mask(heart):
+    """Keep only the largest connected component of the heart mask (in place)
+    """
+    max_clump = get_largest_connectivity(heart)
+    heart[max_clump==0] = 0
+    
+    return heart
+
+
+def resample_im(im, ma, crop=True):
+    """Heart cropped (unless `crop` is False: already cropped), masked out
+    and normalized
+    """
+    if crop:
+        im, ma = crop_heart_bbx(im, ma, pad=(5,5,5))
+    resampled_im = maskout_non_heart(im, ma)
     
     return norm_min_max(resampled_im)
     
     
 
-def diagnose_heart(model, im, heart):
+def classifier_input(im, heart, input_shape):
+    """Heart cropped, masked out, normalized and resampled to the input shape
+    of the classifier. Inputs are cached by heart content and input shape,
+    so diagnosing the same heart with another model only costs the crop.
+
+    Returns:
+        tuple: input batch (1, *input_shape, 1), shape of the cropped heart
+    """
+    cropped_im, cropped_ma = crop_heart_bbx(im, heart, pad=(5,5,5))
+    key = (heart_key(cropped_im, cropped_ma), tuple(input_shape))
+    cached = classifier_inputs.get(key)
+    if cached is not None:
+        logging.info("Classifier input from cache")
+        return cached
     
-    resampled_im = resample_im(im=im, ma=heart)
-    input_shape = model.layers[0].output_shape[0][1:4]
+    resampled_im = resample_im(cropped_im, cropped_ma, crop=False)
     img = sitk.GetImageFromArray(resampled_im)
     img.SetSpacing((0.02, 0.02, 0.02))
     img = resample3d(img, input_shape[::-1])
-    im = sitk.GetArrayFromImage(img)
-    im = norm_min_max(im)
-    im = np.expand_dims(im, axis=3)
-    im = np.expand_dims(im, axis=0)
+    x = norm_min_max(sitk.GetArrayFromImage(img))
+    x = np.expand_dims(x, axis=3)
+    x = np.expand_dims(x, axis=0)
+    # Read-only: the cached array is shared between calls
+    x.flags.writeable = False
+    classifier_inputs.put(key, (x, resampled_im.shape))
+    
+    return x, resampled_im.shape
+    
+
+def gradcam_heatmap(model, x, class_idx):
+    """GradCAM of `GradCAM3D.compute_heatmap` at the resolution of the
+    feature map: no upsampling to the heart shape, see `gradcam_geometry`.
+    """
+    import tensorflow as tf
+    from tensorflow.keras import Model
+    from mousechd.classifier.gradcam import GradCAM3D
+    
+    layer_name = GradCAM3D(model).layerName
+    grad_model = Model(inputs=[model.inputs],
+                       outputs=[model.get_layer(layer_name).output, model.output])
+    with tf.GradientTape() as tape:
+        conv_outs, preds = grad_model(tf.cast(x, tf.float32))
+        loss = preds[:, class_idx]
+    grads = tape.gradient(loss, conv_outs)[0]
+    conv_outs = conv_outs[0]
+    norm_grads = tf.divide(grads, tf.reduce_mean(tf.square(grads)) + tf.constant(1e-5))
+    weights = tf.reduce_mean(norm_grads, axis=(0, 1, 2))
+    cam = np.maximum(tf.reduce_sum(tf.multiply(weights, conv_outs), axis=-1).numpy(), 0)
+    cam = np.pad(cam, ((3,3), (3,3), (3,3)), "constant")
+    
+    return (cam - cam.min()) / (cam.max() - cam.min())
+
+
+def gradcam_geometry(cam_shape, cropped_shape):
+    """Voxel size and offset of a coarse GradCAM in voxels of the cropped
+    heart, so that the viewer places it where the former resize to the
+    cropped shape did (pixel edges aligned).
+
+    Returns:
+        tuple: scale, translate
+    """
+    factors = [c / p for c, p in zip(cropped_shape, cam_shape)]
+    
+    return factors, [0.5 * f - 0.5 for f in factors]
+
+
+@traced()
+def diagnose_heart(model, im, heart):
+    """Classify a heart and compute its GradCAM at feature-map resolution.
+
+    Returns:
+        tuple: predictions, GradCAM (float16), (scale, translate) of the
+            GradCAM in voxels of the heart bounding box (pad 5)
+    """
+    import tensorflow as tf
+    
+    with trace("classifier_preprocess"):
+        input_shape = model.layers[0].output_shape[0][1:4]
+        im, cropped_shape = classifier_input(im, heart, input_shape)
     
-    preds = model.predict(tf.convert_to_tensor(im))[0]
+    with trace("predict"):
+        preds = model.predict(tf.convert_to_tensor(im))[0]
     
     # GradCAM
-    class_idx = np.argmax(preds)
-    grad_model = GradCAM3D(model)
-    gradcam = grad_model.compute_heatmap(im, classIdx=class_idx, upsample_size=resampled_im.shape)
+    with trace("gradcam"):
+        class_idx = np.argmax(preds)
+        gradcam = to_heatmap(gradcam_heatmap(model, im, class_idx))
     
-    return preds, gradcam   
+    return preds, gradcam, gradcam_geometry(gradcam.shape, cropped_shape)   
 
 
 def find_format(indir):
@@ -241,6 +459,7 @@ def find_format(indir):
         return "Unknown"
 
 
+@traced()
 def preprocess(indir, 
                outdir,
                pp_resrc="local",
@@ -252,6 +471,7 @@ def preprocess(indir,
                module=False,
                module_ls=MODULE_LS
                ):
+    from mousechd.datasets.preprocess import Preprocess
     
     fmt = find_format(indir)
     database = os.path.dirname(indir)
@@ -265,7 +485,8 @@ def preprocess(indir,
                    ).preprocess()
     else:
         print("Prepocess on server")
-        server_home = subprocess.getoutput(f'ssh {servername} "pwd"')
+        with trace("ssh", cat="remote", step="home"):
+            server_home = subprocess.getoutput(f'ssh {servername} "pwd"')
 
         logging.info(f"database: {database}")
         logging.info(f"shared_folder: {shared_folder}")
@@ -288,11 +509,90 @@ def preprocess(indir,
 
         print(cmd)
             
-        out = subprocess.getoutput(f'ssh {servername} "{cmd} -database {database} -imdir {imdir} -outdir {outdir} -im_format {fmt} -logfile {logfile}"')
+        with trace("ssh", cat="remote", step="command"):
+            out = subprocess.getoutput(f'ssh {servername} "{cmd} -database {database} -imdir {imdir} -outdir {outdir} -im_format {fmt} -logfile {logfile}"')
         
         print(out)
     
 
+def resample_compact(imdir,
+                     maskdir,
+                     outdir,
+                     metafile=None,
+                     meta_sep=",",
+                     save_images=False):
+    """`resample_folder` of mousechd with masks in the compact format or
+    NIfTI: only the region of the heart (bounding box + 5 voxels) is
+    decoded, labelled and cropped, with the same outputs.
+    """
+    from mousechd.datasets.resample import create_resampling_df
+    from mousechd.datasets.utils import split_slices
+    
+    if save_images:
+        os.makedirs(os.path.join(outdir, "images"), exist_ok=True)
+    os.makedirs(os.path.join(outdir, "images_x5"), exist_ok=True)
+    
+    filenames = sorted(set(re.sub(r"({}|{})$".format(re.escape(RLE_EXT), re.escape(NIFTI_EXT)), "", x)
+                           for x in os.listdir(maskdir)
+                           if (not x.startswith(".")) and x.endswith((RLE_EXT, NIFTI_EXT))))
+    logging.info("Number of masks in maskdir: {}".format(len(filenames)))
+    
+    if metafile is not None:
+        meta = pd.read_csv(metafile, sep=meta_sep)
+        meta = meta[meta["Stage"].isin(["E18.5", "P0", "E17.5"])]
+        meta = meta[~meta["heart_name"].isin(["N_261h", "NH_229m"])] # error images
+        logging.info("Number of images from metafile: {}".format(len(meta)))
+        filenames = [x for x in filenames if x in meta["heart_name"].values]
+        logging.info("Final number of images: {}".format(len(filenames)))
+        meta.to_csv(os.path.join(outdir, os.path.basename(metafile)), index=False)
+    
+    df = create_resampling_df(outdir=outdir)
+    filenames = [x for x in filenames if x not in df["heart_name"].tolist()]
+    logging.info("Need to process: {}".format(len(filenames)))
+    
+    for i, heart_name in enumerate(filenames):
+        logging.info("{}. {}".format(i+1, heart_name))
+        
+        img = sitk.ReadImage(os.path.join(imdir, f"{heart_name}_0000.nii.gz"))
+        spaces = img.GetSpacing()
+        # Same crop as on the whole volume: the heart and its padding are
+        # inside the mask bounding box + 5 voxels
+        ma, geometry = read_mask(find_mask(maskdir, heart_name), crop=True, pad=5)
+        region = tuple(slice(o, o + n) for o, n in zip(geometry["offset"], ma.shape))
+        im = sitk.GetArrayFromImage(img)[region]
+        try:
+            max_clump = get_largest_connectivity(ma)
+        except AssertionError:
+            df.loc[len(df), :] = [heart_name] + ["Error"] * 6
+            logging.info("=> Error!")
+            continue
+        
+        cropped_im, cropped_ma = crop_heart_bbx(im, max_clump, pad=(5,5,5))
+        resampled_im = maskout_non_heart(cropped_im, cropped_ma)
+        resampled_im = norm_min_max(resampled_im)
+        
+        if save_images:
+            resampled_img = sitk.GetImageFromArray(resampled_im)
+            resampled_img.SetSpacing(spaces)
+            sitk.WriteImage(resampled_img, os.path.join(outdir, "images", f"{heart_name}.nii.gz"))
+        
+        for j in range(5):
+            resampled_x5 = split_slices(resampled_im, start=j, step=5, dim=0)
+            resampled_img = sitk.GetImageFromArray(resampled_x5)
+            resampled_img.SetSpacing((spaces[0], spaces[1], spaces[2]*5))
+            sitk.WriteImage(resampled_img, os.path.join(outdir, "images_x5", "{}_{:02d}.nii.gz".format(heart_name, j+1)))
+        
+        df.loc[len(df), :] = [heart_name,
+                              str(resampled_im.shape),
+                              str(spaces),
+                              cropped_im.max(),
+                              cropped_im.min(),
+                              cropped_im.mean(),
+                              cropped_im.std()]
+        df.to_csv(os.path.join(outdir, "resampled.csv"), index=False)
+    
+
+@traced()
 def resample(workdir,
              pp_resrc="local",
              servername="",
@@ -303,22 +603,28 @@ def resample(workdir,
              module=False,
              module_ls=MODULE_LS
              ):
-    
     indir = os.path.join(workdir, "retrain", "processed", "images")
     maskdir = os.path.join(workdir, "HeartSeg")
     outdir = os.path.join(workdir, "retrain", "resampled")
     metafile = os.path.join(workdir, "retrain", "processed", "metadata.csv")
     if pp_resrc == "local":
         print("Resample on local")
-        resample_folder(imdir=indir,
-                        maskdir=maskdir,
-                        outdir=outdir,
-                        metafile=metafile,
-                        meta_sep=",",
-                        save_images=True)
+        resample_compact(imdir=indir,
+                         maskdir=maskdir,
+                         outdir=outdir,
+                         metafile=metafile,
+                         meta_sep=",",
+                         save_images=True)
+        # Masks are not needed as NIfTI on local anymore
+        compact_mask_folder(maskdir)
     else:
         print("Resample on server")
-        server_home = subprocess.getoutput(f'ssh {servername} "pwd"')
+        # mousechd resample reads NIfTI masks: compact masks (segmented
+        # locally or by an earlier run) get a NIfTI copy for the call
+        with trace("expand_masks"):
+            nifti_copies = expand_mask_folder(maskdir)
+        with trace("ssh", cat="remote", step="home"):
+            server_home = subprocess.getoutput(f'ssh {servername} "pwd"')
         indir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, indir)
         maskdir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, maskdir)
         outdir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, outdir)
@@ -339,11 +645,65 @@ def resample(workdir,
 
         print(cmd)
         
-        out = subprocess.getoutput(f'ssh {servername} "{cmd} -imdir {indir}" -maskdir {maskdir} -outdir {outdir} -metafile {metafile} -save_images 1 -logfile {logfile}')
+        try:
+            with trace("ssh", cat="remote", step="command"):
+                out = subprocess.getoutput(f'ssh {servername} "{cmd} -imdir {indir}" -maskdir {maskdir} -outdir {outdir} -metafile {metafile} -save_images 1 -logfile {logfile}')
+        finally:
+            for path in nifti_copies:
+                os.remove(path)
         
         print(out)
         
 
+@traced("metadata")
+def make_retrain_metadata(retrain_dir):
+    """Metadata of preprocessed hearts, labels from their CHD/Normal folder
+    """
+    df = pd.read_csv(os.path.join(retrain_dir, "processed", "processed.csv"))
+    df["Stage"] = "E18.5"
+    df["Normal heart"] = (df["folder"].str.split(os.sep, expand=True)[0] == "Normal") * 1
+    df["CHD"] = (df["folder"].str.split(os.sep, expand=True)[0] == "CHD") * 1
+    df[["heart_name", "Stage", "Normal heart", "CHD"]].to_csv(os.path.join(retrain_dir, "processed", "metadata.csv"),
+                                                              index=False)
+    
+    return df
+
+
+@traced("split")
+def split_retrain_data(retrain_dir, df, test_size=0.2, seed=42):
+    """Split successfully resampled hearts in train/val and write
+    `label/train.csv` and `label/val.csv` with their x5 resampled versions.
+
+    Returns:
+        tuple: train_df, val_df, merged_train_df, merged_val_df
+    """
+    from sklearn.model_selection import train_test_split
+    from mousechd.datasets.preprocess import x5_df, merge_base_x5_labels
+    
+    os.makedirs(os.path.join(retrain_dir, "label"), exist_ok=True)
+    res_df = pd.read_csv(os.path.join(retrain_dir, "resampled", "resampled.csv"))
+    res_df = res_df[res_df["resampled_size"] != "Error"]
+    df = df[df["heart_name"].isin(res_df["heart_name"].tolist())]
+    df.reset_index(drop=True, inplace=True)
+    df["label"] = (df["CHD"] == 1)*1
+    
+    X_train, X_val, _, _ = train_test_split(df["heart_name"].tolist(),
+                                            df["label"].tolist(),
+                                            test_size=test_size,
+                                            random_state=seed)
+    train_df = df[df["heart_name"].isin(X_train)][["heart_name", "label"]]
+    val_df = df[df["heart_name"].isin(X_val)][["heart_name", "label"]]
+    train_df_x5 = x5_df(train_df)
+    val_df_x5 = x5_df(val_df)
+    merged_train_df = merge_base_x5_labels(df=train_df, df_x5=train_df_x5)
+    merged_val_df = merge_base_x5_labels(df=val_df, df_x5=val_df_x5)
+    merged_train_df.to_csv(os.path.join(retrain_dir, "label", "train.csv"), index=False)
+    merged_val_df.to_csv(os.path.join(retrain_dir, "label", "val.csv"), index=False)
+    
+    return train_df, val_df, merged_train_df, merged_val_df
+        
+
+@traced()
 def retrain(resrc,
             retrain_dir,
             outdir,
@@ -355,47 +715,104 @@ def retrain(resrc,
             slurm=False,
             slurm_cmd=SLURM_CMD,
             module=False,
-            module_ls=MODULE_LS
+            module_ls=MODULE_LS,
+            cache=False,
+            nworkers=4,
+            mode="full",
+            init_model=None,
+            replay=0.2,
+            patience=None,
+            time_budget=None,
+            overrides=None,
+            register=True,
+            logfile=None
             ):
+    """Retrain the classifier on `retrain_dir` data.
+
+    mode="full" trains a new model from scratch. mode="incremental" fine-tunes
+    the classifier in `init_model` (defaults to `CLF_DIR`) on the hearts that
+    were not used by previous retrainings plus a `replay` fraction of old ones.
+    `patience` (epochs without improvement) overrides the early-stopping
+    patience of the configs, and training stops before exceeding
+    `time_budget` minutes. Other configs values can be changed with
+    `overrides`. With `register=False` the run is not recorded in the
+    retrain history (e.g. sweep trials). `logfile` defaults to
+    `retrain_dir/retrain.log`.
+    """
+    from ._train import (FINETUNE_WEIGHTS,
+                         prepare_configs,
+                         split_incremental,
+                         record_run,
+                         stopped_epoch)
     
     data_dir = os.path.join(retrain_dir, "resampled")
     label_dir = os.path.join(retrain_dir, "label")
     configs = os.path.join(CLF_DIR, "configs.json")
     log_dir = os.path.join(outdir, "LOGS")
-    logfile = os.path.join(retrain_dir, "retrain.log")
+    if logfile is None:
+        logfile = os.path.join(retrain_dir, "retrain.log")
+    save_dir = os.path.join(outdir, exp)
+    base_configs = configs
+    overrides = dict(overrides or {}, patience=patience)
+    
+    if mode == "incremental":
+        if init_model is None or init_model == "":
+            init_model = CLF_DIR
+        n_new, n_replay = split_incremental(label_dir=label_dir,
+                                            outdir=os.path.join(label_dir, "incremental"),
+                                            trained_file=os.path.join(retrain_dir, "trained.csv"),
+                                            replay=replay)
+        logging.info(f"Incremental retrain from {init_model}: {n_new} new hearts, {n_replay} replayed hearts")
+        label_dir = os.path.join(label_dir, "incremental")
+        # Weights are placed in the experiment folder, where training resumes from
+        os.makedirs(save_dir, exist_ok=True)
+        shutil.copy2(os.path.join(init_model, "best_model.hdf5"), os.path.join(save_dir, FINETUNE_WEIGHTS))
+        base_configs = os.path.join(init_model, "configs.json")
+        overrides["resume"] = FINETUNE_WEIGHTS
+    
+    custom_configs = any(v is not None for v in overrides.values())
+    if custom_configs:
+        # train_clf reads and rewrites configs.json of the experiment
+        configs = prepare_configs(base_configs,
+                                  os.path.join(save_dir, "configs.json"),
+                                  **overrides)
     
     exec_placeholder = " -exp_dir {} -exp {} -data_dir {} -label_dir {} -configs {} -log_dir {} -evaluate none -logfile {} -epochs {}"
     
+    train_start = time.time()
     if resrc == "local":
         print("Retrain on local")
-        import argparse
-        from mousechd.run import train_clf
-        params = {"exp_dir": outdir,
-                  "exp": exp,
-                  "data_dir": data_dir,
-                  "label_dir": label_dir,
-                  "test_path": None,
-                  "configs": configs,
-                  "log_dir": log_dir,
-                  "logfile": logfile,
-                  "epochs": epochs,
-                  "evaluate": "none"}
-        args = argparse.Namespace(**params)
-        train_clf.main(args)
-        
-        return "Sucess"
+        from ._train import train_local
+        _, stop_reason = train_local(exp_dir=outdir,
+                                     exp=exp,
+                                     data_dir=data_dir,
+                                     label_dir=label_dir,
+                                     configs=configs,
+                                     log_dir=log_dir,
+                                     logfile=logfile,
+                                     epochs=epochs,
+                                     cache_dir=os.path.join(retrain_dir, "cache"),
+                                     nworkers=nworkers,
+                                     cache=cache,
+                                     time_budget=None if time_budget is None else time_budget*60)
+        
+        status = "Sucess"
     
     else:
         from mousechd.utils.tools import CLF_ID
         print("Retrain on server")
-        server_home = subprocess.getoutput(f'ssh {servername} "pwd"')
+        with trace("ssh", cat="remote", step="home"):
+            server_home = subprocess.getoutput(f'ssh {servername} "pwd"')
         
-        outdir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, outdir)
-        data_dir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, data_dir)
-        label_dir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, label_dir)
-        configs = f"{server_home}/.MouseCHD/Classifier/{CLF_ID}/Classifier/configs.json"
-        log_dir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, log_dir)
-        logfile = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, logfile)
+        server_outdir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, outdir)
+        server_data_dir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, data_dir)
+        server_label_dir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, label_dir)
+        if custom_configs:
+            server_configs = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, configs)
+        else:
+            server_configs = f"{server_home}/.MouseCHD/Classifier/{CLF_ID}/Classifier/configs.json"
+        server_log_dir = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, log_dir)
+        server_logfile = f"{server_home}/DATA/" + get_relative_sever_dir(shared_folder, logfile)
         
         # Extra modules
         extra_cmd = ""
@@ -404,32 +821,69 @@ def retrain(resrc,
             for m in modules:
                 extra_cmd += f"{m} && "
         
+        train_cmd = f"{lib_path} train_clf"
+        if time_budget is not None:
+            # exit status 124 when the budget is exceeded, best weights are already saved
+            train_cmd = f"timeout {int(time_budget*60)} {train_cmd}"
+        
         if slurm:
-            cmd = extra_cmd + slurm_cmd + f" {lib_path} train_clf"
+            cmd = extra_cmd + slurm_cmd + f" {train_cmd}"
         else:
-            cmd = extra_cmd + f"{lib_path} train_clf"
+            cmd = extra_cmd + train_cmd
             
-        cmd += exec_placeholder.format(outdir,
+        cmd += exec_placeholder.format(server_outdir,
                                        exp,
-                                       data_dir,
-                                       label_dir,
-                                       configs,
-                                       log_dir,
-                                       logfile,
+                                       server_data_dir,
+                                       server_label_dir,
+                                       server_configs,
+                                       server_log_dir,
+                                       server_logfile,
                                        epochs)
         
         logging.info(f"cmd: {cmd}")
         
         
-        out = subprocess.getoutput(f'ssh {servername} "{cmd}"')
+        with trace("ssh", cat="remote", step="command"):
+            exitcode, out = subprocess.getstatusoutput(f'ssh {servername} "{cmd}"')
         
         logging.info(out)
         
-        if ("error" in out) and ("Terminated" not in out):
+        if ("error" in out) and ("Terminated" not in out) and (exitcode != 124):
             logging.info(out)
-            return "Error"
+            status = "Error"
+        else:
+            status = "Sucess"
+        
+        if exitcode == 124:
+            stop_reason = "time_budget"
+        elif stopped_epoch(save_dir) < epochs:
+            stop_reason = "early_stopping"
         else:
-            return "Sucess"
+            stop_reason = "completed"
+    
+    if status != "Error":
+        last_epoch = stopped_epoch(save_dir)
+        run = record_run(retrain_dir=retrain_dir,
+                         save_dir=save_dir,
+                         label_dir=label_dir,
+                         exp=exp,
+                         mode=mode,
+                         epochs=epochs,
+                         train_time=time.time() - train_start,
+                         epochs_run=last_epoch,
+                         stopped_epoch=last_epoch,
+                         stop_reason=stop_reason,
+                         patience=patience,
+                         time_budget=time_budget,
+                         register=register)
+        logging.info("Stopped at epoch {} ({}), total time: {}".format(
+            run["stopped_epoch"], stop_reason,
+            time.strftime("%Hh%Mm%Ss", time.gmtime(run["train_time"]))))
+        if mode == "incremental":
+            logging.info("Time saved versus full retrain (estimated): {}".format(
+                time.strftime("%Hh%Mm%Ss", time.gmtime(max(0, run["time_saved"])))))
+        
+    return status
         
               
 ################
@@ -4,6 +4,7 @@ from datetime import datetime
 import os, sys
 import json
 import re
+import zipfile
 import pathlib
 import subprocess
 
@@ -17,15 +18,13 @@ from qtpy.QtWidgets import (QWidget, QSlider, QHBoxLayout, QVBoxLayout, QLabel,
                             QFileDialog, QComboBox, QAbstractItemView, QCheckBox,
                             QRadioButton, QLineEdit, QScrollArea, QDialog, QMessageBox)
 from qtpy.QtGui import QPixmap, QFont, QMovie
-from qtpy.QtCore import Qt, QSize
+from qtpy.QtCore import Qt, QSize, QTimer
 
 import pandas as pd
 import numpy as np
 import SimpleITK as sitk
-from sklearn.model_selection import train_test_split
 
-import torch
-import tensorflow as tf
+# torch and TensorFlow are imported when a task or the classifier needs them
 
 # Fix the problem when installing plugin from Napari hub
 #========================================================#
@@ -37,10 +36,7 @@ if pkgutil.find_loader("mousechd") is None:
 from mousechd.utils.tools import CACHE_DIR, set_logger
 from mousechd.classifier.utils import download_clf_models, CLF_DIR
 from mousechd.segmentation.utils import download_seg_models, SEG_DIR
-from mousechd.classifier.models import load_MouseCHD_model
-from mousechd.datasets.utils import (get_largest_connectivity,
-                                     get_translate_values)
-from mousechd.datasets.preprocess import x5_df, merge_base_x5_labels
+from mousechd.datasets.utils import get_translate_values
 
 
 from ._utils import (is_relative_to, 
@@ -49,13 +45,33 @@ from ._utils import (is_relative_to,
                      APPTAINER_LIB_PATH,
                      MODULE_LS,
                      segment_heart,
+                     segment_heart_progressive,
                      segment_hearts,
+                     clean_mask,
                      gen_white2red_colormap,
                      gen_transturbo_colormap,
                      diagnose_heart,
                      preprocess,
                      resample,
+                     make_retrain_metadata,
+                     split_retrain_data,
                      retrain)
+from ._sweep import sweep
+from ._profiling import start_trace, stop_trace, trace
+from ._memory import MemoryMonitor
+from ._admission import admit
+from ._calibrate import calibrate, update_vars, count_cores
+from ._threads import set_thread_budget, segmentation_plan
+from ._capabilities import cuda_available, tf_gpu_available
+from ._models import classifiers, is_model_dir
+from ._masks import find_mask, mask_surface as mask_surface_mesh
+from ._session import SESSION_EXT, heart_layer_names, snapshot, load_session as load_session_file, layer_kwargs
+from ._profiles import PROFILES, default_profile, describe
+from ._quantize import (quantized_available,
+                        quantize_segmenter,
+                        validate_quantized,
+                        load_validation,
+                        describe_validation)
 from .assets import download_assets
 
 
@@ -86,6 +102,9 @@ resources = ["local", "server"]
 # serverlibs = ["apptainer", "conda"]
 tasks = ["segment", "diagnose", "retrain"]
 
+# Delay after the last edit of the model path before loading the model
+MODEL_PATH_DEBOUNCE_MS = 600
+
 issueLink = "<a href=\"https://github.com/hnguyentt/mousechd-napari/issues\"> <font color=green> issues</font> </a>"
 
 
@@ -123,13 +142,22 @@ except FileNotFoundError:
     with open(os.path.join(CACHE_DIR, "Napari", "vars.json"), "w") as f:
         json.dump(default_vars, f, indent=1)
 
+# Settings recommended by calibration
+nthreads_preprocessing_default = int(default_vars.get("nthreads_preprocessing", 6))
+nthreads_nifti_default = int(default_vars.get("nthreads_nifti", 2))
+nworkers_default = int(default_vars.get("nworkers", 1))
+thread_budget_default = int(default_vars.get("thread_budget", 0)) or count_cores()
+cpu_runtime_default = bool(default_vars.get("cpu_runtime", False))
+quantized_default = bool(default_vars.get("quantized", False))
+step_size_default = float(default_vars.get("step_size", 0.5))
+preview_default = bool(default_vars.get("preview", False))
+surface_default = bool(default_vars.get("mask_surface", False))
+# Without a saved profile, the default depends on the GPU: it is set when the
+# devices are probed in the background
+profile_default = default_vars.get("profile", None)
+if profile_default not in PROFILES:
+    profile_default = None
 
-try:
-    tf.test.is_gpu_available()
-except:
-    tf.config.set_visible_devices([], 'GPU')
- 
-download_assets()   
         
 class MouseCHD(QScrollArea):
     def __init__(self, napari_viewer):
@@ -150,16 +178,11 @@ class MouseCHD(QScrollArea):
         header_label = QLabel('Mouse Congenital Heart Disease')
         header_label.setFont(QFont("Helvetica [Cronyx]", 18, weight=QFont.Bold))
         header_container.layout().addWidget(header_label, alignment=Qt.AlignCenter)
-        ## Logo
-        logo_size = QSize(450, 450)
-        logo_path = os.path.join(CACHE_DIR, "Napari", 'assets', 'thumbnail.png')
-        print(logo_path)
-        logo = QPixmap(str(logo_path))
-        logo = logo.scaled(logo_size, Qt.KeepAspectRatio, transformMode=Qt.SmoothTransformation)
-        logo_label = QLabel()
-        logo_label.setPixmap(logo)
-        logo_label.setMinimumWidth(500)
-        header_container.layout().addWidget(logo_label, alignment=Qt.AlignCenter)
+        ## Logo, set when the assets are downloaded (in the background on first use)
+        self.logo_label = QLabel()
+        self.logo_label.setMinimumWidth(500)
+        self._set_logo()
+        header_container.layout().addWidget(self.logo_label, alignment=Qt.AlignCenter)
         ## Credit
         credit_container = QWidget()
         credit_container.setLayout(QHBoxLayout())
@@ -238,7 +261,8 @@ class MouseCHD(QScrollArea):
         resrc_container.layout().addWidget(self.server_container)
         
         # Threads for preprocessing and saving nifti
-        instruction = ("If your computer crashes or it is frozen, consider to decrease these parameter. " +
+        instruction = ("If there is not enough memory, these numbers are lowered automatically or the job waits for memory. " +
+                       "If your computer crashes or it is frozen, consider to decrease these parameter. " +
                        "Be aware that the segmentation may take longer to finish if you decrease these numbers!")
         self.nthreads_container = QWidget()
         self.nthreads_container.setLayout(QVBoxLayout())
@@ -248,18 +272,50 @@ class MouseCHD(QScrollArea):
         nthreads_preprocessing_cont = self.create_QSpinBox(att_name="nthreads_preprocessing",
                                                            label="\tNumber of preprocessing threads:",
                                                            min_val=1,
-                                                           default_val=6)
-        self.nthreads_preprocessing.setValue(int(6))
+                                                           default_val=nthreads_preprocessing_default)
+        self.nthreads_preprocessing.setValue(nthreads_preprocessing_default)
         self.nthreads_container.layout().addWidget(nthreads_preprocessing_cont)
         
         self.nthreads_nifti = QSpinBox()
         nthreads_nifti_cont = self.create_QSpinBox(att_name="nthreads_nifti",
                                                    label="\tNumber of threads for saving NIFTI files:",
                                                    min_val=1,
-                                                   default_val=2)
-        self.nthreads_nifti.setValue(int(2))
+                                                   default_val=nthreads_nifti_default)
+        self.nthreads_nifti.setValue(nthreads_nifti_default)
         self.nthreads_container.layout().addWidget(nthreads_nifti_cont)
         
+        self.nworkers = QSpinBox()
+        nworkers_cont = self.create_QSpinBox(att_name="nworkers",
+                                             label="\tNumber of segmentation processes (CPU):",
+                                             min_val=1,
+                                             default_val=nworkers_default)
+        self.nworkers.setValue(nworkers_default)
+        self.nthreads_container.layout().addWidget(nworkers_cont)
+        
+        self.thread_budget = QSpinBox()
+        thread_budget_cont = self.create_QSpinBox(att_name="thread_budget",
+                                                  label="\tCPU thread budget (torch, TensorFlow, SimpleITK, BLAS):",
+                                                  min_val=1,
+                                                  max_val=count_cores(),
+                                                  default_val=min(thread_budget_default, count_cores()))
+        self.thread_budget.setValue(min(thread_budget_default, count_cores()))
+        self.nthreads_container.layout().addWidget(thread_budget_cont)
+        
+        self.cpu_runtime = QCheckBox("Optimized CPU runtime (inference mode, tuned threads, channels-last, bfloat16 if supported)", self)
+        self.cpu_runtime.setChecked(cpu_runtime_default)
+        self.nthreads_container.layout().addWidget(self.cpu_runtime)
+        self.nthreads_container.layout().addWidget(self.create_help_text(
+            "Compare it with the default runtime on your computer with the command: mousechd-napari cpu_runtime"))
+        
+        self.quantized = QCheckBox("Int8 segmentation model (CPU)", self)
+        self.quantized.setChecked(quantized_default and quantized_available())
+        self.quantized.toggled.connect(self._on_quantized_changed)
+        self.nthreads_container.layout().addWidget(self.quantized)
+        self.quantize_msg = self.create_help_text(
+            describe_validation(load_validation()) if quantized_available() else
+            "The int8 model is made and validated on the sample scan when this option is checked the first time (a few minutes).")
+        self.nthreads_container.layout().addWidget(self.quantize_msg)
+        
         instruction = ("If the segmentation is too slow, especially on CPU, consider to increase step size. " +
                        "Be aware that increase this number will decrease the accuracy of segmentation model significantly.")
         self.nthreads_container.layout().addWidget(self.create_help_text(instruction))
@@ -270,12 +326,44 @@ class MouseCHD(QScrollArea):
                                             min_val=0.1,
                                             max_val=1,
                                             magf=10,
-                                            default_val=0.5)
-        self.step_size.setValue(5)
+                                            default_val=step_size_default)
+        self.step_size.setValue(int(round(step_size_default*10)))
         self.nthreads_container.layout().addWidget(stepsize_cont)
         
+        instruction = ("Calibrate measures this computer (cores, memory, disk and a short segmentation) " +
+                       "and sets the recommended values above. It takes a few minutes and is saved for the next sessions.")
+        self.nthreads_container.layout().addWidget(self.create_help_text(instruction))
+        self.calibrate_btn = QPushButton("Calibrate")
+        self.calibrate_btn.clicked.connect(self.run_calibration)
+        self.nthreads_container.layout().addWidget(self.calibrate_btn)
+        self.calibrate_msg = self.create_help_text("")
+        self.nthreads_container.layout().addWidget(self.calibrate_msg)
+        self.calibrate_msg.hide()
+        
         resrc_container.layout().addWidget(self.nthreads_container)
         
+        # Segmentation profile
+        instruction = ("Profiles trade segmentation accuracy for speed. The runtime and the Dice with the most accurate profile " +
+                       "are measured on the sample scan with the command: mousechd-napari profiles")
+        resrc_container.layout().addWidget(self.create_help_text(instruction))
+        profile_container = QWidget()
+        profile_container.setLayout(QHBoxLayout())
+        profile_container.layout().addWidget(QLabel("Segmentation profile: "))
+        self.seg_profile = QComboBox()
+        self.seg_profile.addItems(list(PROFILES.keys()))
+        self.seg_profile.setCurrentText(profile_default or "standard")
+        self.seg_profile.currentTextChanged.connect(self._on_profile_changed)
+        profile_container.layout().addWidget(self.seg_profile)
+        resrc_container.layout().addWidget(profile_container)
+        self.profile_msg = self.create_help_text(describe(profile_default or "standard"))
+        resrc_container.layout().addWidget(self.profile_msg)
+        self.seg_preview = QCheckBox("Show the mask while segmenting (local)", self)
+        self.seg_preview.setChecked(preview_default)
+        resrc_container.layout().addWidget(self.seg_preview)
+        self.mask_surface = QCheckBox("Show the mask as a surface mesh (smooth 3D rotation)", self)
+        self.mask_surface.setChecked(surface_default)
+        resrc_container.layout().addWidget(self.mask_surface)
+        
         ## Change
         for btn in resrc_buttons:
             btn.toggled.connect(lambda _, btn=btn: self._on_resrc_changed(btn))
@@ -375,6 +463,58 @@ class MouseCHD(QScrollArea):
                                        label="# epochs",
                                        default_txt="20")
         self.retrain_container.layout().addWidget(epochs)
+        self.time_budget = QLineEdit()
+        time_budget = self.create_QLineEdit(att_name="time_budget",
+                                            label="Time budget (minutes)",
+                                            placeholder="<no limit>")
+        self.retrain_container.layout().addWidget(time_budget)
+        self.patience = QLineEdit()
+        patience = self.create_QLineEdit(att_name="patience",
+                                         label="Early stopping patience (epochs)",
+                                         placeholder="<model default>")
+        self.retrain_container.layout().addWidget(patience)
+        instruction = ("Training stops when the validation metric does not improve for 'patience' epochs, " +
+                       "or before the next epoch would exceed the time budget. The best model is kept.")
+        self.retrain_container.layout().addWidget(self.create_help_text(instruction))
+        
+        self.train_cache = QCheckBox("Cache decoded training data (faster epochs, uses more disk space)", self)
+        self.train_cache.setFont(parameter_font)
+        self.train_cache.setChecked(True)
+        self.retrain_container.layout().addWidget(self.train_cache)
+        
+        self.retrain_mode = "full"
+        retrain_mode_container, retrain_mode_btns = self.create_RadioButtons(label="Retrain mode",
+                                                                             choices=["full", "incremental"],
+                                                                             default_idx=0)
+        self.retrain_container.layout().addWidget(retrain_mode_container)
+        self.incremental_container = QWidget()
+        self.incremental_container.setLayout(QVBoxLayout())
+        instruction = ("Incremental mode fine-tunes the currently loaded classifier (default or retrained model) " +
+                       "on the hearts that were not used in previous retrainings, plus a replay sample of old hearts.")
+        self.incremental_container.layout().addWidget(self.create_help_text(instruction))
+        self.replay = QLineEdit()
+        replay = self.create_QLineEdit(att_name="replay",
+                                       label="Replay fraction of old hearts",
+                                       default_txt="0.2")
+        self.incremental_container.layout().addWidget(replay)
+        self.retrain_container.layout().addWidget(self.incremental_container)
+        self.incremental_container.hide()
+        
+        self.sweep = QCheckBox("Hyperparameter sweep", self)
+        self.sweep_grid = QLineEdit()
+        self.sweep_container = self.create_checkbox(box_name="sweep", txt_name="sweep_grid",
+                                                    default_txt='{"lr": [0.001, 0.0001], "class_weights": [true, false]}')
+        self.sweep.stateChanged.connect(self._on_sweep_changed)
+        self.sweep_grid.hide()
+        self.retrain_container.layout().addWidget(self.sweep_container)
+        self.sweep_parallel = QSpinBox()
+        self.sweep_parallel_container = self.create_QSpinBox(att_name="sweep_parallel",
+                                                             label="\tParallel trials:",
+                                                             min_val=1,
+                                                             default_val=2)
+        self.sweep_parallel.setValue(2)
+        self.retrain_container.layout().addWidget(self.sweep_parallel_container)
+        self.sweep_parallel_container.hide()
         
         
         self.pp_resrc = "local"
@@ -397,6 +537,9 @@ class MouseCHD(QScrollArea):
             
         for btn in pp_btns:
             btn.toggled.connect(lambda _, btn=btn: self._on_preprocess_choice_change(btn))
+            
+        for btn in retrain_mode_btns:
+            btn.toggled.connect(lambda _, btn=btn: self._on_retrain_mode_changed(btn))
         
         task_container.layout().addWidget(QLabel("<hr>"))
         self.container.layout().addWidget(task_container)
@@ -467,6 +610,23 @@ class MouseCHD(QScrollArea):
         self.cache_btn.clicked.connect(self.delete_cache)
         self.container.layout().addWidget(self.cache_btn)
         
+        ###########
+        # SESSION #
+        ###########
+        session_container = QWidget()
+        session_container.setLayout(QHBoxLayout())
+        self.save_session_btn = QPushButton("Save session")
+        self.save_session_btn.setFont(parameter_font)
+        self.save_session_btn.clicked.connect(self.save_session)
+        session_container.layout().addWidget(self.save_session_btn)
+        self.load_session_btn = QPushButton("Load session")
+        self.load_session_btn.setFont(parameter_font)
+        self.load_session_btn.clicked.connect(self.load_session)
+        session_container.layout().addWidget(self.load_session_btn)
+        self.container.layout().addWidget(session_container)
+        # Last predictions of each heart, saved with its session
+        self.predictions = {}
+        
         ########
         # LOGS #
         ########
@@ -513,11 +673,21 @@ class MouseCHD(QScrollArea):
         # PROCESS PARAMETERS #
         ######################
         self.workdir = os.path.join(CACHE_DIR, "Napari")
-        download_clf_models()
         self.outdir.setText(outdir)
         
-        self.model = load_MouseCHD_model(conf_path=os.path.join(CLF_DIR, "configs.json"),
-                                         weights_path=os.path.join(CLF_DIR, "best_model.hdf5"))
+        # The classifier is loaded in the background, the widget is usable meanwhile
+        self.model = None
+        # Run parameters of a diagnosis waiting for the classifier
+        self.pending_params = None
+        self.model_timer = QTimer()
+        self.model_timer.setSingleShot(True)
+        self.model_timer.setInterval(MODEL_PATH_DEBOUNCE_MS)
+        self.model_timer.timeout.connect(self._load_model)
+        worker = init_worker(CLF_DIR)
+        worker.returned.connect(self._on_initialized)
+        worker.errored.connect(lambda error: (self._set_logo(),
+                                              self._on_model_failed(CLF_DIR, error)))
+        worker.start()
         
         self.logdir = self.outdir.text()
         if self.logdir != "":
@@ -525,6 +695,13 @@ class MouseCHD(QScrollArea):
             
         self.run_worker = None
         self.log_worker = None
+        # Job waiting for memory (admission control), with the run parameters
+        # of when it was queued
+        self.queued_params = None
+        self.queued_at = None
+        self.admission_timer = QTimer()
+        self.admission_timer.setInterval(5000)
+        self.admission_timer.timeout.connect(self._retry_queued)
         
         ########
         # LOAD #
@@ -728,15 +905,42 @@ class MouseCHD(QScrollArea):
             self.server_container.show()
             self.retrain_instruct.show()
             self.pp_resrc_container.show()
+            self.train_cache.hide()
             self.nthreads_container.hide()
         else:
             self.outdir.setText(outdir)
             self.server_container.hide()
             self.retrain_instruct.hide()
             self.pp_resrc_container.hide()
+            self.train_cache.show()
             self.nthreads_container.show()
             
              
+    def _on_profile_changed(self, profile):
+        self.step_size.setValue(int(round(PROFILES[profile]["step_size"]*10)))
+        self.profile_msg.setText(describe(profile))
+        
+        
+    def _on_quantized_changed(self, checked):
+        if (not checked) or quantized_available():
+            return
+        self.quantized.setEnabled(False)
+        self.quantize_msg.setText("Quantizing the segmentation model and validating it on the sample scan...")
+        worker = quantize_worker()
+        worker.returned.connect(self._on_quantized)
+        worker.errored.connect(lambda error: (show_error(f"Quantization failed: {error}"),
+                                              self.quantized.setChecked(False),
+                                              self.quantized.setEnabled(True),
+                                              self.quantize_msg.setText(f"Quantization failed: {error}")))
+        worker.start()
+        
+        
+    def _on_quantized(self, res):
+        self.quantized.setEnabled(True)
+        self.quantize_msg.setText(describe_validation(res))
+        show_info(describe_validation(res))
+        
+        
     def _on_task_changed(self, btn):
         if btn.isChecked():
             self.task = btn.text()
@@ -781,16 +985,86 @@ class MouseCHD(QScrollArea):
             btn.setStyleSheet(unset_box_style)
            
     
-    def _on_model_path_changed(self):
-        if self.model_path.text() == "":
-            conf_path = os.path.join(CLF_DIR, "configs.json")
-            weights_path = os.path.join(CLF_DIR, "best_model.hdf5")
+    def _on_retrain_mode_changed(self, btn):
+        if btn.isChecked():
+            self.retrain_mode = btn.text()
+            btn.setStyleSheet(checked_style)
+            if btn.text() == "incremental":
+                self.incremental_container.show()
+            else:
+                self.incremental_container.hide()
         else:
-            conf_path = os.path.join(self.model_path.text(), "configs.json")
-            weights_path = os.path.join(self.model_path.text(), "best_model.hdf5")
+            btn.setStyleSheet(unset_box_style)
+    
+    
+    def _set_logo(self):
+        logo_path = os.path.join(CACHE_DIR, "Napari", 'assets', 'thumbnail.png')
+        if (not self.logo_label.pixmap()) or self.logo_label.pixmap().isNull():
+            if os.path.isfile(logo_path):
+                logo = QPixmap(str(logo_path))
+                logo = logo.scaled(QSize(450, 450), Qt.KeepAspectRatio, transformMode=Qt.SmoothTransformation)
+                self.logo_label.setPixmap(logo)
+    
+    
+    def _on_initialized(self, res):
+        self._set_logo()
+        if profile_default is None:
+            self.seg_profile.setCurrentText(res["profile"])
+        self._on_model_loaded(CLF_DIR, res["model"])
+    
+    
+    def _model_dir(self):
+        return CLF_DIR if self.model_path.text() == "" else self.model_path.text()
+    
+    
+    def _on_model_path_changed(self):
+        # Load when the path has not been edited for a moment, not at each
+        # keystroke. A diagnosis started meanwhile waits for the new model.
+        self.model = None
+        self.model_timer.start()
+        
+    
+    def _load_model(self):
+        model_dir = self._model_dir()
+        model = classifiers.get(model_dir)
+        if model is not None:
+            self._on_model_loaded(model_dir, model)
+            return
+        self.model = None
+        if not is_model_dir(model_dir):
+            # The default model is still downloading, or the path is incomplete
+            if model_dir != CLF_DIR:
+                self.model_path.setStyleSheet(warning_style)
+                self._cancel_pending("custom model path must contain configs.json and best_model.hdf5")
+            return
+        worker = model_worker(model_dir)
+        worker.returned.connect(lambda model: self._on_model_loaded(model_dir, model))
+        worker.errored.connect(lambda error: self._on_model_failed(model_dir, error))
+        worker.start()
         
-        self.model = load_MouseCHD_model(conf_path=conf_path,
-                                         weights_path=weights_path) 
+    
+    def _cancel_pending(self, reason):
+        # The diagnosis waiting for the classifier is not started
+        if self.pending_params is not None:
+            self.pending_params = None
+            show_error(f"Diagnosis not started: {reason}")
+    
+    
+    def _on_model_failed(self, model_dir, error):
+        show_error(f"Classifier loading failed: {error}")
+        # Failure of a path edited since: the diagnosis waits for the new one
+        if model_dir == self._model_dir():
+            self._cancel_pending("the classifier could not be loaded")
+        
+    
+    def _on_model_loaded(self, model_dir, model):
+        # Model of a path edited since
+        if model_dir != self._model_dir():
+            return
+        self.model = model
+        if self.pending_params is not None:
+            params, self.pending_params = self.pending_params, None
+            self._start_task(params, queued_at=time.time())
     
     
     def _unset_servername_warning(self):
@@ -804,6 +1078,15 @@ class MouseCHD(QScrollArea):
             self.slurm_cmd.hide()
             
 
+    def _on_sweep_changed(self):
+        if self.sweep.isChecked():
+            self.sweep_grid.show()
+            self.sweep_parallel_container.show()
+        else:
+            self.sweep_grid.hide()
+            self.sweep_parallel_container.hide()
+            
+
     def _on_module_changed(self):
         if self.module.isChecked():
             self.module_ls.show()
@@ -857,6 +1140,10 @@ class MouseCHD(QScrollArea):
     #############        
     def update_layers(self, layer):
         
+        if layer is None:
+            # Progress tick: lets the worker be stopped between tiles
+            return
+        
         if "error" in layer.keys():
             self.error.setText(layer["log"])
             self.stop_task()
@@ -866,48 +1153,33 @@ class MouseCHD(QScrollArea):
             self.run_log.setText(self.run_log.text() + "\n" + layer["log"])
             self.log_container.show()
             
+            if "preview" in layer.keys():
+                preview = layer["preview"]
+                if preview["metadata"]["name"] in all_layer_names:
+                    self.viewer.layers[preview["metadata"]["name"]].data = preview["data"]
+                else:
+                    self.viewer.add_image(preview["data"], **preview["metadata"])
+            
             if "metadata" in layer.keys():
                 if layer["metadata"]["name"] not in all_layer_names:
-                    self.viewer.add_image(layer["data"], **layer["metadata"])
+                    added = self.viewer.add_image(layer["data"], **layer["metadata"])
+                    # Attribute names depend on the napari version
+                    for attr in ["interpolation2d", "interpolation3d"]:
+                        if ("interpolation" in layer.keys()) and hasattr(added, attr):
+                            setattr(added, attr, layer["interpolation"])
+                preview_name = re.sub(r"^mask-", "preview-", layer["metadata"]["name"])
+                if preview_name in all_layer_names:
+                    self.viewer.layers.remove(preview_name)
+            
+            if "surface" in layer.keys():
+                surface = layer["surface"]
+                if surface["metadata"]["name"] not in all_layer_names:
+                    self.viewer.add_surface(surface["data"], **surface["metadata"])
             
             if "res" in layer.keys():
-                preds = layer["res"]
-                categories_map = {0: "Normal", 1: "CHD"}
-                class_idx = np.argmax(preds)
-                show_info("Prediction: {}({})".format(categories_map[class_idx], preds[class_idx]))
-                
-                pred_class = categories_map[class_idx]
-                prob = preds[class_idx]
-                max_length = 50
-                if pred_class == "CHD":
-                    prob = prob
-                else:
-                    prob = 1-prob
-                    
-                chd_length = int(max_length*prob)
-                norm_length = max_length - chd_length
-                        
-                textstyle = "color:white;font-size:15px"
-                predstyle = "background-color:{};color:white;font-size:15px".format(COLORS[pred_class])
                 heartname = re.sub(r"^gradcam-", "", layer["metadata"]["name"])
-                self.diag_res.setText(f'<p style="{textstyle}"><mark style="{predstyle}"> {heartname}:</mark> <mark style="{predstyle}"><b>{pred_class}</b></mark></p>')
-                self.chd_prob.setText('<p> <mark {}>Normal</mark><mark {}>CHD ({:.3f}) |</mark><mark {}>{}</mark><mark {}>{}</mark></p>'.format(
-                    hidestyle,
-                    'style="color:{};font-size:15px"'.format(COLORS["CHD"]),
-                    prob,
-                    'style="background-color:{};color:{};font-size:10px"'.format(COLORS["CHD"], COLORS["CHD"]),
-                    '|'*chd_length,
-                    comstyle,
-                    '|'*norm_length))
-                self.norm_prob.setText('<p> <mark {}>CHD</mark><mark {}>Normal ({:.3f}) |</mark><mark {}>{}</mark><mark {}>{}</mark></p>'.format(
-                    hidestyle,
-                    'style="color:{};font-size:15px"'.format(COLORS["Normal"]),
-                    1-prob,
-                    'style="background-color:{};color:{};font-size:10px"'.format(COLORS["Normal"], COLORS["Normal"]),
-                    '|'*norm_length,
-                    comstyle,
-                    '|'*chd_length))
-                self.diag_container.show()
+                self.predictions[heartname] = layer["res"]
+                self.show_prediction(heartname, layer["res"])
                 
             if layer["stop_worker"]:
                 self.stop_task()
@@ -918,6 +1190,44 @@ class MouseCHD(QScrollArea):
         self.viewer.camera.angles = (0,45,0)
     
     
+    def show_prediction(self, heartname, preds):
+        categories_map = {0: "Normal", 1: "CHD"}
+        class_idx = np.argmax(preds)
+        show_info("Prediction: {}({})".format(categories_map[class_idx], preds[class_idx]))
+
+        pred_class = categories_map[class_idx]
+        prob = preds[class_idx]
+        max_length = 50
+        if pred_class == "CHD":
+            prob = prob
+        else:
+            prob = 1-prob
+
+        chd_length = int(max_length*prob)
+        norm_length = max_length - chd_length
+
+        textstyle = "color:white;font-size:15px"
+        predstyle = "background-color:{};color:white;font-size:15px".format(COLORS[pred_class])
+        self.diag_res.setText(f'<p style="{textstyle}"><mark style="{predstyle}"> {heartname}:</mark> <mark style="{predstyle}"><b>{pred_class}</b></mark></p>')
+        self.chd_prob.setText('<p> <mark {}>Normal</mark><mark {}>CHD ({:.3f}) |</mark><mark {}>{}</mark><mark {}>{}</mark></p>'.format(
+            hidestyle,
+            'style="color:{};font-size:15px"'.format(COLORS["CHD"]),
+            prob,
+            'style="background-color:{};color:{};font-size:10px"'.format(COLORS["CHD"], COLORS["CHD"]),
+            '|'*chd_length,
+            comstyle,
+            '|'*norm_length))
+        self.norm_prob.setText('<p> <mark {}>CHD</mark><mark {}>Normal ({:.3f}) |</mark><mark {}>{}</mark><mark {}>{}</mark></p>'.format(
+            hidestyle,
+            'style="color:{};font-size:15px"'.format(COLORS["Normal"]),
+            1-prob,
+            'style="background-color:{};color:{};font-size:10px"'.format(COLORS["Normal"], COLORS["Normal"]),
+            '|'*norm_length,
+            comstyle,
+            '|'*chd_length))
+        self.diag_container.show()
+        
+        
     def update_log(self, line):
         self.run_log.setText(self.run_log.text() + line)
         
@@ -932,7 +1242,7 @@ class MouseCHD(QScrollArea):
         is_executable = True
         
         if self.resrc == "local":
-            if not torch.cuda.is_available():
+            if not cuda_available():
                 show_info("MouseCHD plugin can't found GPU on your local machine, running segmentation on CPU may take 40-45 minutes!")
                 # is_executable = False
                 # show_info("Local machine does not have GPU, please use server machine or install corresponding CUDA Toolkit.")
@@ -982,6 +1292,10 @@ class MouseCHD(QScrollArea):
                 is_executable = False
                 self.outdir.setStyleSheet(warning_style)
                 show_info("Output directory is required!")
+            
+            retrain_params = self._retrain_params()
+            if retrain_params is None:
+                is_executable = False
                 
         # Parameters
         if self.resrc == "local":
@@ -994,45 +1308,191 @@ class MouseCHD(QScrollArea):
             for layer in self.viewer.layers:
                 if layer.name == self._image_layers.currentText():
                     image = layer        
-            self.run_btn.hide()
-            self.stop_btn.show()
-            self.cache_btn.hide()
-            self.stop_btn.setText("Stop: {}".format(self.task.capitalize()))
-            self.run_worker = run_task(task=self.task,
-                                       resrc=self.resrc,
-                                       workdir=self.workdir,
-                                       nthreads_preprocessing=self.nthreads_preprocessing.value(),
-                                       nthreads_nifti=self.nthreads_nifti.value(),
-                                       step_size=self.step_size.value()/10.,
-                                       heart_name=self._image_layers.currentText(),
-                                       servername=self.servername.text(),
-                                       shared_folder=self.shared_folder.text(),
-                                       lib_path=self.apptainer_path.text(),
-                                       slurm=self.slurm.isChecked(),
-                                       slurm_cmd=self.slurm_cmd.text(),
-                                       module=self.module.isChecked(),
-                                       module_ls=self.module_ls.text(),
-                                       image=image,
-                                       model=self.model,
-                                       pp_resrc=self.pp_resrc,
-                                       chd_dir=os.path.join(self.data_dir.text(), "CHD"),
-                                       norm_dir=os.path.join(self.data_dir.text(), "Normal"),
-                                       outdir=self.outdir.text(),
-                                       exp=self.exp.text(),
-                                       epochs=int(self.epochs.text()))
-            self.run_worker.yielded.connect(self.update_layers)
-            self.run_worker.start()
             
+            params = self._run_params(image)
             if self.task == "retrain":
-                self.log_worker = read_log(os.path.join(self.workdir,"retrain", "retrain.log"))
-                self.log_worker.yielded.connect(self.update_log)
-                self.log_worker.start()
-                
-            self.busy_container.show()
+                params.update(retrain_params)
+            if self.task in ["segment", "diagnose"]:
+                decision = self._admit(params)
+                if decision["action"] == "refuse":
+                    show_error(decision["message"])
+                    return
+                if decision["action"] == "queue":
+                    show_info(decision["message"])
+                    self.run_log.setText(self.run_log.text() + "\n" + decision["message"])
+                    self.log_container.show()
+                    self.queued_params = params
+                    self.queued_at = time.time()
+                    self.run_btn.hide()
+                    self.cache_btn.hide()
+                    self.stop_btn.setText("Cancel queued: {}".format(self.task.capitalize()))
+                    self.stop_btn.show()
+                    self.admission_timer.start()
+                    return
+                if decision["action"] == "reduce":
+                    self._apply_admission(decision, params)
+                elif decision["message"] != "":
+                    # Runs, but close to the memory available
+                    show_info(decision["message"])
+            
+            self._start_task(params, queued_at=time.time())
+            
+            
+    def _run_params(self, image):
+        """Arguments of `run_task` from the widget state. Queued and pending
+        jobs keep the parameters of when they were requested.
+        """
+        return dict(task=self.task,
+                    resrc=self.resrc,
+                    workdir=self.workdir,
+                    nthreads_preprocessing=self.nthreads_preprocessing.value(),
+                    nthreads_nifti=self.nthreads_nifti.value(),
+                    nworkers=self.nworkers.value(),
+                    thread_budget=self.thread_budget.value(),
+                    cpu_runtime=self.cpu_runtime.isChecked(),
+                    quantized=self.quantized.isChecked() and self.quantized.isEnabled(),
+                    step_size=self.step_size.value()/10.,
+                    profile=self.seg_profile.currentText(),
+                    preview=self.seg_preview.isChecked(),
+                    mask_surface=self.mask_surface.isChecked(),
+                    heart_name=image.name if image is not None else self._image_layers.currentText(),
+                    servername=self.servername.text(),
+                    shared_folder=self.shared_folder.text(),
+                    lib_path=self.apptainer_path.text(),
+                    slurm=self.slurm.isChecked(),
+                    slurm_cmd=self.slurm_cmd.text(),
+                    module=self.module.isChecked(),
+                    module_ls=self.module_ls.text(),
+                    image=image,
+                    pp_resrc=self.pp_resrc,
+                    chd_dir=os.path.join(self.data_dir.text(), "CHD"),
+                    norm_dir=os.path.join(self.data_dir.text(), "Normal"),
+                    outdir=self.outdir.text(),
+                    exp=self.exp.text(),
+                    train_cache=self.train_cache.isChecked(),
+                    retrain_mode=self.retrain_mode,
+                    init_model=self.model_path.text() if self.model_path.text() != "" else CLF_DIR,
+                    sweep_parallel=self.sweep_parallel.value())
+    
+    
+    def _retrain_params(self):
+        """Retrain fields parsed from their line edits. None, with the invalid
+        fields highlighted, if a value is not valid.
+        """
+        def _number(field, cast, optional=False, upper=None):
+            field.setStyleSheet(unwarning_style)
+            if optional and (field.text() == ""):
+                return None
+            try:
+                value = cast(field.text())
+            except ValueError:
+                value = None
+            if (value is None) or (value <= 0) or ((upper is not None) and (value > upper)):
+                field.setStyleSheet(warning_style)
+                raise ValueError
+            return value
+        
+        params = {}
+        checks = [("epochs", self.epochs, int, False, None, "# epochs must be a positive integer!"),
+                  ("patience", self.patience, int, True, None, "Patience must be a positive integer!"),
+                  ("time_budget", self.time_budget, float, True, None, "Time budget must be a positive number!"),
+                  ("replay", self.replay, float, False, 1, "Replay fraction must be in (0, 1]!")]
+        for key, field, cast, optional, upper, msg in checks:
+            try:
+                params[key] = _number(field, cast, optional=optional, upper=upper)
+            except ValueError:
+                show_info(msg)
+                return None
+        
+        params["sweep_grid"] = None
+        if self.sweep.isChecked():
+            self.sweep_grid.setStyleSheet(unwarning_style)
+            try:
+                grid = json.loads(self.sweep_grid.text())
+            except ValueError:
+                grid = None
+            if (not isinstance(grid, dict)) or (len(grid) == 0) or \
+                    not all(isinstance(v, list) and (len(v) > 0) for v in grid.values()):
+                self.sweep_grid.setStyleSheet(warning_style)
+                show_info('Sweep grid must be a JSON object of lists, e.g. {"lr": [0.001, 0.0001]}!')
+                return None
+            params["sweep_grid"] = grid
+        
+        return params
+    
+    
+    def _admit(self, params):
+        image = params["image"]
+        return admit(workdir=params["workdir"],
+                     task=params["task"],
+                     resrc=params["resrc"],
+                     shape=image.data.shape,
+                     dtype=image.data.dtype,
+                     nthreads_preprocessing=params["nthreads_preprocessing"],
+                     nthreads_nifti=params["nthreads_nifti"],
+                     step_size=params["step_size"],
+                     nworkers=params["nworkers"])
+    
+    
+    def _apply_admission(self, decision, params):
+        # Thread counts are shown in the spin boxes, so the decision is visible
+        show_info(decision["message"])
+        self.run_log.setText(self.run_log.text() + "\n" + decision["message"])
+        self.log_container.show()
+        for key in ["nthreads_preprocessing", "nthreads_nifti", "nworkers"]:
+            params[key] = decision[key]
+        self.nthreads_preprocessing.setValue(decision["nthreads_preprocessing"])
+        self.nthreads_nifti.setValue(decision["nthreads_nifti"])
+        self.nworkers.setValue(decision["nworkers"])
+    
+    
+    def _retry_queued(self):
+        decision = self._admit(self.queued_params)
+        if decision["action"] not in ["run", "reduce"]:
+            return
+        self.admission_timer.stop()
+        if decision["action"] == "reduce":
+            self._apply_admission(decision, self.queued_params)
+        params, self.queued_params = self.queued_params, None
+        self._start_task(params, queued_at=self.queued_at)
+        
+        
+    def _start_task(self, params, queued_at=None):
+        if (params["task"] == "diagnose") and (self.model is None):
+            if (self._model_dir() != CLF_DIR) and not is_model_dir(self._model_dir()):
+                self.model_path.setStyleSheet(warning_style)
+                show_error("Custom model path must contain configs.json and best_model.hdf5")
+                return
+            self.pending_params = params
+            show_info("The classifier is loading, diagnosis starts when it is ready")
+            return
+        self.run_btn.hide()
+        self.stop_btn.show()
+        self.cache_btn.hide()
+        self.stop_btn.setText("Stop: {}".format(params["task"].capitalize()))
+        self.run_worker = run_task(**params, model=self.model, queued_at=queued_at)
+        self.run_worker.yielded.connect(self.update_layers)
+        self.run_worker.start()
+        
+        if params["task"] == "retrain":
+            self.log_worker = read_log(os.path.join(params["workdir"], "retrain", "retrain.log"))
+            self.log_worker.yielded.connect(self.update_log)
+            self.log_worker.start()
+            
+        self.busy_container.show()
         
         
     def stop_task(self):
         
+        if self.admission_timer.isActive():
+            # Queued job not started yet
+            self.admission_timer.stop()
+            self.queued_params = None
+            self.stop_btn.hide()
+            self.run_btn.show()
+            self.cache_btn.show()
+            return
+        
         self.run_worker.quit()
         if self.log_worker is not None:
             self.log_worker.quit()
@@ -1059,6 +1519,38 @@ class MouseCHD(QScrollArea):
         self.cache_btn.show()
         
         
+    def run_calibration(self):
+        self.calibrate_btn.setEnabled(False)
+        self.calibrate_btn.setText("Calibrating...")
+        worker = calibration_worker(os.path.join(CACHE_DIR, "Napari"))
+        worker.returned.connect(self._on_calibrated)
+        worker.errored.connect(lambda error: (show_error(f"Calibration failed: {error}"),
+                                              self.calibrate_btn.setEnabled(True),
+                                              self.calibrate_btn.setText("Calibrate")))
+        worker.start()
+        
+        
+    def _on_calibrated(self, res):
+        rec = res["recommended"]
+        self.nthreads_preprocessing.setValue(rec["nthreads_preprocessing"])
+        self.nthreads_nifti.setValue(rec["nthreads_nifti"])
+        self.nworkers.setValue(rec["nworkers"])
+        self.step_size.setValue(int(round(rec["step_size"]*10)))
+        msg = "{} cores, {:.0f} GB memory, disk {:.0f} MB/s{}.".format(
+            res["probe"]["cores"],
+            res["probe"]["memory_total_gb"],
+            res["probe"]["disk_write_mbs"],
+            ", GPU: {}".format(res["probe"]["gpu"]) if res["probe"]["gpu"] else ", no GPU")
+        if rec["predicted_segment_time"] is not None:
+            msg += " Predicted segmentation time: {}".format(
+                time.strftime("%Hh%Mm%Ss", time.gmtime(rec["predicted_segment_time"])))
+        self.calibrate_msg.setText(msg)
+        self.calibrate_msg.show()
+        self.calibrate_btn.setEnabled(True)
+        self.calibrate_btn.setText("Calibrate")
+        show_info("Calibration finished! Recommended settings are saved.")
+        
+        
     def run_tsb(self):
         from tensorboard import program
         from subprocess import check_output
@@ -1111,8 +1603,127 @@ class MouseCHD(QScrollArea):
                 pass
             
         self.cache_btn.setEnabled(True)
+        
+        
+    def save_session(self):
+        heart_name = self._image_layers.currentText()
+        if heart_name == "":
+            show_info("No image to save!")
+            return
+        layers = [snapshot(self.viewer.layers[x]) for x in heart_layer_names(heart_name)
+                  if x in [l.name for l in self.viewer.layers]]
+        outdir = self.outdir.text() if self.outdir.text() != "" else str(pathlib.Path.home())
+        path, _ = QFileDialog.getSaveFileName(self, "Save session",
+                                              os.path.join(outdir, f"{heart_name}{SESSION_EXT}"),
+                                              f"MouseCHD session (*{SESSION_EXT})")
+        if path == "":
+            return
+        if not path.endswith(SESSION_EXT):
+            path += SESSION_EXT
+        
+        self.save_session_btn.setEnabled(False)
+        worker = session_worker(path, heart_name, layers, self.predictions.get(heart_name))
+        worker.returned.connect(self._on_session_saved)
+        worker.errored.connect(self._on_session_saved)
+        worker.start()
+        
+    def _on_session_saved(self, res):
+        self.save_session_btn.setEnabled(True)
+        if isinstance(res, Exception):
+            show_error(f"Session not saved: {res}")
+        else:
+            show_info("Session saved: {} ({} layers)".format(res["path"], len(res["layers"])))
+            
+    def load_session(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Load session", "",
+                                              f"MouseCHD session (*{SESSION_EXT})")
+        if path == "":
+            return
+        try:
+            session = load_session_file(path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as error:
+            show_error(f"Session not loaded: {error}")
+            return
+        
+        all_layer_names = [x.name for x in self.viewer.layers]
+        existing = [x["name"] for x in session["layers"] if x["name"] in all_layer_names]
+        if len(existing) > 0:
+            msgBox = QMessageBox()
+            msgBox.setIcon(QMessageBox.Question)
+            msgBox.setText("These layers will be replaced by the session: {}. Do you want to continue?".format(", ".join(existing)))
+            msgBox.setWindowTitle("Load Session")
+            msgBox.setStandardButtons(QMessageBox.Yes | QMessageBox.Cancel)
+            if msgBox.exec() != QMessageBox.Yes:
+                return
+        
+        for layer in session["layers"]:
+            if layer["name"] in all_layer_names:
+                self.viewer.layers.remove(layer["name"])
+            kwargs = layer_kwargs(layer["settings"])
+            if layer["kind"] == "surface":
+                added = self.viewer.add_surface(layer["data"], name=layer["name"], **kwargs)
+            else:
+                added = self.viewer.add_image(layer["data"], name=layer["name"], **kwargs)
+            for attr in ["interpolation2d", "interpolation3d"]:
+                if (attr in layer["settings"]) and hasattr(added, attr):
+                    setattr(added, attr, layer["settings"][attr])
+        
+        heart_name = session["heart_name"]
+        if session["predictions"] is not None:
+            self.predictions[heart_name] = np.asarray(session["predictions"])
+            self.show_prediction(heart_name, self.predictions[heart_name])
+        if heart_name in [self._image_layers.itemText(i) for i in range(self._image_layers.count())]:
+            self._image_layers.setCurrentText(heart_name)
+        show_info("Session loaded: {} ({})".format(heart_name, session["date"]))
    
 
+@thread_worker
+def init_worker(model_dir):
+    """Download the assets (logo, sample scan), probe the devices and load the
+    default classifier
+    """
+    start = time.time()
+    download_assets()
+    profile = default_profile()
+    tf_gpu_available()
+    download_clf_models()
+    model = classifiers.load(model_dir)
+    logging.info("Classifier loaded in {:.1f}s".format(time.time() - start))
+    
+    return {"model": model, "profile": profile}
+
+
+@thread_worker
+def session_worker(path, heart_name, layers, predictions):
+    from ._session import save_session
+    
+    start = time.time()
+    manifest = save_session(path, heart_name, layers, predictions=predictions)
+    logging.info("Session saved in {:.1f}s: {}".format(time.time() - start, path))
+    manifest["path"] = path
+    
+    return manifest
+
+
+@thread_worker
+def model_worker(model_dir):
+    tf_gpu_available()
+    return classifiers.load(model_dir)
+
+
+@thread_worker
+def calibration_worker(workdir):
+    return calibrate(workdir=workdir,
+                     sample_path=os.path.join(CACHE_DIR, "Napari", "assets", "sample.nii.gz"))
+
+
+@thread_worker
+def quantize_worker():
+    sample_path = os.path.join(CACHE_DIR, "Napari", "assets", "sample.nii.gz")
+    quantize_segmenter(sample_path)
+    return validate_quantized(sample_path)
+
+
 @thread_worker
 def read_log(path):
     while not os.path.isfile(path):
@@ -1128,6 +1739,7 @@ def read_log(path):
         
         condition = (bool(re.search(r"^\d+\.", line.strip("\n"))) |
                       line.strip("\n").startswith("Mouse") |
+                      line.strip("\n").startswith("Epoch") |
                       bool(re.search(r"^\d+ hearts", line.strip("\n"))))
         if condition:
             yield line
@@ -1143,6 +1755,13 @@ def run_task(task,
              heart_name,
              servername,
              shared_folder,
+             profile=None,
+             preview=False,
+             mask_surface=False,
+             nworkers=1,
+             thread_budget=None,
+             cpu_runtime=False,
+             quantized=False,
              lib_path=apptainer_lib_path,
              slurm=False,
              slurm_cmd=slurm_cmd,
@@ -1156,14 +1775,31 @@ def run_task(task,
              outdir=None,
              exp=None,
              epochs=20,
+             train_cache=False,
+             retrain_mode="full",
+             init_model=None,
+             replay=0.2,
+             patience=None,
+             time_budget=None,
+             sweep_grid=None,
+             sweep_parallel=2,
+             queued_at=None,
              ):
     
+    profile = profile or default_profile()
     print("="*10 + "PARAMETERS" + "="*10)
     print(f"task={task}")
     print(f"resrc={resrc}")
     print(f"nthreads_preprocessing={nthreads_preprocessing}")
     print(f"nthreads_nifti={nthreads_nifti}")
     print(f"step_size={step_size}")
+    print(f"profile={profile}")
+    print(f"preview={preview}")
+    print(f"mask_surface={mask_surface}")
+    print(f"nworkers={nworkers}")
+    print(f"thread_budget={thread_budget}")
+    print(f"cpu_runtime={cpu_runtime}")
+    print(f"quantized={quantized}")
     print(f"workdir={workdir}")
     print(f"heart_name={heart_name}")
     print(f"servername={servername}")
@@ -1180,32 +1816,65 @@ def run_task(task,
     print(f"outdir={outdir}")
     print(f"exp={exp}")
     print(f"epochs={epochs}")
+    print(f"train_cache={train_cache}")
+    print(f"retrain_mode={retrain_mode}")
+    print(f"init_model={init_model}")
+    print(f"replay={replay}")
+    print(f"patience={patience}")
+    print(f"time_budget={time_budget}")
+    print(f"sweep_grid={sweep_grid}")
+    print(f"sweep_parallel={sweep_parallel}")
     print("="*30)
+    
+    # Spans of all stages are saved as a Chrome trace (chrome://tracing, ui.perfetto.dev)
+    tracer = start_trace(f"{task}-{heart_name}" if task in ["segment", "diagnose"] else f"{task}-{exp}")
+    if queued_at is not None:
+        tracer.add_span("queue_wait", queued_at, time.time())
+    trace_path = os.path.join(workdir, "traces", "{}_{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S"), task))
+    print(f"trace={trace_path}")
+    
+    # Peak memory of each stage, appended to workdir/memory.csv, with the
+    # nnU-Net processes used for one scan
+    plan = segmentation_plan(1, nthreads_preprocessing, nthreads_nifti)
+    monitor = MemoryMonitor(task=task,
+                            resrc=resrc,
+                            n_voxels=None if image is None else int(np.prod(image.data.shape)),
+                            itemsize=None if image is None else image.data.dtype.itemsize,
+                            nthreads_preprocessing=plan["preprocessing"],
+                            nthreads_nifti=plan["nifti"],
+                            nworkers=nworkers,
+                            step_size=step_size)
 
     
     layer = {"stop_worker": False, "tsb": False, "log": ""}
     
     try:
         # Save default vars
-        default_vars = {"servername": servername,
-                        "shared_folder": shared_folder,
-                        "lib_path": lib_path,
-                        "slurm_cmd": slurm_cmd,
-                        "module_ls": module_ls,
-                        "outdir": outdir}
-        
-        with open(os.path.join(CACHE_DIR, "Napari", "vars.json"), "w") as f:
-            json.dump(default_vars, f, indent=1)
+        update_vars({"servername": servername,
+                     "shared_folder": shared_folder,
+                     "lib_path": lib_path,
+                     "slurm_cmd": slurm_cmd,
+                     "module_ls": module_ls,
+                     "outdir": outdir,
+                     "profile": profile,
+                     "preview": preview,
+                     "mask_surface": mask_surface,
+                     "nworkers": nworkers,
+                     "thread_budget": thread_budget or 0,
+                     "cpu_runtime": cpu_runtime,
+                     "quantized": quantized})
+        # One budget for all the libraries of this process and of the nnU-Net workers
+        set_thread_budget(thread_budget)
                 
         if task in ["segment", "diagnose"]:
             assert image is not None, "Image must be specified"
             scale = image.scale
-            if not torch.cuda.is_available() and (resrc=="local"):
+            if not cuda_available() and (resrc=="local"):
                 layer["log"] = ("Your machine doesn't have GPUs or CUDA versions are not compatible." 
                                 + "Using CPU for segmentation may take 40-45 minutes." 
                                 + "Running on GPUs takes 4-5 minutes to finish!")
-                layer["log"] += ("\n\nNote that we use minimal mode: inference with only 1 fold and distable TTA to make inference on CPU faster"
-                                 + "This may make the segmentation not as accurate as running on full mode!")
+                layer["log"] += ("\n\nSegmentation profile: {} ({}). ".format(profile, PROFILES[profile]["description"])
+                                 + "Faster profiles make the segmentation less accurate, see the measurements under the profile selector.")
                 yield layer
             if (resrc=="local") and (not os.path.isdir(SEG_DIR)):
                 layer["log"] += "\n\n==> Download segmentation model... (this may take time but it requires only once at the first run)"
@@ -1215,21 +1884,53 @@ def run_task(task,
             
             show_info("Start heart segmentation!")
             seg_start = time.time()
-            heart = segment_heart(resrc=resrc,
-                                  nthreads_preprocessing=nthreads_preprocessing,
-                                  nthreads_nifti=nthreads_nifti,
-                                  step_size=step_size,
-                                  workdir=workdir,
-                                  heart_name=heart_name,
-                                  servername=servername,
-                                  shared_folder=shared_folder,
-                                  lib_path=lib_path,
-                                  slurm=slurm,
-                                  slurm_cmd=slurm_cmd,
-                                  module=module,
-                                  module_ls=module_ls)
-            max_clump = get_largest_connectivity(heart)
-            heart[max_clump==0] = 0
+            # A mask from a previous run is only read: not representative
+            mask_exists = find_mask(os.path.join(workdir, "HeartSeg"), heart_name) is not None
+            with monitor.stage("segment", record=not mask_exists):
+                if preview and (resrc == "local") and (not mask_exists):
+                    # Coarse mask first, then refined every few tiles. Stopping
+                    # the run stops the segmentation after the current tile.
+                    for update in segment_heart_progressive(workdir=workdir,
+                                                            heart_name=heart_name,
+                                                            step_size=step_size,
+                                                            profile=profile,
+                                                            nworkers=nworkers,
+                                                            cpu_runtime=cpu_runtime,
+                                                            quantized=quantized):
+                        if "mask" not in update:
+                            yield None
+                            continue
+                        yield {"stop_worker": False,
+                               "tsb": False,
+                               "log": "Segmentation ({}): {}/{} tiles, {}".format(
+                                   update["stage"], update["done"], update["total"],
+                                   time.strftime("%Hh%Mm%Ss", time.gmtime(time.time() - seg_start))),
+                               "preview": {"data": update["mask"],
+                                           "metadata": dict(name=f"preview-{heart_name}",
+                                                            colormap=gen_white2red_colormap(),
+                                                            opacity=0.4,
+                                                            translate=[t*s for t, s in zip(update["translate"], scale)],
+                                                            scale=[x*s for x, s in zip(update["scale"], scale)],
+                                                            blending="translucent_no_depth",
+                                                            contrast_limits=(0,1))}}
+                heart = segment_heart(resrc=resrc,
+                                      nthreads_preprocessing=nthreads_preprocessing,
+                                      nthreads_nifti=nthreads_nifti,
+                                      step_size=step_size,
+                                      workdir=workdir,
+                                      heart_name=heart_name,
+                                      servername=servername,
+                                      shared_folder=shared_folder,
+                                      lib_path=lib_path,
+                                      slurm=slurm,
+                                      slurm_cmd=slurm_cmd,
+                                      module=module,
+                                      module_ls=module_ls,
+                                      profile=profile,
+                                      nworkers=nworkers,
+                                      cpu_runtime=cpu_runtime,
+                                      quantized=quantized)
+                heart = clean_mask(heart)
             seg_end = time.time()
             metadata = dict(name='mask-{}'.format(heart_name),
                             colormap=gen_white2red_colormap(),
@@ -1238,12 +1939,26 @@ def run_task(task,
                             scale=scale,
                             blending='translucent_no_depth',
                             contrast_limits=(0,1))
+            if mask_surface:
+                # The mesh replaces the volume rendering of the mask in 3D
+                with trace("mask_surface"):
+                    surface = mask_surface_mesh(heart)
+                if surface is not None:
+                    metadata["visible"] = False
+                    layer["surface"] = {"data": surface,
+                                        "metadata": dict(name="surface-{}".format(heart_name),
+                                                         colormap="red",
+                                                         opacity=0.6,
+                                                         scale=scale,
+                                                         shading="smooth")}
             
             layer["data"] = heart
             layer["metadata"] = metadata
             layer["log"] = "Heart segmentation finished! Segment time: {}".format(
                 time.strftime("%Hh%Mm%Ss", time.gmtime(seg_end - seg_start))
             )
+            if "segment" in monitor.peaks():
+                layer["log"] += ", peak memory: {:.1f} GB".format(monitor.peaks()["segment"] / 1024)
             
             if task == "segment":
                 layer["stop_worker"] = True
@@ -1257,22 +1972,27 @@ def run_task(task,
             
             show_info("Start diagnosis")
             clf_start = time.time()
-            pred, gradcam = diagnose_heart(model, im=image.data, heart=heart)
+            with monitor.stage("diagnose"):
+                pred, gradcam, (cam_scale, cam_translate) = diagnose_heart(model, im=image.data, heart=heart)
             clf_end = time.time()
             
             layer["log"] = "Diagnosis finished! Diagnosis time: {}".format(
                 time.strftime("%Hh%Mm%Ss", time.gmtime(clf_end - clf_start))
             )
+            if "diagnose" in monitor.peaks():
+                layer["log"] += ", peak memory: {:.1f} GB".format(monitor.peaks()["diagnose"] / 1024)
             layer["res"] = pred
             layer["data"] = gradcam
+            # Coarse GradCAM, upsampled by the viewer
             metadata = dict(name="gradcam-{}".format(heart_name),
                             colormap=gen_transturbo_colormap(),
                             opacity=0.5,
                             visible=False,
-                            translate=translate_values,
-                            scale=scale,
+                            translate=[t + o*s for t, o, s in zip(translate_values, cam_translate, scale)],
+                            scale=[f*s for f, s in zip(cam_scale, scale)],
                             blending="translucent_no_depth")
             layer["metadata"] = metadata
+            layer["interpolation"] = "linear"
             layer["stop_worker"] = True
             
             yield layer
@@ -1298,16 +2018,17 @@ def run_task(task,
             
             # Preprocessing CHD
             chd_start = time.time()
-            preprocess(indir=chd_dir,
-                       outdir=os.path.join(retrain_dir, "processed"),
-                       pp_resrc=pp_resrc,
-                       servername=servername,
-                       shared_folder=shared_folder,
-                       lib_path=lib_path,
-                       slurm=slurm,
-                       slurm_cmd=slurm_cmd,
-                       module=module,
-                       module_ls=module_ls)
+            with monitor.stage("preprocess_CHD"):
+                preprocess(indir=chd_dir,
+                           outdir=os.path.join(retrain_dir, "processed"),
+                           pp_resrc=pp_resrc,
+                           servername=servername,
+                           shared_folder=shared_folder,
+                           lib_path=lib_path,
+                           slurm=slurm,
+                           slurm_cmd=slurm_cmd,
+                           module=module,
+                           module_ls=module_ls)
             chd_end = time.time()
             layer["log"] = "Finished! Processing time: {}\n".format(
                 time.strftime("%Hh%Mm%Ss", time.gmtime(chd_end - chd_start))
@@ -1318,16 +2039,17 @@ def run_task(task,
             
             # Processing Normal
             norm_start = time.time()
-            preprocess(indir=norm_dir,
-                       outdir=os.path.join(retrain_dir, "processed"),
-                       pp_resrc=pp_resrc,
-                       servername=servername,
-                       shared_folder=shared_folder,
-                       lib_path=lib_path,
-                       slurm=slurm,
-                       slurm_cmd=slurm_cmd,
-                       module=module,
-                       module_ls=module_ls)
+            with monitor.stage("preprocess_Normal"):
+                preprocess(indir=norm_dir,
+                           outdir=os.path.join(retrain_dir, "processed"),
+                           pp_resrc=pp_resrc,
+                           servername=servername,
+                           shared_folder=shared_folder,
+                           lib_path=lib_path,
+                           slurm=slurm,
+                           slurm_cmd=slurm_cmd,
+                           module=module,
+                           module_ls=module_ls)
             norm_end = time.time()
             layer["log"] = "Finished! Processing time: {}\n".format(
                 time.strftime("%Hh%Mm%Ss", time.gmtime(norm_end - norm_start))
@@ -1336,31 +2058,28 @@ def run_task(task,
             yield layer
             
             # process metafile
-            df = pd.read_csv(os.path.join(retrain_dir, "processed", "processed.csv"))
-            df["Stage"] = "E18.5"
-            df["Normal heart"] = (df["folder"].str.split(os.sep, expand=True)[0] == "Normal") * 1
-            df["CHD"] = (df["folder"].str.split(os.sep, expand=True)[0] == "CHD") * 1
-            df[["heart_name", "Stage", "Normal heart", "CHD"]].to_csv(os.path.join(retrain_dir, "processed", "metadata.csv"),
-                                                                      index=False)
+            df = make_retrain_metadata(retrain_dir)
             
             # Segmentation
-            if not torch.cuda.is_available() and (resrc=="local"):
+            if not cuda_available() and (resrc=="local"):
                 layer["log"] = "Your machine doesn't have GPUs or GPUs are not compatible. Using CPU for segmentation may take 40-45 minutes. Running on GPUs takes around 2 minutes to finish!"
                 yield layer
 
             seg_start = time.time()
-            segment_hearts(resrc=resrc,
-                           nthreads_preprocessing=nthreads_preprocessing,
-                           nthreads_nifti=nthreads_nifti,
-                           step_size=step_size,
-                           workdir=workdir,
-                           servername=servername,
-                           shared_folder=shared_folder,
-                           lib_path=lib_path,
-                           slurm=slurm,
-                           slurm_cmd=slurm_cmd,
-                           module=module,
-                           module_ls=module_ls)
+            with monitor.stage("segment_all"):
+                segment_hearts(resrc=resrc,
+                               nthreads_preprocessing=nthreads_preprocessing,
+                               nthreads_nifti=nthreads_nifti,
+                               step_size=step_size,
+                               workdir=workdir,
+                               servername=servername,
+                               shared_folder=shared_folder,
+                               lib_path=lib_path,
+                               slurm=slurm,
+                               slurm_cmd=slurm_cmd,
+                               module=module,
+                               module_ls=module_ls,
+                               profile=profile)
             seg_end = time.time()
             layer["log"] = "Finished! Processing time: {}\n".format(
                 time.strftime("%Hh%Mm%Ss", time.gmtime(seg_end - seg_start))
@@ -1370,15 +2089,16 @@ def run_task(task,
             
             # Resample
             res_start = time.time()
-            resample(workdir=workdir,
-                     pp_resrc=pp_resrc,
-                     servername=servername,
-                     shared_folder=shared_folder,
-                     lib_path=lib_path,
-                     slurm=slurm,
-                     slurm_cmd=slurm_cmd,
-                     module=module,
-                     module_ls=module_ls)
+            with monitor.stage("resample"):
+                resample(workdir=workdir,
+                         pp_resrc=pp_resrc,
+                         servername=servername,
+                         shared_folder=shared_folder,
+                         lib_path=lib_path,
+                         slurm=slurm,
+                         slurm_cmd=slurm_cmd,
+                         module=module,
+                         module_ls=module_ls)
             res_end = time.time()
             layer["log"] = "Finished! Processing time: {}\n".format(
                 time.strftime("%Hh%Mm%Ss", time.gmtime(res_end - res_start))
@@ -1386,26 +2106,8 @@ def run_task(task,
             yield layer
             
             # Split data
-            os.makedirs(os.path.join(retrain_dir, "label"), exist_ok=True)
-            res_df = pd.read_csv(os.path.join(retrain_dir, "resampled", "resampled.csv"))
-            res_df = res_df[res_df["resampled_size"] != "Error"]
-            df = df[df["heart_name"].isin(res_df["heart_name"].tolist())]
-            df.reset_index(drop=True, inplace=True)
-            df["label"] = (df["CHD"] == 1)*1
-            
             layer["log"] = "~~Split data~~\n"
-            X_train, X_val, _, _ = train_test_split(df["heart_name"].tolist(),
-                                                    df["label"].tolist(),
-                                                    test_size=0.2,
-                                                    random_state=42)
-            train_df = df[df["heart_name"].isin(X_train)][["heart_name", "label"]]
-            val_df = df[df["heart_name"].isin(X_val)][["heart_name", "label"]]
-            train_df_x5 = x5_df(train_df)
-            val_df_x5 = x5_df(val_df)
-            merged_train_df = merge_base_x5_labels(df=train_df, df_x5=train_df_x5)
-            merged_val_df = merge_base_x5_labels(df=val_df, df_x5=val_df_x5)
-            merged_train_df.to_csv(os.path.join(retrain_dir, "label", "train.csv"), index=False)
-            merged_val_df.to_csv(os.path.join(retrain_dir, "label", "val.csv"), index=False)
+            train_df, val_df, merged_train_df, merged_val_df = split_retrain_data(retrain_dir, df)
             layer["log"] += "Train: {} CHD ({} resampled), {} Normal ({} resampled)\nVal: {} CHD ({} resampled), {} Normal ({} resampled)\n".format(
                 train_df["label"].sum(),
                 merged_train_df["label"].sum(),
@@ -1422,6 +2124,36 @@ def run_task(task,
             yield layer
             
             train_start = time.time()
+            if sweep_grid is not None:
+                sweep_df = sweep(resrc=resrc,
+                                 retrain_dir=retrain_dir,
+                                 outdir=outdir,
+                                 exp=exp,
+                                 grid=sweep_grid,
+                                 max_parallel=sweep_parallel,
+                                 epochs=epochs,
+                                 servername=servername,
+                                 shared_folder=shared_folder,
+                                 lib_path=lib_path,
+                                 slurm=slurm,
+                                 slurm_cmd=slurm_cmd,
+                                 module=module,
+                                 module_ls=module_ls,
+                                 cache=train_cache,
+                                 nworkers=nthreads_preprocessing,
+                                 patience=patience,
+                                 time_budget=time_budget)
+                layer["log"] = "Sweep finished! Running time: {}\n".format(
+                    time.strftime("%Hh%Mm%Ss", time.gmtime(time.time() - train_start))
+                )
+                layer["log"] += "Results (best first) saved in {}:\n{}\n".format(
+                    os.path.join(outdir, exp, "sweep.csv"),
+                    sweep_df.to_string(index=False)
+                )
+                layer["stop_worker"] = True
+                yield layer
+                return
+            
             status = retrain(resrc=resrc,
                              retrain_dir=retrain_dir,
                              outdir=outdir,
@@ -1433,7 +2165,14 @@ def run_task(task,
                              slurm=slurm,
                              slurm_cmd=slurm_cmd,
                              module=module,
-                             module_ls=module_ls
+                             module_ls=module_ls,
+                             cache=train_cache,
+                             nworkers=nthreads_preprocessing,
+                             mode=retrain_mode,
+                             init_model=init_model,
+                             replay=replay,
+                             patience=patience,
+                             time_budget=time_budget
                              )    
                 
             train_end = time.time()
@@ -1445,6 +2184,16 @@ def run_task(task,
                 layer["log"] = "Retraining finished! Running time: {}\n".format(
                     time.strftime("%Hh%Mm%Ss", time.gmtime(train_end - train_start))
                 )
+                with open(os.path.join(outdir, exp, "summary.json"), "r") as f:
+                    summary = json.load(f)
+                layer["log"] += "Stopped at epoch {}/{} ({})\n".format(summary["stopped_epoch"],
+                                                                      epochs,
+                                                                      summary["stop_reason"].replace("_", " "))
+                if retrain_mode == "incremental":
+                    layer["log"] += "Incremental retrain on {} hearts. Time saved versus full retrain (estimated): {}\n".format(
+                        summary["n_hearts"],
+                        time.strftime("%Hh%Mm%Ss", time.gmtime(max(0, summary["time_saved"])))
+                    )
             layer["stop_worker"] = True
             yield layer
             
@@ -1455,6 +2204,10 @@ def run_task(task,
         layer["log"] = f"An error occured. The error traceback is saved in {logpath}. Please report your problem together with traceback file here: {issueLink}"
         logging.exception("=> TRACEBACK: ")
         yield layer
+    
+    finally:
+        stop_trace(trace_path)
+        monitor.save(workdir)
         
         
     
@@ -0,0 +1,272 @@
+"""
+Segment and diagnose all scans of a folder (DICOM folders, NIfTI, NRRD) without the viewer
+"""
+import os
+import time
+import logging
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+RESULT_HEADERS = ["heart_name",
+                  "path",
+                  "prediction",
+                  "prob_CHD",
+                  "prob_Normal",
+                  "segment_time",
+                  "diagnose_time",
+                  "status"]
+CATEGORIES = {0: "Normal", 1: "CHD"}
+
+
+def add_args(parser):
+    from mousechd_napari._utils import APPTAINER_LIB_PATH, SLURM_CMD
+    from mousechd_napari._profiles import PROFILES
+
+    parser.add_argument("-indir", type=str, help="Input folder of scans: DICOM folders, .nii.gz or .nrrd files")
+    parser.add_argument("-outdir", type=str, help="Output directory for masks, GradCAMs and results.csv")
+    parser.add_argument("-model", type=str, help="Retrained model directory (configs.json, best_model.hdf5). Default: default classifier", default=None)
+    parser.add_argument("-resrc", type=str, choices=["local", "server"], help="Resource for segmentation", default="local")
+    parser.add_argument("-workdir", type=str, help="Segmentation working directory. Default: ~/.MouseCHD/Napari on local, <shared_folder>/.MouseCHD on server", default=None)
+    parser.add_argument("-prefetch", type=int, help="Number of scans read ahead while the current one is processed", default=1)
+    parser.add_argument("-nthreads_preprocessing", type=int, help="Number of threads for segmentation preprocessing", default=6)
+    parser.add_argument("-nthreads_nifti", type=int, help="Number of threads to save NIFTI files", default=2)
+    parser.add_argument("-nworkers", type=int, help="Number of segmentation processes sharing the sliding-window tiles (local CPU)", default=1)
+    parser.add_argument("-thread_budget", type=int, help="CPU threads shared by segmentation (3/4) and the overlapping diagnosis (1/4). 0: all cores", default=0)
+    parser.add_argument("-profile", type=str, choices=list(PROFILES.keys()),
+                        help="Segmentation profile (folds, TTA, step size). Default: accurate on GPU, standard on CPU", default=None)
+    parser.add_argument("-cpu_runtime", type=int, choices=[0, 1], help="Optimized CPU runtime for local segmentation (see the cpu_runtime command)", default=0)
+    parser.add_argument("-quantized", type=int, choices=[0, 1], help="Int8 segmentation model on CPU (see the quantize command)", default=0)
+    parser.add_argument("-step_size", type=float, help="Step size of the segmentation sliding window. Default: step size of the profile", default=None)
+    parser.add_argument("-gradcam", type=int, choices=[0, 1], help="Save GradCAMs?", default=1)
+    parser.add_argument("-mask_format", type=str, choices=["nifti", "packed", "rle"],
+                        help="Masks as uint8 NIfTI, bit-packed .npz (mousechd_napari._masks.load_packed_mask) or bounding box + run lengths .rle.npz (load_rle_mask)", default="nifti")
+    parser.add_argument("-servername", type=str, help="Server name (resrc=server)", default="")
+    parser.add_argument("-shared_folder", type=str, help="Shared folder with the server (resrc=server)", default="")
+    parser.add_argument("-lib_path", type=str, help="MouseCHD execution command on server", default=APPTAINER_LIB_PATH)
+    parser.add_argument("-slurm_cmd", type=str, help="Slurm command on server, empty to run without Slurm", default=SLURM_CMD)
+    parser.add_argument("-module_ls", type=str, help="';'-separated modules to load on server", default="")
+    parser.add_argument("-trace", type=int, choices=[0, 1], help="Save a Chrome trace of all stages in outdir/batch_trace.json", default=0)
+    parser.add_argument("-logfile", type=str, help="path to logfile", default=None)
+
+    return parser
+
+
+def list_scans(indir):
+    """DICOM folders, NIfTI and NRRD files of `indir`, sorted by name
+    """
+    scans = []
+    for x in sorted(os.listdir(indir)):
+        path = os.path.join(indir, x)
+        if x.startswith("."):
+            continue
+        if os.path.isdir(path) or x.endswith((".nii.gz", ".nrrd")):
+            scans.append(path)
+
+    return scans
+
+
+def read_scan(path):
+    from mousechd_napari._reader import reader_function
+
+    im, add_kwargs, _ = reader_function(path)[0]
+
+    return im, add_kwargs["name"], tuple(add_kwargs["scale"])
+
+
+def save_volume(arr, path, scale, translate=(0, 0, 0)):
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing(tuple(float(x) for x in scale[::-1]))
+    img.SetOrigin(tuple(float(t*s) for t, s in zip(translate, scale))[::-1])
+    sitk.WriteImage(img, path)
+
+
+def diagnose_and_save(model, im, heart, heart_name, scale, outdir, gradcam=True, mask_format="nifti"):
+    """Diagnose a segmented heart and write its mask and GradCAM.
+
+    Returns:
+        dict: result row (without timing of segmentation)
+    """
+    from mousechd.datasets.utils import get_translate_values
+    from mousechd_napari._utils import diagnose_heart
+    from mousechd_napari._masks import PACKED_EXT, RLE_EXT, save_packed_mask, save_rle_mask, to_labels
+
+    start = time.time()
+    preds, cam, (cam_scale, cam_translate) = diagnose_heart(model, im=im, heart=heart)
+    diagnose_time = time.time() - start
+
+    class_idx = int(np.argmax(preds))
+    prob = float(preds[class_idx])
+    if CATEGORIES[class_idx] != "CHD":
+        prob = 1 - prob
+
+    if mask_format == "packed":
+        save_packed_mask(heart, os.path.join(outdir, "masks", f"{heart_name}{PACKED_EXT}"), spacing=scale)
+    elif mask_format == "rle":
+        save_rle_mask(heart, os.path.join(outdir, "masks", f"{heart_name}{RLE_EXT}"), spacing=tuple(scale)[::-1])
+    else:
+        save_volume(to_labels(heart), os.path.join(outdir, "masks", f"{heart_name}.nii.gz"), scale)
+    if gradcam:
+        # NIfTI has no half precision type
+        # Coarse GradCAM: its voxels are larger than the scan voxels
+        translate = get_translate_values(heart, pad=(5, 5, 5))
+        save_volume(cam.astype(np.float32),
+                    os.path.join(outdir, "gradcams", f"{heart_name}.nii.gz"),
+                    [f*s for f, s in zip(cam_scale, scale)],
+                    translate=[(t + o) / f for t, o, f in zip(translate, cam_translate, cam_scale)])
+
+    return {"prediction": CATEGORIES[class_idx],
+            "prob_CHD": prob,
+            "prob_Normal": 1 - prob,
+            "diagnose_time": diagnose_time}
+
+
+def main(args):
+    from mousechd.utils.tools import CACHE_DIR, set_logger
+    from mousechd.classifier.utils import download_clf_models, CLF_DIR
+    from mousechd.segmentation.utils import download_seg_models
+    from mousechd.classifier.models import load_MouseCHD_model
+    from mousechd_napari._utils import segment_heart, clean_mask
+    from mousechd_napari._profiling import start_trace, stop_trace
+    from mousechd_napari._threads import get_thread_budget, partition, set_thread_budget
+
+    os.makedirs(os.path.join(args.outdir, "masks"), exist_ok=True)
+    if args.gradcam:
+        os.makedirs(os.path.join(args.outdir, "gradcams"), exist_ok=True)
+    set_logger(args.logfile if args.logfile is not None else os.path.join(args.outdir, "batch.log"))
+    if args.trace:
+        start_trace("batch")
+
+    if args.workdir is not None:
+        workdir = args.workdir
+    elif args.resrc == "local":
+        workdir = os.path.join(CACHE_DIR, "Napari")
+    else:
+        workdir = os.path.join(args.shared_folder, ".MouseCHD")
+
+    # Segmentation and diagnosis run at the same time: split the budget between
+    # torch/SimpleITK/nnU-Net and TensorFlow before TensorFlow starts
+    shares = partition(args.thread_budget or get_thread_budget(), {"segment": 3, "diagnose": 1})
+    set_thread_budget(shares["segment"], tf_threads=shares["diagnose"])
+    logging.info(f"Threads: {shares}")
+
+    # Models
+    download_clf_models()
+    model_dir = CLF_DIR if args.model is None else args.model
+    model = load_MouseCHD_model(conf_path=os.path.join(model_dir, "configs.json"),
+                                weights_path=os.path.join(model_dir, "best_model.hdf5"))
+    if args.resrc == "local":
+        download_seg_models()
+
+    # Resume from previous results
+    res_path = os.path.join(args.outdir, "results.csv")
+    try:
+        res_df = pd.read_csv(res_path)
+    except FileNotFoundError:
+        res_df = pd.DataFrame(columns=RESULT_HEADERS)
+    done = res_df[res_df["status"] == "OK"]["path"].tolist()
+    scans = [x for x in list_scans(args.indir) if x not in done]
+    # Failed scans are retried: their previous rows are replaced
+    res_df = res_df[(res_df["status"] == "OK") | (~res_df["path"].isin(scans))].reset_index(drop=True)
+    logging.info("{} scans, {} already processed".format(len(scans) + len(done), len(done)))
+
+    # Rows are added by the main loop (segmentation errors) and by the
+    # diagnosis callbacks
+    res_lock = threading.Lock()
+
+    def _add_row(row):
+        with res_lock:
+            res_df.loc[len(res_df), :] = [row.get(k) for k in RESULT_HEADERS]
+            res_df.to_csv(res_path, index=False)
+
+    def _on_diagnosed(future, row):
+        try:
+            row.update(future.result())
+            row["status"] = "OK"
+        except Exception as error:
+            logging.exception(f"Diagnosis of {row['path']} failed")
+            row["status"] = f"Error: {error}"
+        _add_row(row)
+        logging.info("{}: {} (CHD prob: {}), segment time: {:.1f}s, diagnose time: {}".format(
+            row["heart_name"], row.get("prediction"), row.get("prob_CHD"),
+            row["segment_time"], row.get("diagnose_time")))
+
+    # Reading runs ahead of segmentation, diagnosis of a heart overlaps with
+    # segmentation of the next one
+    with ThreadPoolExecutor(max_workers=max(1, args.prefetch)) as reader, \
+         ThreadPoolExecutor(max_workers=1) as diagnoser:
+        queue = deque()
+        pending = []
+        for path in scans[:max(1, args.prefetch)]:
+            queue.append((path, reader.submit(read_scan, path)))
+        next_scan = len(queue)
+
+        for i in range(len(scans)):
+            path, future = queue.popleft()
+            if next_scan < len(scans):
+                queue.append((scans[next_scan], reader.submit(read_scan, scans[next_scan])))
+                next_scan += 1
+
+            row = {"path": path}
+            try:
+                im, heart_name, scale = future.result()
+                row["heart_name"] = heart_name
+                logging.info(f"{i+1}. {heart_name}")
+                seg_start = time.time()
+                heart = segment_heart(resrc=args.resrc,
+                                      nthreads_preprocessing=args.nthreads_preprocessing,
+                                      nthreads_nifti=args.nthreads_nifti,
+                                      step_size=args.step_size,
+                                      workdir=workdir,
+                                      heart_name=heart_name,
+                                      servername=args.servername,
+                                      shared_folder=args.shared_folder,
+                                      lib_path=args.lib_path,
+                                      slurm=args.slurm_cmd != "",
+                                      slurm_cmd=args.slurm_cmd,
+                                      module=args.module_ls != "",
+                                      module_ls=args.module_ls,
+                                      profile=args.profile,
+                                      nworkers=args.nworkers,
+                                      cpu_runtime=bool(args.cpu_runtime),
+                                      quantized=bool(args.quantized))
+                heart = clean_mask(heart)
+                row["segment_time"] = time.time() - seg_start
+            except Exception as error:
+                logging.exception(f"Segmentation of {path} failed")
+                row["status"] = f"Error: {error}"
+                _add_row(row)
+                continue
+
+            diag_future = diagnoser.submit(diagnose_and_save,
+                                           model=model,
+                                           im=im,
+                                           heart=heart,
+                                           heart_name=heart_name,
+                                           scale=scale,
+                                           outdir=args.outdir,
+                                           gradcam=bool(args.gradcam),
+                                           mask_format=args.mask_format)
+            diag_future.add_done_callback(lambda f, row=row: _on_diagnosed(f, row))
+            pending.append(diag_future)
+            del im, heart
+
+        for diag_future in pending:
+            diag_future.exception()
+
+    logging.info(f"Results saved in {res_path}")
+    if args.trace:
+        stop_trace(os.path.join(args.outdir, "batch_trace.json"))
+        logging.info(f"Trace saved in {os.path.join(args.outdir, 'batch_trace.json')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Segment and diagnose a folder of scans")
+    parser = add_args(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,287 @@
+"""
+Benchmark plugin import time, reader, preprocessing, diagnosis and mask post-processing on synthetic volumes
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import SimpleITK as sitk
+
+BENCHMARKS = ["import", "reader", "clean_mask", "resample_im", "diagnose", "diagnose_cached", "end2end",
+              "mask_packed", "mask_rle", "heatmap_dtype", "mask_surface"]
+# Entry points of napari: widget, reader, sample
+IMPORT_MODULES = ["mousechd_napari._widget", "mousechd_napari._reader", "mousechd_napari.sample_data"]
+# Frameworks that must not be imported at start-up
+HEAVY_MODULES = ["torch", "tensorflow", "nnunet"]
+IMPORT_CODE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+from mousechd_napari._profiling import current_rss
+print(json.dumps({{"time": duration,
+                  "rss": current_rss(),
+                  "heavy": [x for x in {heavy} if x in sys.modules]}}))
+"""
+
+
+def add_args(parser):
+    parser.add_argument("-sizes", type=int, nargs="+", help="Sides of the synthetic cubic volumes (voxels at 0.02 mm)", default=[400, 600])
+    parser.add_argument("-benchmarks", type=str, nargs="+", choices=BENCHMARKS, help="Benchmarks to run", default=BENCHMARKS[:5])
+    parser.add_argument("-repeat", type=int, help="Number of runs per benchmark", default=3)
+    parser.add_argument("-model", type=str, help="Model directory (configs.json, best_model.hdf5) for diagnosis. Default: default classifier", default=None)
+    parser.add_argument("-nthreads_preprocessing", type=int, help="Number of threads for segmentation preprocessing (end2end)", default=6)
+    parser.add_argument("-nthreads_nifti", type=int, help="Number of threads to save NIFTI files (end2end)", default=2)
+    parser.add_argument("-thread_budget", type=int, help="CPU thread budget of all libraries. 0: library defaults", default=0)
+    parser.add_argument("-outfile", type=str, help="Output JSON file", default="benchmark.json")
+    parser.add_argument("-compare", type=str, help="Previous benchmark JSON file to compare with", default=None)
+    parser.add_argument("-threshold", type=float, help="Relative slowdown (or memory increase) reported as a regression", default=0.2)
+
+    return parser
+
+
+def load_model(model_dir=None):
+    """Classifier for diagnosis benchmarks. Without downloaded weights, the
+    architecture from configs.json is built with random weights: timings
+    do not depend on weights.
+    """
+    from mousechd.classifier.utils import CLF_DIR
+    from mousechd.classifier.models import MouseCHD, load_MouseCHD_model
+
+    model_dir = CLF_DIR if model_dir is None else model_dir
+    conf_path = os.path.join(model_dir, "configs.json")
+    weights_path = os.path.join(model_dir, "best_model.hdf5")
+    if not os.path.isfile(conf_path):
+        return None
+    if os.path.isfile(weights_path):
+        return load_MouseCHD_model(conf_path=conf_path, weights_path=weights_path)
+
+    with open(conf_path, "r") as f:
+        configs = json.load(f)
+    return MouseCHD(model_name=configs["model_name"],
+                    input_size=configs["input_size"],
+                    n_classes=configs["n_classes"],
+                    first_filters=configs["first_filters"],
+                    mask_depth=configs["mask_depth"],
+                    is_bn_mask=configs["is_bn_mask"]).build_model()
+
+
+def import_time(module, repeat=3):
+    """Import `module` in fresh interpreters (cold start, as when napari opens
+    the plugin).
+
+    Returns:
+        dict: time_mean, time_min, time_max (seconds), peak_mem_mb (resident
+            memory after import), heavy frameworks imported, repeat
+    """
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", IMPORT_CODE.format(module=module, heavy=HEAVY_MODULES)],
+                             capture_output=True, text=True, check=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    times = [x["time"] for x in runs]
+
+    return {"module": module,
+            "time_mean": float(np.mean(times)),
+            "time_min": float(np.min(times)),
+            "time_max": float(np.max(times)),
+            "peak_mem_mb": float(max(x["rss"] or 0 for x in runs)) / 2**20,
+            "heavy": runs[-1]["heavy"],
+            "repeat": repeat}
+
+
+def run_benchmarks(sizes, benchmarks, repeat=3, model_dir=None, nthreads_preprocessing=6, nthreads_nifti=2):
+    from mousechd_napari._profiling import profile_call
+    from mousechd_napari._phantom import heart_phantom
+    from mousechd_napari._reader import reader_function
+    from mousechd_napari._utils import resample_im, diagnose_heart, clean_mask, segment_heart
+    from mousechd_napari._models import classifier_inputs
+    from mousechd_napari._masks import (PACKED_EXT, RLE_EXT, save_packed_mask, save_rle_mask, load_rle_mask,
+                                        to_heatmap, memory_report, mask_surface)
+    from mousechd.datasets.utils import crop_heart_bbx
+
+    model = None
+    if {"diagnose", "diagnose_cached", "end2end"} & set(benchmarks):
+        model = load_model(model_dir)
+        if model is None:
+            logging.info("No classifier configs found, diagnosis benchmarks are skipped")
+
+    results = []
+    if "import" in benchmarks:
+        # Does not depend on the volume: size 0
+        for module in IMPORT_MODULES:
+            res = import_time(module, repeat=repeat)
+            res.update({"benchmark": "import", "size": 0})
+            results.append(res)
+            logging.info("import {}: {:.2f}s (min {:.2f}s), {:.0f} MB, heavy modules: {}".format(
+                module, res["time_mean"], res["time_min"], res["peak_mem_mb"], ", ".join(res["heavy"]) or "none"))
+
+    tmpdir = tempfile.mkdtemp(prefix="mousechd_bench_")
+    try:
+        for size in sizes:
+            logging.info(f"Volume {size}^3")
+            im, heart = heart_phantom(size, seed=size)
+            clean_heart = clean_mask(heart.copy())
+            name = f"bench_{size}"
+            path = os.path.join(tmpdir, f"{name}.nii.gz")
+            img = sitk.GetImageFromArray(im)
+            img.SetSpacing((0.02, 0.02, 0.02))
+            sitk.WriteImage(img, path)
+            del img
+
+            def _add(bench, res, size=size):
+                res.update({"benchmark": bench, "size": size})
+                results.append(res)
+                logging.info("{}: {:.3f}s (min {:.3f}s), peak memory {:.0f} MB".format(
+                    bench, res["time_mean"], res["time_min"], res["peak_mem_mb"]))
+                if "nbytes_before" in res:
+                    logging.info("{}: {:.1f} MB ({}) -> {:.1f} MB ({})".format(
+                        bench, res["nbytes_before"] / 2**20, res["dtype_before"],
+                        res["nbytes_after"] / 2**20, res["dtype_after"]))
+
+            if "reader" in benchmarks:
+                _add("reader", profile_call(reader_function, path, repeat=repeat))
+            if "clean_mask" in benchmarks:
+                _add("clean_mask", profile_call(clean_mask, repeat=repeat,
+                                                setup=lambda heart=heart: {"heart": heart.copy()}))
+            if "resample_im" in benchmarks:
+                _add("resample_im", profile_call(resample_im, im=im, ma=clean_heart, repeat=repeat))
+            if ("diagnose" in benchmarks) and (model is not None):
+                # First call builds the graph
+                diagnose_heart(model, im=im, heart=clean_heart)
+                _add("diagnose", profile_call(diagnose_heart, model, im=im, heart=clean_heart, repeat=repeat,
+                                              setup=classifier_inputs.clear))
+            if ("diagnose_cached" in benchmarks) and (model is not None):
+                # Same heart diagnosed again (e.g. with another model): input from cache
+                diagnose_heart(model, im=im, heart=clean_heart)
+                _add("diagnose_cached", profile_call(diagnose_heart, model, im=im, heart=clean_heart, repeat=repeat))
+            if ("end2end" in benchmarks) and (model is not None):
+                def _end2end(path=path, name=name):
+                    workdir = tempfile.mkdtemp(dir=tmpdir)
+                    layer_im = reader_function(path)[0][0]
+                    ma = segment_heart(resrc="local",
+                                       nthreads_preprocessing=nthreads_preprocessing,
+                                       nthreads_nifti=nthreads_nifti,
+                                       step_size=0.5,
+                                       workdir=workdir,
+                                       heart_name=name)
+                    ma = clean_mask(ma)
+                    diagnose_heart(model, im=layer_im, heart=ma)
+                    shutil.rmtree(workdir, ignore_errors=True)
+                _add("end2end", profile_call(_end2end, repeat=repeat))
+            if "mask_packed" in benchmarks:
+                # uint8 mask in memory -> bit-packed file
+                packed_path = os.path.join(tmpdir, f"{name}{PACKED_EXT}")
+                res = profile_call(save_packed_mask, clean_heart, packed_path, repeat=repeat)
+                res.update({"nbytes_before": int(clean_heart.nbytes),
+                            "nbytes_after": os.path.getsize(packed_path),
+                            "dtype_before": str(clean_heart.dtype),
+                            "dtype_after": "packed bits (file)"})
+                _add("mask_packed", res)
+            if "mask_rle" in benchmarks:
+                # NIfTI mask of the segmentation cache -> bounding box + run lengths,
+                # timed: reading the cropped heart region
+                nifti_path = os.path.join(tmpdir, f"{name}_mask.nii.gz")
+                rle_path = os.path.join(tmpdir, f"{name}_mask{RLE_EXT}")
+                sitk.WriteImage(sitk.GetImageFromArray(clean_heart), nifti_path)
+                save_rle_mask(clean_heart, rle_path)
+                res = profile_call(load_rle_mask, rle_path, crop=True, pad=5, repeat=repeat)
+                res.update({"nbytes_before": os.path.getsize(nifti_path),
+                            "nbytes_after": os.path.getsize(rle_path),
+                            "dtype_before": "NIfTI file",
+                            "dtype_after": "RLE file"})
+                _add("mask_rle", res)
+            if "heatmap_dtype" in benchmarks:
+                # Former GradCAM: float64 at cropped heart resolution
+                cropped_shape = crop_heart_bbx(im, clean_heart, pad=(5,5,5))[1].shape
+                cam = np.random.default_rng(size).random(cropped_shape)
+                res = profile_call(to_heatmap, cam, repeat=repeat)
+                res.update(memory_report(cam, to_heatmap(cam)))
+                _add("heatmap_dtype", res)
+                del cam
+            if "mask_surface" in benchmarks:
+                # Mesh drawn instead of the mask volume in 3D
+                res = profile_call(mask_surface, clean_heart, repeat=repeat)
+                verts, faces = mask_surface(clean_heart)
+                res.update({"nbytes_before": int(clean_heart.nbytes),
+                            "nbytes_after": int(verts.nbytes + faces.nbytes),
+                            "dtype_before": str(clean_heart.dtype),
+                            "dtype_after": f"mesh ({len(verts)} vertices, {len(faces)} faces)"})
+                _add("mask_surface", res)
+            del im, heart, clean_heart
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    """Compare results with a previous benchmark.
+
+    Returns:
+        list: (benchmark, size, time ratio, memory ratio, is regression)
+    """
+    base = {(x["benchmark"], x["size"], x.get("module")): x for x in baseline["results"]}
+    rows = []
+    for res in results:
+        key = (res["benchmark"], res["size"], res.get("module"))
+        if key not in base:
+            continue
+        time_ratio = res["time_min"] / max(base[key]["time_min"], 1e-9)
+        mem_ratio = res["peak_mem_mb"] / max(base[key]["peak_mem_mb"], 1e-9)
+        name = res["benchmark"] if res.get("module") is None else "{} {}".format(res["benchmark"], res["module"])
+        rows.append((name, res["size"], time_ratio, mem_ratio,
+                     (time_ratio > 1 + threshold) or (mem_ratio > 1 + threshold)))
+
+    return rows
+
+
+def main(args):
+    import mousechd_napari
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.thread_budget:
+        from mousechd_napari._threads import set_thread_budget
+        set_thread_budget(args.thread_budget)
+    results = run_benchmarks(sizes=args.sizes,
+                             benchmarks=args.benchmarks,
+                             repeat=args.repeat,
+                             model_dir=args.model,
+                             nthreads_preprocessing=args.nthreads_preprocessing,
+                             nthreads_nifti=args.nthreads_nifti)
+    report = {"version": mousechd_napari.__version__,
+              "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+              "platform": platform.platform(),
+              "python": platform.python_version(),
+              "cpu_count": os.cpu_count(),
+              "thread_budget": args.thread_budget or None,
+              "results": results}
+    with open(args.outfile, "w") as f:
+        json.dump(report, f, indent=1)
+    logging.info(f"Results saved in {args.outfile}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, threshold=args.threshold)
+        logging.info("Compared with version {} ({})".format(baseline.get("version"), baseline.get("date")))
+        for bench, size, time_ratio, mem_ratio, regression in rows:
+            logging.info("{:<12} {:>5}^3  time x{:.2f}  memory x{:.2f}{}".format(
+                bench, size, time_ratio, mem_ratio, "  REGRESSION" if regression else ""))
+        if any(x[-1] for x in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark MouseCHD napari hot paths")
+    parser = add_args(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,42 @@
+"""
+Measure this computer and save recommended thread counts and step size for the plugin
+"""
+import os
+import json
+import logging
+import argparse
+
+
+def add_args(parser):
+    parser.add_argument("-workdir", type=str, help="Working directory (disk throughput is measured there). Default: ~/.MouseCHD/Napari", default=None)
+    parser.add_argument("-segment", type=int, choices=[0, 1], help="Time a short segmentation on a crop of the sample scan", default=1)
+    parser.add_argument("-target_minutes", type=float, help="Target segmentation time of a scan on CPU (minutes)", default=10)
+    parser.add_argument("-save", type=int, choices=[0, 1], help="Save recommended settings in vars.json", default=1)
+
+    return parser
+
+
+def main(args):
+    from mousechd.utils.tools import CACHE_DIR
+    from mousechd_napari.assets import download_assets
+    from mousechd_napari._calibrate import calibrate
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    workdir = os.path.join(CACHE_DIR, "Napari") if args.workdir is None else args.workdir
+    sample_path = None
+    if args.segment:
+        download_assets()
+        sample_path = os.path.join(CACHE_DIR, "Napari", "assets", "sample.nii.gz")
+    res = calibrate(workdir=workdir,
+                    sample_path=sample_path,
+                    segment=bool(args.segment),
+                    target_minutes=args.target_minutes,
+                    save=bool(args.save))
+    print(json.dumps(res["recommended"], indent=1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate MouseCHD napari settings")
+    parser = add_args(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,50 @@
+"""
+Compare the optimized CPU runtime with the default one on the sample scan (time and Dice)
+"""
+import os
+import logging
+import argparse
+
+
+def add_args(parser):
+    from mousechd_napari._profiles import PROFILES
+    from mousechd_napari._runtime import MIN_DICE
+
+    parser.add_argument("-profile", type=str, choices=list(PROFILES.keys()), help="Segmentation profile", default="standard")
+    parser.add_argument("-sample", type=str, help="NIfTI scan to segment. Default: sample scan of the plugin", default=None)
+    parser.add_argument("-crop", type=int, help="Segment only the central crop^3 region. Default: whole scan", default=None)
+    parser.add_argument("-nthreads", type=int, help="Torch threads of the optimized runtime. Default: thread budget", default=None)
+    parser.add_argument("-min_dice", type=float, help="Minimal Dice with the default runtime to recommend a variant", default=MIN_DICE)
+
+    return parser
+
+
+def main(args):
+    from mousechd.utils.tools import CACHE_DIR
+    from mousechd_napari.assets import download_assets
+    from mousechd_napari._runtime import benchmark_cpu_runtime, runtime_path
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    sample_path = args.sample
+    if sample_path is None:
+        download_assets()
+        sample_path = os.path.join(CACHE_DIR, "Napari", "assets", "sample.nii.gz")
+    res = benchmark_cpu_runtime(sample_path,
+                                profile=args.profile,
+                                crop=args.crop,
+                                nthreads=args.nthreads,
+                                min_dice=args.min_dice)
+    for name, v in res["variants"].items():
+        if "error" in v:
+            print("{:<20} failed: {}".format(name, v["error"]))
+        else:
+            print("{:<20} {:8.1f}s  x{:.2f}  Dice {:.4f}".format(name, v["time"], v["speedup"], v["dice"]))
+    print("Recommended: {}".format(res["recommended"]["variant"] if res["recommended"] else "default runtime"))
+    print(f"Saved in {runtime_path()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CPU runtime")
+    parser = add_args(parser)
+    args = parser.parse_args()
+    main(args)
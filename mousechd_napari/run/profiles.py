@@ -0,0 +1,50 @@
+"""
+Measure the runtime and the Dice of the segmentation profiles on the sample scan
+"""
+import os
+import time
+import logging
+import argparse
+
+
+def add_args(parser):
+    from mousechd_napari._profiles import PROFILES
+
+    parser.add_argument("-profiles", type=str, nargs="+", choices=list(PROFILES.keys()),
+                        help="Profiles to measure. The Dice is computed against the most accurate one. Default: all", default=None)
+    parser.add_argument("-sample", type=str, help="NIfTI scan to segment. Default: sample scan of the plugin", default=None)
+    parser.add_argument("-crop", type=int, help="Segment only the central crop^3 region (faster on CPU). Default: whole scan", default=None)
+    parser.add_argument("-nthreads_preprocessing", type=int, help="Number of threads for segmentation preprocessing", default=6)
+    parser.add_argument("-nthreads_nifti", type=int, help="Number of threads to save NIFTI files", default=2)
+
+    return parser
+
+
+def main(args):
+    from mousechd.utils.tools import CACHE_DIR
+    from mousechd_napari.assets import download_assets
+    from mousechd_napari._profiles import measure_profiles, profiles_path
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    sample_path = args.sample
+    if sample_path is None:
+        download_assets()
+        sample_path = os.path.join(CACHE_DIR, "Napari", "assets", "sample.nii.gz")
+    res = measure_profiles(sample_path,
+                           profiles=args.profiles,
+                           nthreads_preprocessing=args.nthreads_preprocessing,
+                           nthreads_nifti=args.nthreads_nifti,
+                           crop=args.crop)
+    for profile, m in res.items():
+        print("{:<10} {:>10}  Dice vs {}: {:.3f}".format(profile,
+                                                         time.strftime("%Hh%Mm%Ss", time.gmtime(m["time"])),
+                                                         m["reference"],
+                                                         m["dice"]))
+    print(f"Saved in {profiles_path()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure segmentation profiles")
+    parser = add_args(parser)
+    args = parser.parse_args()
+    main(args)
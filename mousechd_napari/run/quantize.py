@@ -0,0 +1,43 @@
+"""
+Make the int8 copy of the segmentation model and validate it on the sample scan (speedup and Dice)
+"""
+import os
+import logging
+import argparse
+
+
+def add_args(parser):
+    from mousechd_napari._profiles import PROFILES
+    from mousechd_napari._quantize import CROP_SIZE
+
+    parser.add_argument("-sample", type=str, help="NIfTI scan for calibration and validation. Default: sample scan of the plugin", default=None)
+    parser.add_argument("-crop", type=int, help="Use the central crop^3 region of the scan, 0 for the whole scan", default=CROP_SIZE)
+    parser.add_argument("-profile", type=str, choices=list(PROFILES.keys()), help="Profile of the validation", default="standard")
+    parser.add_argument("-validate_only", type=int, choices=[0, 1], help="Only validate the existing int8 model", default=0)
+
+    return parser
+
+
+def main(args):
+    from mousechd.utils.tools import CACHE_DIR
+    from mousechd_napari.assets import download_assets
+    from mousechd_napari._quantize import quantize_segmenter, validate_quantized, describe_validation, quant_dir
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    sample_path = args.sample
+    if sample_path is None:
+        download_assets()
+        sample_path = os.path.join(CACHE_DIR, "Napari", "assets", "sample.nii.gz")
+    crop = args.crop if args.crop > 0 else None
+    if not args.validate_only:
+        quantize_segmenter(sample_path, crop=crop)
+    res = validate_quantized(sample_path, profile=args.profile, crop=crop)
+    print(describe_validation(res))
+    print(f"Saved in {quant_dir()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize the segmentation model")
+    parser = add_args(parser)
+    args = parser.parse_args()
+    main(args)
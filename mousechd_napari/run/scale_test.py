@@ -0,0 +1,157 @@
+"""
+Run the retrain data preparation on synthetic cohorts of increasing size and report throughput and peak memory per stage
+"""
+import os
+import re
+import time
+import shutil
+import logging
+import argparse
+
+import pandas as pd
+import SimpleITK as sitk
+
+STAGES = ["preprocess", "metadata", "segment", "resample", "split"]
+
+
+def add_args(parser):
+    parser.add_argument("-workdir", type=str, help="Working directory for cohorts and retrain data")
+    parser.add_argument("-counts", type=int, nargs="+", help="Cohort sizes", default=[10, 100, 1000])
+    parser.add_argument("-size", type=int, help="Side of the phantom volumes (voxels at 0.02 mm)", default=256)
+    parser.add_argument("-format", type=str, choices=["NIFTI", "NRRD", "DICOM"], help="Format of the phantom scans", default="NIFTI")
+    parser.add_argument("-chd_ratio", type=float, help="Fraction of CHD phantoms", default=0.5)
+    parser.add_argument("-segment", type=str, choices=["threshold", "nnunet"],
+                        help="threshold: fast intensity segmentation of the phantoms; nnunet: segmentation model", default="threshold")
+    parser.add_argument("-nthreads", type=int, help="Number of threads for phantom generation", default=4)
+    parser.add_argument("-nthreads_preprocessing", type=int, help="Number of threads for segmentation preprocessing (nnunet)", default=6)
+    parser.add_argument("-nthreads_nifti", type=int, help="Number of threads to save NIFTI files (nnunet)", default=2)
+    parser.add_argument("-keep", type=int, choices=[0, 1], help="Keep the retrain data of each cohort", default=0)
+
+    return parser
+
+
+def threshold_segment(imdir, outdir, threshold=450):
+    """Segment phantoms by intensity: myocardium and chambers are brighter
+    than the body. Masks are written as `outdir/<heart_name>.nii.gz`, like
+    the segmentation model outputs.
+    """
+    from mousechd_napari._utils import clean_mask
+
+    os.makedirs(outdir, exist_ok=True)
+    for fn in sorted(os.listdir(imdir)):
+        if not fn.endswith(".nii.gz"):
+            continue
+        img = sitk.ReadImage(os.path.join(imdir, fn))
+        heart = (sitk.GetArrayFromImage(img) > threshold).astype("uint8")
+        ma = sitk.GetImageFromArray(clean_mask(heart))
+        ma.CopyInformation(img)
+        sitk.WriteImage(ma, os.path.join(outdir, re.sub(r"(_0000)?\.nii\.gz$", "", fn) + ".nii.gz"))
+
+
+def link_subset(cohort_dir, hearts, data_dir, n_hearts, chd_ratio):
+    """Data directory with CHD/Normal folders linking to the first phantoms
+    of the cohort.
+    """
+    n_chd = int(round(n_hearts * chd_ratio))
+    subset = ([x for x in hearts if x[0] == "CHD"][:n_chd]
+              + [x for x in hearts if x[0] == "Normal"][:n_hearts - n_chd])
+    for group in ["CHD", "Normal"]:
+        os.makedirs(os.path.join(data_dir, group), exist_ok=True)
+    files = {os.path.splitext(x)[0].replace(".nii", ""): x
+             for group in ["CHD", "Normal"] for x in os.listdir(os.path.join(cohort_dir, group))}
+    for group, name in subset:
+        dst = os.path.join(data_dir, group, files[name])
+        if not os.path.lexists(dst):
+            os.symlink(os.path.join(cohort_dir, group, files[name]), dst)
+
+    return n_chd, n_hearts - n_chd
+
+
+def main(args):
+    from mousechd.utils.tools import set_logger
+    from mousechd_napari._phantom import make_cohort
+    from mousechd_napari._profiling import PeakMemory
+    from mousechd_napari._utils import (preprocess,
+                                        segment_hearts,
+                                        resample,
+                                        make_retrain_metadata,
+                                        split_retrain_data)
+
+    os.makedirs(args.workdir, exist_ok=True)
+    set_logger(os.path.join(args.workdir, "scale_test.log"))
+
+    cohort_dir = os.path.join(args.workdir, "cohort_{}_{}".format(args.format, args.size))
+    hearts = make_cohort(cohort_dir,
+                         n_hearts=max(args.counts),
+                         size=args.size,
+                         fmt=args.format,
+                         chd_ratio=args.chd_ratio,
+                         nthreads=args.nthreads)
+
+    rows = []
+    for n_hearts in sorted(args.counts):
+        data_dir = os.path.join(args.workdir, f"data_{n_hearts}")
+        workdir = os.path.join(args.workdir, f"work_{n_hearts}")
+        retrain_dir = os.path.join(workdir, "retrain")
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(retrain_dir)
+        n_chd, n_normal = link_subset(cohort_dir, hearts, data_dir, n_hearts, args.chd_ratio)
+        logging.info(f"{n_hearts} hearts: {n_chd} CHD, {n_normal} Normal")
+
+        state = {}
+
+        def _preprocess(data_dir=data_dir, retrain_dir=retrain_dir):
+            for group in ["CHD", "Normal"]:
+                preprocess(indir=os.path.join(data_dir, group),
+                           outdir=os.path.join(retrain_dir, "processed"))
+
+        def _metadata(retrain_dir=retrain_dir, state=state):
+            state["df"] = make_retrain_metadata(retrain_dir)
+
+        def _segment(retrain_dir=retrain_dir, workdir=workdir):
+            if args.segment == "threshold":
+                threshold_segment(imdir=os.path.join(retrain_dir, "processed", "images"),
+                                  outdir=os.path.join(workdir, "HeartSeg"))
+            else:
+                segment_hearts(resrc="local",
+                               nthreads_preprocessing=args.nthreads_preprocessing,
+                               nthreads_nifti=args.nthreads_nifti,
+                               step_size=0.5,
+                               workdir=workdir)
+
+        def _resample(workdir=workdir):
+            resample(workdir=workdir)
+
+        def _split(retrain_dir=retrain_dir, state=state):
+            state["split"] = split_retrain_data(retrain_dir, state["df"])
+
+        for stage, func in zip(STAGES, [_preprocess, _metadata, _segment, _resample, _split]):
+            with PeakMemory(children=True) as mem:
+                start = time.time()
+                func()
+                duration = time.time() - start
+            rows.append({"n_hearts": n_hearts,
+                         "stage": stage,
+                         "time": duration,
+                         "hearts_per_s": n_hearts / max(duration, 1e-9),
+                         "peak_mem_mb": mem.peak / 2**20})
+            logging.info("{}. {}: {:.1f}s, {:.2f} hearts/s, peak memory {:.0f} MB".format(
+                n_hearts, stage, duration, rows[-1]["hearts_per_s"], rows[-1]["peak_mem_mb"]))
+
+        train_df, val_df, _, _ = state["split"]
+        logging.info(f"{n_hearts}. Train: {len(train_df)}, Val: {len(val_df)}")
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    df = pd.DataFrame(rows)
+    df.to_csv(os.path.join(args.workdir, "scale_test.csv"), index=False)
+    logging.info("\n" + df.pivot(index="stage", columns="n_hearts", values="hearts_per_s").loc[STAGES].to_string())
+    logging.info(f"Results saved in {os.path.join(args.workdir, 'scale_test.csv')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scale test of the retrain data preparation")
+    parser = add_args(parser)
+    args = parser.parse_args()
+    main(args)
@@ -4,7 +4,9 @@ def load_sample():
     
     from mousechd.utils.tools import CACHE_DIR
     from ._utils import tmp_dir
+    from .assets import download_assets
     
+    download_assets()
     shutil.copy2(os.path.join(CACHE_DIR, "Napari", "assets", "sample.nii.gz"), os.path.join(tmp_dir, "sample.nii.gz"))
         
     img = sitk.ReadImage(os.path.join(CACHE_DIR, "Napari", "assets", "sample.nii.gz"))